@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Benchmark for formatting a Graphite flush.
+
+Fills a Server with counters, gauges and timers and times Server.flush()
+against the old string-concatenation formatting, reporting wall time
+and peak memory. Nothing is sent over the network. Note that flush()
+reports more statistics per timer than the old format did, so its
+payload is larger.
+
+    $ python benchmarks/bench_flush.py [--keys 100000 1000000]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pystatsd.server import Server, _Record  # noqa: E402
+
+
+class NullSender(object):
+    def send(self, payloads):
+        self.sent = sum(len(payload) for payload in payloads)
+        return True
+
+
+def fill(server, keys):
+    ts = int(time.time())
+    for i in range(keys):
+        kind = i % 3
+        if kind == 0:
+            server.counters['app.counter%d' % i] = _Record(i, ts)
+        elif kind == 1:
+            server.gauges['app.gauge%d' % i] = _Record(float(i), ts)
+        else:
+            server.timers['app.timer%d' % i] = _Record([float(i), 1.0, 2.0], ts)
+
+
+def legacy_format(server, ts):
+    """The string-concatenation formatting flush used to do."""
+    stat_string = ''
+    for k, record in server.counters.items():
+        stat_string += '%s.%s %s %s\n' % (server.counters_prefix, k, record.value, ts)
+    for k, record in server.gauges.items():
+        stat_string += '%s.%s %s %s\n' % (server.counters_prefix, k, record.value, ts)
+    for k, record in server.timers.items():
+        v = record.value
+        v.sort()
+        for name, value in (('lower', v[0]), ('count', len(v)),
+                            ('mean', sum(v) / len(v)), ('upper', v[-1]),
+                            ('upper_90', v[-1])):
+            stat_string += '%s.%s.%s %s %s\n' % (
+                server.timers_prefix, k, name, value, ts)
+    if server.global_prefix:
+        stat_string = '\n'.join([
+            '%s.%s' % (server.global_prefix, s)
+            for s in stat_string.split('\n')[:-1]
+        ])
+    return bytes(bytearray(stat_string, 'utf-8'))
+
+
+def measure(keys, func):
+    """Time func on a freshly filled server, then run it again under
+    tracemalloc (which slows it down a lot) to get peak memory.
+    """
+    server = Server(global_prefix='apikey', pct_threshold=90)
+    server._graphite = NullSender()
+    fill(server, keys)
+    start = time.time()
+    size = func(server)
+    elapsed = time.time() - start
+
+    server = Server(global_prefix='apikey', pct_threshold=90)
+    server._graphite = NullSender()
+    fill(server, keys)
+    tracemalloc.start()
+    func(server)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def run_legacy(server):
+    return len(legacy_format(server, int(time.time())))
+
+
+def run_flush(server):
+    server.flush()
+    return server._graphite.sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, nargs='+',
+                        default=[100000, 1000000])
+    options = parser.parse_args()
+
+    for keys in options.keys:
+        for name, func in (('legacy', run_legacy), ('flush', run_flush)):
+            elapsed, peak, size = measure(keys, func)
+            print('%8d keys  %-6s  %7.2fs  peak %8.1f MiB  payload %8.1f MiB'
+                  % (keys, name, elapsed, peak / 1048576.0, size / 1048576.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark for the memory held by live metric keys.
+
+Feeds the same datagrams (a third counters, a third gauges, a third
+timers with one sample each, 50 lines per datagram) to the old
+representation, where each key was a ``[value, ts]`` list and the clock
+was read for every line, and to Server.process, which keeps slotted
+records and reads the clock once per datagram. Reports the memory still
+held once every key is live, and the ingest time.
+
+    $ python benchmarks/bench_memory.py [--keys 1000000]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pystatsd.parser import Parser, parse_sample_rate  # noqa: E402
+from pystatsd.server import Server  # noqa: E402
+
+
+def datagrams(keys, per_datagram=50):
+    lines = []
+    for i in range(keys):
+        kind = i % 3
+        if kind == 0:
+            lines.append('app.counter%d:1|c' % i)
+        elif kind == 1:
+            lines.append('app.gauge%d:%d|g' % (i, i))
+        else:
+            lines.append('app.timer%d:%d|ms' % (i, i % 1000))
+        if len(lines) == per_datagram:
+            yield '\n'.join(lines)
+            lines = []
+    if lines:
+        yield '\n'.join(lines)
+
+
+class LegacyStore(object):
+    """Aggregation the way Server did it before: [value, ts] lists and a
+    time.time() call per line.
+    """
+
+    def __init__(self):
+        self.parser = Parser()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+
+    def process(self, data):
+        for line in data.split('\n'):
+            key, value, mtype, rest = self.parser.parse(line)
+            if mtype == 'ms':
+                ts = int(time.time())
+                timer = self.timers.get(key)
+                if timer is None:
+                    timer = self.timers[key] = [[], ts]
+                timer[0].append(float(value or 0))
+                timer[1] = ts
+            elif mtype == 'g':
+                ts = int(time.time())
+                self.gauges[key] = [float(value), ts]
+            else:
+                ts = int(time.time())
+                sample_rate = 1.0
+                if len(rest) == 1:
+                    sample_rate = parse_sample_rate(rest[0])
+                counter = self.counters.setdefault(key, [0, ts])
+                counter[0] += float(value or 1) * (1 / sample_rate)
+                counter[1] = ts
+
+
+def measure(keys, make):
+    packets = list(datagrams(keys))
+
+    store = make()
+    start = time.time()
+    for packet in packets:
+        store.process(packet)
+    elapsed = time.time() - start
+    del store
+
+    gc.collect()
+    tracemalloc.start()
+    store = make()
+    for packet in packets:
+        store.process(packet)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, held
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, nargs='+', default=[1000000])
+    options = parser.parse_args()
+
+    for keys in options.keys:
+        for name, make in (('legacy', LegacyStore), ('records', Server)):
+            elapsed, held = measure(keys, make)
+            print('%8d keys  %-7s  %6.2fs  held %7.1f MiB  (%5.1f bytes/key)'
+                  % (keys, name, elapsed, held / 1048576.0, held / float(keys)))
+
+
+if __name__ == '__main__':
+    main()
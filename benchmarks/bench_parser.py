@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Micro-benchmark for statsd line parsing.
+
+Compares the old per-line ``re.match`` + ``_clean_key`` approach with
+``pystatsd.parser.Parser`` and prints lines/sec for each.
+
+    $ python benchmarks/bench_parser.py [--lines N] [--keys N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pystatsd.parser import Parser, parse_sample_rate  # noqa: E402
+
+
+def legacy_clean_key(k):
+    return re.sub(
+        r'[^a-zA-Z_\-0-9\.]',
+        '',
+        re.sub(
+            r'\s+',
+            '_',
+            k.replace('/', '-').replace(' ', '_')
+        )
+    )
+
+
+def legacy_parse(line):
+    match = re.match(r'\A([^:]+):([^|]+)\|(.+)', line)
+    if match is None:
+        return None
+    key = legacy_clean_key(match.group(1))
+    value = match.group(2)
+    rest = match.group(3).split('|')
+    mtype = rest.pop(0)
+    if len(rest) == 1:
+        float(re.match(r'^@([\d\.]+)', rest[0]).group(1))
+    return key, value, mtype, rest
+
+
+def make_parse():
+    parse_line = Parser().parse
+
+    def parse(line):
+        parsed = parse_line(line)
+        if parsed is not None and len(parsed[3]) == 1:
+            parse_sample_rate(parsed[3][0])
+        return parsed
+    return parse
+
+
+def make_lines(count, keys):
+    types = ('c', 'ms', 'g', 'c|@0.1')
+    return ['app.web%d.requests/%s:%d|%s' % (i % keys, 'get', i, types[i % 4])
+            for i in range(count)]
+
+
+def bench(name, parse, lines):
+    start = time.time()
+    for line in lines:
+        parse(line)
+    elapsed = time.time() - start
+    print('%-8s %10d lines in %.3fs  %12.0f lines/sec'
+          % (name, len(lines), elapsed, len(lines) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=500000)
+    parser.add_argument('--keys', type=int, default=1000)
+    options = parser.parse_args()
+
+    lines = make_lines(options.lines, options.keys)
+    bench('legacy', legacy_parse, lines)
+    bench('parser', make_parse(), lines)
+
+
+if __name__ == '__main__':
+    main()
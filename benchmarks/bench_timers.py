@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Benchmark for timer sample storage.
+
+Feeds the same samples, spread over --timers timers, to plain lists and
+array('d') buffers (both flushed by the server's _timer_stats; arrays
+both with NumPy, when installed, and in pure Python) and to
+QuantileSketches. Prints the memory held and the time taken to compute
+the flush statistics for each.
+
+    $ python benchmarks/bench_timers.py [--samples 10000000] [--timers 1]
+"""
+
+import argparse
+import array
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pystatsd import server  # noqa: E402
+from pystatsd.sketch import QuantileSketch  # noqa: E402
+
+
+PERCENTILES = (50, 90, 95, 99, 99.9)
+
+
+def flush_sketch(sketch):
+    count = sketch.count
+    return (sketch.min, sketch.max, sketch.sum / count,
+            [sketch.value_at_rank(int(p / 100.0 * count) - 1)
+             for p in PERCENTILES])
+
+
+def flush_stats(samples):
+    stat = server._timer_stats(samples, PERCENTILES)
+    return (stat['min'], stat['max'], stat['mean'],
+            [value for pct, value in stat['thresholds']])
+
+
+def new_array():
+    return array.array('d')
+
+
+def record(container, values, timers):
+    all_samples = [container() for i in range(timers)]
+    appends = [samples.append for samples in all_samples]
+    for i, value in enumerate(values):
+        # Like the server, store a freshly parsed float per sample.
+        appends[i % timers](value + 0.0)
+    return all_samples
+
+
+def bench(name, container, flush, values, timers, numpy=None):
+    tracemalloc.start()
+    samples = record(container, values, timers)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del samples
+
+    start = time.time()
+    samples = record(container, values, timers)
+    recorded = time.time() - start
+
+    saved, server.numpy = server.numpy, numpy
+    try:
+        start = time.time()
+        for timer in samples:
+            result = flush(timer)
+        elapsed = time.time() - start
+    finally:
+        server.numpy = saved
+    print('%-13s record %6.2fs  memory %9.1f MiB  flush %9.2f ms  p99=%.2f'
+          % (name, recorded, memory / 1048576.0, elapsed * 1000, result[3][3]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=10000000)
+    parser.add_argument('--timers', type=int, default=1)
+    options = parser.parse_args()
+
+    rnd = random.Random(0)
+    values = [rnd.lognormvariate(3, 1) for i in range(options.samples)]
+    timers = options.timers
+    bench('list', list, flush_stats, values, timers)
+    bench('array', new_array, flush_stats, values, timers)
+    if server.numpy is not None:
+        bench('array+numpy', new_array, flush_stats, values, timers,
+              numpy=server.numpy)
+    bench('sketch', QuantileSketch, flush_sketch, values, timers)
+
+
+if __name__ == '__main__':
+    main()
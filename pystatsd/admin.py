@@ -0,0 +1,140 @@
+"""Admin TCP port, modelled on etsy statsd's management port.
+
+Send one command per line:
+
+    help      list the commands
+    stats     uptime, ingest totals, key counts and last flush figures
+    counters  counters of the current flush interval
+    gauges    last known gauges
+    timers    sample counts of the current flush interval's timers
+    sets      distinct member counts of the current flush interval's sets
+    profile   stage timings of the running profile; 'profile start',
+              'profile stop' (also dumps to profile_dir if set) and
+              'profile stacks' for its collapsed stacks
+    quit      close the connection
+
+Every reply is a list of ``name: value`` lines followed by ``END`` and
+an empty line. Unknown commands get ``ERROR``.
+"""
+
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+__all__ = ['AdminServer', 'admin_command']
+
+
+COMMANDS = ('help', 'stats', 'counters', 'gauges', 'timers', 'sets', 'profile', 'quit')
+
+
+def _stats(server):
+    with server._lock:
+        ingest = dict(server._ingest)
+        keys = (len(server.counters), len(server.gauges), len(server.timers),
+                len(server.sets))
+        rejected = server._rejected[0]
+    stats = [('uptime', int(time.time() - server.started))]
+    for name in sorted(ingest):
+        stats.append(('ingest.%s' % name, server.totals[name] + ingest[name]))
+    stats.extend([
+        ('keys.counters', keys[0]),
+        ('keys.gauges', keys[1]),
+        ('keys.timers', keys[2]),
+        ('keys.sets', keys[3]),
+        ('keys.rejected', rejected),
+        ('flush.last', server.last_flush),
+        ('flush.duration_ms', round(server.flush_duration, 3)),
+        ('flush.send_latency_ms', round(server.send_latency, 3)),
+        ('flush.bytes_sent', server.bytes_sent),
+    ])
+    for phase, ms in server.flush_phases:
+        stats.append(('flush.phase.%s_ms' % phase, round(ms, 3)))
+    if server._graphite is not None:
+        stats.append(('graphite.queued_bytes', server._graphite.queued_bytes))
+        stats.append(('graphite.dropped_bytes', server._graphite.dropped_bytes))
+    if server.transport == 'ganglia-gmetric':
+        stats.append(('gmetric.dropped', server.gmetric_dropped))
+    return stats
+
+
+def _profile(server, action):
+    if action == 'start':
+        profiler = server.start_profiling()
+    elif action == 'stop':
+        profiler = server.stop_profiling()
+    else:
+        profiler = server._profiler
+    if profiler is None:
+        return ['profiling: off']
+    if action == 'stacks':
+        return profiler.collapsed()
+    lines = ['profiling: %s' % ('on' if profiler.running else 'off'),
+             'samples: %d' % profiler.samples]
+    for row in profiler.summary():
+        lines.append('stage.%s: calls=%d total_ms=%.3f us_per_call=%.3f' % row)
+    return lines
+
+
+def admin_command(server, command):
+    """Run one admin command against server and return the reply."""
+    command, sep, arg = command.partition(' ')
+    if command == 'help':
+        lines = ['Commands: %s' % ', '.join(COMMANDS)]
+    elif command == 'stats':
+        lines = ['%s: %s' % stat for stat in _stats(server)]
+    elif command in ('counters', 'gauges', 'timers', 'sets'):
+        with server._lock:
+            if command == 'gauges':
+                metrics = dict(server._flushed_gauges)
+                metrics.update(server.gauges)
+            else:
+                metrics = dict(getattr(server, command))
+            if command == 'timers':
+                values = [(k, len(record.value)) for k, record in metrics.items()]
+            elif command == 'sets':
+                values = [(k, record.value.count()) for k, record in metrics.items()]
+            else:
+                values = [(k, record.value) for k, record in metrics.items()]
+        lines = ['%s: %s' % value for value in sorted(values)]
+    elif command == 'profile' and arg.strip() in ('', 'start', 'stop', 'stacks'):
+        lines = _profile(server, arg.strip())
+    else:
+        return 'ERROR\n'
+    lines.append('END')
+    return '\n'.join(lines) + '\n\n'
+
+
+class _AdminHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('utf-8', 'replace').strip()
+            if command == 'quit':
+                return
+            if command:
+                reply = admin_command(self.server.statsd, command)
+                self.wfile.write(reply.encode('utf-8'))
+
+
+class AdminServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Serves the admin port for server from a background thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server, addr):
+        socketserver.TCPServer.__init__(self, addr, _AdminHandler)
+        self.statsd = server
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
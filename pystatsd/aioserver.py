@@ -0,0 +1,384 @@
+"""asyncio-based statsd server.
+
+AsyncServer aggregates exactly like Server, but everything runs on one
+event loop: datagrams arrive through ``datagram_received``, flushes are
+scheduled with ``call_at`` and metrics go out over non-blocking
+transports. A slow or unreachable Graphite host, a full Ganglia socket or
+a gmetric run that takes its time never holds up ingest.
+
+This module needs Python 3.5 or later; server.py does not import it.
+"""
+
+import asyncio
+import logging
+import signal
+import time
+
+try:
+    from . import gmetric
+    from .admin import admin_command
+    from .graphite import GraphiteSender, _Connection, parse_addrs
+    from .server import Server
+except ValueError:
+    import gmetric
+    from admin import admin_command
+    from graphite import GraphiteSender, _Connection, parse_addrs
+    from server import Server
+
+__all__ = ['AsyncServer', 'AsyncGraphiteSender']
+
+
+log = logging.getLogger(__name__)
+
+
+class _AsyncConnection(_Connection, asyncio.Protocol):
+    """A carbon connection driven by the event loop. Writing pauses while
+    the transport holds more than the sender's chunk_size, so undelivered
+    data stays in the sender's bounded queue rather than in the transport.
+    """
+
+    def __init__(self, sender, addr, timeout, backoff_min, backoff_max):
+        _Connection.__init__(self, addr, timeout, backoff_min, backoff_max)
+        self.sender = sender
+        self.transport = None
+        self.connecting = False
+        self.paused = False
+
+    def available(self, now):
+        return self.transport is not None or (
+            not self.connecting and now >= self.retry_at)
+
+    def connect(self, loop):
+        self.connecting = True
+        loop.create_task(self._connect(loop))
+
+    async def _connect(self, loop):
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: self, *self.addr),
+                self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.connecting = False
+            self.fail(time.time())
+            log.error("Error connecting to Graphite %s:%s: %s"
+                      % (self.addr + (e,)))
+            self.sender._pump()
+
+    def connection_made(self, transport):
+        self.connecting = False
+        self.transport = transport
+        self.backoff = 0
+        transport.set_write_buffer_limits(high=self.sender.chunk_size)
+        self.sender._pump()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.paused = False
+        if self.sender.closed:
+            return
+        # Carbon never closes on its own, so any loss counts as a failure.
+        self.fail(time.time())
+        if exc is not None:
+            log.error("Error communicating with Graphite %s:%s: %s"
+                      % (self.addr + (exc,)))
+        self.sender._lost(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.sender._pump()
+
+    def data_received(self, data):
+        pass
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.abort()
+            self.transport = None
+
+
+class AsyncGraphiteSender(GraphiteSender):
+    """GraphiteSender for an event loop: send() queues the payloads and
+    returns at once; they are written as the connection accepts them.
+
+    Takes the same arguments as GraphiteSender plus the loop. Only whole
+    payloads move to the next relay. If a connection drops, the payload in
+    progress is resumed from its last line start (or from its start, for
+    pickle frames); up to chunk_size bytes the transport had buffered but
+    not yet written may be lost.
+    """
+
+    def __init__(self, addrs, loop, **kwargs):
+        GraphiteSender.__init__(self, [], **kwargs)
+        self.loop = loop
+        timeout = kwargs.get('timeout', 5.0)
+        backoff_min = kwargs.get('backoff_min', 1.0)
+        backoff_max = kwargs.get('backoff_max', 60.0)
+        self.connections = [_AsyncConnection(self, addr, timeout,
+                                             backoff_min, backoff_max)
+                            for addr in addrs]
+        self._current = None
+        self.closed = False
+
+    def send(self, payloads):
+        """Queue payloads and start writing them. Returns True if the
+        queue could be handed to a connection right away.
+        """
+        if not isinstance(payloads, (list, tuple)):
+            payloads = [payloads]
+        if not self._queue:
+            # Nothing in flight, so this flush may go to the next relay.
+            self._current = None
+        for payload in payloads:
+            if payload:
+                self._enqueue(payload)
+        return self._pump()
+
+    def _pump(self):
+        if self.closed:
+            return False
+        queue = self._queue
+        chunk_size = self.chunk_size
+        while queue:
+            connection = self._current
+            if connection is None or connection.transport is None:
+                connection = self._current = self._pick(time.time())
+                if connection is None:
+                    log.debug("All Graphite hosts backing off, %d bytes queued",
+                              self._queued_bytes)
+                    return False
+                if connection.transport is None:
+                    if not connection.connecting:
+                        connection.connect(self.loop)
+                    return False
+            if connection.paused:
+                return False
+            entry = queue[0]
+            payload, offset = entry
+            chunk = bytes(payload[offset:offset + chunk_size])
+            connection.transport.write(chunk)
+            entry[1] = offset + len(chunk)
+            self._queued_bytes -= len(chunk)
+            if entry[1] >= len(payload):
+                queue.popleft()
+        return True
+
+    def _lost(self, connection):
+        if connection is not self._current:
+            return
+        self._current = None
+        if self._queue:
+            entry = self._queue[0]
+            payload, offset = entry
+            if self.line_protocol:
+                resume = payload.rfind(b'\n', 0, offset) + 1
+            else:
+                resume = 0
+            self._queued_bytes += offset - resume
+            entry[1] = resume
+        self._pump()
+
+    def close(self):
+        self.closed = True
+        GraphiteSender.close(self)
+
+
+class _AsyncGmetric(gmetric.Gmetric):
+    """Gmetric on a non-blocking socket. Packets the kernel cannot take
+    right away are dropped and counted instead of waited for.
+    """
+
+    def __init__(self, host, port, protocol):
+        gmetric.Gmetric.__init__(self, host, port, protocol)
+        self.socket.setblocking(False)
+        self.dropped = 0
+
+    def send(self, *args, **kwargs):
+        try:
+            gmetric.Gmetric.send(self, *args, **kwargs)
+        except BlockingIOError:
+            self.dropped += 1
+
+
+class _StatsdProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        try:
+            self.server.process(data)
+        except Exception as error:
+            log.error("Bad data from %s: %s", addr, error)
+
+    def error_received(self, exc):
+        log.error("Receive error: %s", exc)
+
+
+class _StatsdStreamProtocol(asyncio.Protocol):
+    """Newline-terminated lines over TCP."""
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = b''
+
+    def data_received(self, data):
+        lines, sep, self.pending = (self.pending + data).rpartition(b'\n')
+        if len(self.pending) > self.server.buf:
+            log.error("Dropping line longer than %d bytes from TCP client", self.server.buf)
+            self.pending = b''
+        self._process(lines)
+
+    def connection_lost(self, exc):
+        self._process(self.pending)
+        self.pending = b''
+
+    def _process(self, lines):
+        if lines:
+            try:
+                self.server.process(lines)
+            except Exception as error:
+                log.error("Bad data from TCP client: %s", error)
+
+
+class _AdminProtocol(asyncio.Protocol):
+    """The admin commands of admin.py, served on the loop."""
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            command = line.decode('utf-8', 'replace').strip()
+            if command == 'quit':
+                self.transport.close()
+                return
+            if command:
+                reply = admin_command(self.server, command)
+                self.transport.write(reply.encode('utf-8'))
+
+
+class AsyncServer(Server):
+    """Server running on an asyncio event loop.
+
+    Takes the same arguments as Server, except that workers is not
+    supported and recv_batch has no effect: the loop reads every datagram
+    that is ready whenever the socket becomes readable.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Server.__init__(self, *args, **kwargs)
+        if self.workers > 0:
+            raise ValueError("AsyncServer does not support workers")
+        self.loop = None
+        self._transports = []
+        self._flush_handle = None
+        self._next_flush = None
+
+    async def start(self, hostname='', port=8125, loop=None):
+        """Start listening and schedule flushes on loop (the current
+        event loop by default). Returns once the sockets are bound.
+        """
+        assert type(port) is int, 'port is not an integer: %s' % (port)
+        self.loop = loop or asyncio.get_event_loop()
+        addr = (hostname, port)
+        reuseport = self.sockets > 1
+        for i in range(self.sockets):
+            sock = self._bind(addr, reuseport)
+            if i == 0:
+                # Later sockets share the port the first one got.
+                addr = sock.getsockname()
+            transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: _StatsdProtocol(self), sock=sock)
+            self._transports.append(transport)
+        if self.unix_socket:
+            transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: _StatsdProtocol(self), sock=self._bind_unix(self.unix_socket))
+            self._transports.append(transport)
+        if self.tcp_port is not None:
+            self._listeners.append(await self.loop.create_server(
+                lambda: _StatsdStreamProtocol(self),
+                sock=self._listen_tcp((hostname, self.tcp_port))))
+        if self.admin_port is not None:
+            self._listeners.append(await self.loop.create_server(
+                lambda: _AdminProtocol(self),
+                sock=self._listen_tcp((self.admin_host, self.admin_port))))
+        self._schedule_flush()
+
+    @property
+    def address(self):
+        """(host, port) of the first listening socket."""
+        return self._transports[0].get_extra_info('sockname')
+
+    def _schedule_flush(self):
+        # Scheduled on absolute loop time so flushes do not drift.
+        now = self.loop.time()
+        if self._next_flush is None:
+            self._next_flush = now
+        self._next_flush += self.flush_interval / 1000
+        if self._next_flush < now:
+            self._next_flush = now
+        self._flush_handle = self.loop.call_at(self._next_flush, self.on_timer)
+
+    def _set_timer(self):
+        self._schedule_flush()
+
+    def _run_gmetric(self, commands):
+        # GmetricPool.run blocks until its deadline, so it gets a thread.
+        self.loop.run_in_executor(None, Server._run_gmetric, self, commands)
+
+    def graphite_sender(self):
+        if self._graphite is None:
+            self._graphite = AsyncGraphiteSender(
+                parse_addrs(self.graphite_host, self.graphite_port),
+                self.loop,
+                timeout=self.graphite_timeout,
+                max_queue_bytes=self.graphite_queue_bytes,
+                line_protocol=self.transport != 'graphite-pickle')
+        return self._graphite
+
+    def ganglia_sender(self):
+        if self._gmetric is None:
+            self._gmetric = _AsyncGmetric(self.ganglia_host, self.ganglia_port, self.ganglia_protocol)
+        return self._gmetric
+
+    def serve(self, hostname='', port=8125):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.start(hostname, port, loop))
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+            if self.profile_dir and hasattr(signal, 'SIGUSR1'):
+                loop.add_signal_handler(signal.SIGUSR1, self._toggle_profiling)
+        except NotImplementedError:
+            pass
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def stop(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self.stop_profiling()
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        for listener in self._listeners:
+            listener.close()
+        self._listeners = []
+        self._unlink_unix()
+        if self._graphite is not None:
+            self._graphite.close()
+        if self._gmetric is not None:
+            self._gmetric.close()
+        if self.loop is not None and self.loop.is_running():
+            self.loop.stop()
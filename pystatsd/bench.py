@@ -0,0 +1,392 @@
+"""End-to-end benchmark behind ``pystatsd-bench``.
+
+Starts a Server in a child process, with Graphite pointed at a fake
+carbon listener in this process, floods it with synthetic traffic over
+loopback UDP from one or more sender processes and reports:
+
+* lines sent and lines the server actually ingested, hence the drop rate
+* ingest throughput in lines per second
+* flush duration percentiles, read from the server's admin port
+* peak RSS of the server and its workers (Linux only)
+* what the fake carbon received
+
+The traffic is generated up front from a seed, so runs with the same
+options send the same packets.
+
+    $ pystatsd-bench --duration 10 --keys 10000 --mix c=60,ms=30,g=10
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+try:
+    from .server import Server, _mp, _parse_pcts
+except ValueError:
+    from server import Server, _mp, _parse_pcts
+
+__all__ = ['make_packets', 'parse_mix', 'run_bench']
+
+
+def parse_mix(value):
+    """Parse a metric type mix such as 'c=60,ms=30,g=10' into a list of
+    (type, weight).
+    """
+    mix = []
+    for part in value.split(','):
+        mtype, sep, weight = part.strip().partition('=')
+        if mtype not in ('c', 'ms', 'g', 's'):
+            raise ValueError("unknown metric type: %s" % mtype)
+        mix.append((mtype, float(weight) if sep else 1.0))
+    return mix
+
+
+def make_packets(keys=1000, mix=(('c', 1.0),), sample_rate=1.0,
+                 packet_size=1432, values_per_line=1, lines=None, seed=0):
+    """Generate datagrams of synthetic statsd traffic.
+
+    Each of the keys has a fixed type drawn from mix. Lines are packed
+    into datagrams of at most packet_size bytes, with values_per_line
+    colon-separated values each; counters carry |@sample_rate when it is
+    below 1. Enough lines are generated to touch every key (at least
+    lines of them). Returns a list of (datagram, number of lines).
+    """
+    rnd = random.Random(seed)
+    types = [mtype for mtype, weight in mix]
+    total = sum([weight for mtype, weight in mix])
+    cumulative = []
+    acc = 0.0
+    for mtype, weight in mix:
+        acc += weight / total
+        cumulative.append(acc)
+
+    def pick_type():
+        x = rnd.random()
+        for mtype, bound in zip(types, cumulative):
+            if x < bound:
+                return mtype
+        return types[-1]
+
+    key_types = [pick_type() for i in range(keys)]
+    rate = '|@%s' % sample_rate if sample_rate < 1 else ''
+    if lines is None:
+        lines = max(keys, 50000)
+
+    packets = []
+    packet, count, size = [], 0, 0
+    for i in range(lines):
+        index = i if i < keys else rnd.randrange(keys)
+        mtype = key_types[index]
+        if mtype == 'c':
+            values = ['1'] * values_per_line
+        elif mtype == 'ms':
+            values = [str(rnd.randint(1, 1000)) for v in range(values_per_line)]
+        elif mtype == 's':
+            values = ['u%d' % rnd.randrange(1000) for v in range(values_per_line)]
+        else:
+            values = [str(rnd.randint(0, 100)) for v in range(values_per_line)]
+        line = 'bench.%s.%d:%s|%s' % (mtype, index, ':'.join(values), mtype)
+        if mtype == 'c':
+            line += rate
+        if packet and size + 1 + len(line) > packet_size:
+            packets.append(('\n'.join(packet).encode('utf-8'), count))
+            packet, count, size = [], 0, 0
+        if packet:
+            size += 1
+        packet.append(line)
+        count += 1
+        size += len(line)
+    if packet:
+        packets.append(('\n'.join(packet).encode('utf-8'), count))
+    rnd.shuffle(packets)
+    return packets
+
+
+def _free_port(kind=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _serve(kwargs, port):
+    Server(**kwargs).serve('127.0.0.1', port)
+
+
+def _send(addr, packets, duration, rate, results):
+    """Sender process: cycle through packets for duration seconds, at
+    most rate lines per second if rate is set.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sendto = sock.sendto
+    lines = sent = errors = 0
+    start = time.time()
+    end = start + duration
+    i = 0
+    while 1:
+        if i % 64 == 0:
+            now = time.time()
+            if now >= end:
+                break
+            if rate and lines > rate * (now - start):
+                time.sleep(min(0.01, end - now))
+                continue
+        data, count = packets[i % len(packets)]
+        i += 1
+        try:
+            sendto(data, addr)
+        except socket.error:
+            errors += 1
+            continue
+        sent += 1
+        lines += count
+    sock.close()
+    results.put((sent, lines, errors))
+
+
+class _Carbon(object):
+    """Fake carbon: accepts plaintext connections and counts what it gets."""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.bytes = 0
+        self.lines = 0
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while 1:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._read, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, conn):
+        while 1:
+            try:
+                data = conn.recv(65536)
+            except socket.error:
+                data = b''
+            if not data:
+                conn.close()
+                return
+            with self._lock:
+                self.bytes += len(data)
+                self.lines += data.count(b'\n')
+
+    def close(self):
+        self.sock.close()
+
+
+def _admin_stats(port):
+    """Ask the server's admin port for its stats, or None if it is not
+    up yet.
+    """
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), 1)
+    except socket.error:
+        return None
+    try:
+        sock.sendall(b'stats\nquit\n')
+        reply = b''
+        while 1:
+            data = sock.recv(65536)
+            if not data:
+                break
+            reply += data
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    stats = {}
+    for line in reply.decode('utf-8').splitlines():
+        name, sep, value = line.partition(': ')
+        if sep:
+            stats[name] = value
+    return stats
+
+
+def _rss(pid):
+    """Resident memory in bytes of pid and its children, or None where
+    /proc is not available.
+    """
+    pids = [pid]
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open('/proc/%s/stat' % entry) as f:
+                        fields = f.read().rpartition(')')[2].split()
+                except IOError:
+                    continue
+                if int(fields[1]) == pid:
+                    pids.append(int(entry))
+        total = 0
+        for p in pids:
+            try:
+                with open('/proc/%d/status' % p) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except IOError:
+                pass
+        return total
+    except OSError:
+        return None
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    index = max(int(pct / 100.0 * len(values)) - 1, 0)
+    return values[index]
+
+
+def bench(options):
+    """Run one benchmark and return its results as a dict."""
+    packets = make_packets(options.keys, parse_mix(options.mix),
+                           options.sample_rate, options.packet_size,
+                           options.values_per_line, seed=options.seed)
+
+    carbon = _Carbon()
+    port = _free_port(socket.SOCK_DGRAM)
+    admin_port = _free_port()
+    kwargs = dict(graphite_host='127.0.0.1', graphite_port=carbon.port,
+                  flush_interval=options.flush_interval,
+                  admin_port=admin_port, workers=options.workers,
+                  sockets=options.sockets, recv_batch=options.recv_batch,
+                  rcvbuf=options.rcvbuf, timer_backend=options.timer_backend,
+                  pct_threshold=options.pct)
+    server = _mp.Process(target=_serve, args=(kwargs, port))
+    server.start()
+
+    try:
+        deadline = time.time() + 10
+        stats = _admin_stats(admin_port)
+        while stats is None:
+            if time.time() > deadline or not server.is_alive():
+                raise RuntimeError("pystatsd server did not start")
+            time.sleep(0.05)
+            stats = _admin_stats(admin_port)
+        lines_before = int(stats['ingest.lines'])
+
+        results = _mp.Queue()
+        senders = [_mp.Process(target=_send,
+                               args=(('127.0.0.1', port), packets,
+                                     options.duration, options.rate, results))
+                   for i in range(options.senders)]
+        start = time.time()
+        for sender in senders:
+            sender.start()
+
+        # Poll the server while the senders run, and for two more flush
+        # intervals so what they sent gets ingested and flushed.
+        interval = options.flush_interval / 1000.0
+        end = start + options.duration + 2 * interval
+        flushes = []
+        last_flush = stats['flush.last']
+        peak_rss = _rss(server.pid)
+        while time.time() < end:
+            time.sleep(min(interval / 4, 0.25))
+            stats = _admin_stats(admin_port) or stats
+            if stats['flush.last'] != last_flush:
+                last_flush = stats['flush.last']
+                flushes.append(float(stats['flush.duration_ms']))
+            rss = _rss(server.pid)
+            if rss is not None and (peak_rss is None or rss > peak_rss):
+                peak_rss = rss
+
+        sent = lines_sent = errors = 0
+        for sender in senders:
+            s, l, e = results.get()
+            sent += s
+            lines_sent += l
+            errors += e
+        for sender in senders:
+            sender.join()
+    finally:
+        server.terminate()
+        server.join()
+        carbon.close()
+
+    lines_received = int(stats['ingest.lines']) - lines_before
+    return {
+        'packets_sent': sent,
+        'lines_sent': lines_sent,
+        'send_errors': errors,
+        'lines_received': lines_received,
+        'lines_per_sec': lines_received / options.duration,
+        'drop_rate': max(0.0, 1 - float(lines_received) / lines_sent) if lines_sent else 0.0,
+        'flushes': len(flushes),
+        'flush_ms': dict(('p%s' % pct, _percentile(flushes, pct) if flushes else None)
+                         for pct in (50, 90, 99, 100)),
+        'peak_rss': peak_rss,
+        'carbon_lines': carbon.lines,
+        'carbon_bytes': carbon.bytes,
+    }
+
+
+def report(results):
+    lines = [
+        'lines sent      %12d  (%d packets, %d send errors)'
+        % (results['lines_sent'], results['packets_sent'], results['send_errors']),
+        'lines received  %12d' % results['lines_received'],
+        'ingest          %12.0f  lines/sec' % results['lines_per_sec'],
+        'drop rate       %11.2f%%' % (results['drop_rate'] * 100),
+    ]
+    flush_ms = results['flush_ms']
+    if results['flushes']:
+        lines.append('flush           %12d  flushes, p50 %.1f ms  p90 %.1f ms  p99 %.1f ms  max %.1f ms'
+                     % (results['flushes'], flush_ms['p50'], flush_ms['p90'],
+                        flush_ms['p99'], flush_ms['p100']))
+    if results['peak_rss'] is not None:
+        lines.append('server RSS      %12.1f  MiB peak' % (results['peak_rss'] / 1048576.0))
+    lines.append('carbon          %12d  lines, %d bytes'
+                 % (results['carbon_lines'], results['carbon_bytes']))
+    return '\n'.join(lines)
+
+
+def run_bench():
+    parser = argparse.ArgumentParser(description='Benchmark a local pystatsd server end to end.')
+    parser.add_argument('--duration', dest='duration', help='seconds to send traffic for (default: 10)', type=float, default=10.0)
+    parser.add_argument('--senders', dest='senders', help='number of sender processes (default: 1)', type=int, default=1)
+    parser.add_argument('--rate', dest='rate', help='max lines per second per sender; 0 sends as fast as possible (default: 0)', type=int, default=0)
+    parser.add_argument('--keys', dest='keys', help='number of distinct keys (default: 10000)', type=int, default=10000)
+    parser.add_argument('--mix', dest='mix', help='metric type weights over c, ms, g and s (default: c=60,ms=30,g=10)', type=str, default='c=60,ms=30,g=10')
+    parser.add_argument('--sample-rate', dest='sample_rate', help='sample rate tagged on counters (default: 1)', type=float, default=1.0)
+    parser.add_argument('--packet-size', dest='packet_size', help='max datagram size in bytes (default: 1432)', type=int, default=1432)
+    parser.add_argument('--values-per-line', dest='values_per_line', help='values per line, as in key:v1:v2|ms (default: 1)', type=int, default=1)
+    parser.add_argument('--seed', dest='seed', help='random seed for the generated traffic (default: 0)', type=int, default=0)
+    parser.add_argument('--flush-interval', dest='flush_interval', help='server flush interval in millis (default: 1000)', type=int, default=1000)
+    parser.add_argument('--workers', dest='workers', help='server worker processes (default: 0)', type=int, default=0)
+    parser.add_argument('--sockets', dest='sockets', help='server SO_REUSEPORT sockets (default: 1)', type=int, default=1)
+    parser.add_argument('--recv-batch', dest='recv_batch', help='server datagrams drained per wakeup (default: 1)', type=int, default=1)
+    parser.add_argument('--rcvbuf', dest='rcvbuf', help='server SO_RCVBUF in bytes (default: kernel default)', type=int, default=None)
+    parser.add_argument('--timer-backend', dest='timer_backend', help='server timer backend (default: list)', choices=['list', 'sketch'], default='list')
+    parser.add_argument('-t', '--pct', dest='pct', help='server percentiles (default: 90)', type=_parse_pcts, default=[90])
+    parser.add_argument('--json', dest='json', help='print the results as JSON', action='store_true', default=False)
+    options = parser.parse_args(sys.argv[1:])
+
+    results = bench(options)
+    if options.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        print(report(results))
+
+
+if __name__ == '__main__':
+    run_bench()
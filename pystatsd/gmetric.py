@@ -37,10 +37,15 @@
 #
 # Version 3.1 - 30-Apr-2011 Author: Adam Tygart
 #   Added Spoofing support
+#
+# Version 3.2
+#   Pack XDR with struct (xdrlib is gone in Python 3.13), cache metadata
+#   packets per metric and only resend them every TMAX seconds
 
 
-from xdrlib import Packer, Unpacker
 import socket
+import struct
+import time
 
 slope_str2int = {'zero':0,
                  'positive':1,
@@ -56,18 +61,71 @@ slope_int2str = {0: 'zero',
                  4: 'unspecified'}
 
 
+def _pack_int(i):
+    return struct.pack('>i', i)
+
+
+def _pack_uint(i):
+    return struct.pack('>I', i)
+
+
+def _pack_string(s):
+    """XDR string: length, bytes, zero padding to a multiple of 4."""
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    n = len(s)
+    return struct.pack('>I', n) + s + b'\0' * ((4 - n % 4) % 4)
+
+
+class _Unpacker(object):
+    """Just enough of xdrlib.Unpacker for gmetric_read."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _unpack(self, fmt):
+        value, = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += 4
+        return value
+
+    def unpack_int(self):
+        return self._unpack('>i')
+
+    def unpack_uint(self):
+        return self._unpack('>I')
+
+    def unpack_string(self):
+        n = self.unpack_uint()
+        value = self.data[self.pos:self.pos + n]
+        if len(value) < n:
+            raise EOFError
+        self.pos += n + (4 - n % 4) % 4
+        return value
+
+    def done(self):
+        if self.pos < len(self.data):
+            raise ValueError('unextracted data remains')
+
+
 class Gmetric:
     """
     Class to send gmetric/gmond 2.X packets
 
     Thread safe
+
+    Metadata packets are cached per metric name and only resent when the
+    metadata changes or TMAX seconds have passed, so steady state is one
+    small data packet per metric. The cache holds at most max_meta names
+    and is simply dropped when it fills up, so unbounded metric names
+    cannot grow it forever.
     """
 
     type = ('', 'string', 'uint16', 'int16', 'uint32', 'int32', 'float',
             'double', 'timestamp')
     protocol = ('udp', 'multicast')
 
-    def __init__(self, host, port, protocol):
+    def __init__(self, host, port, protocol, max_meta=10000):
         if protocol not in self.protocol:
             raise ValueError("Protocol must be one of: " + str(self.protocol))
 
@@ -77,70 +135,94 @@ class Gmetric:
                                    socket.IP_MULTICAST_TTL, 20)
         self.hostport = (host, int(port))
         #self.socket.connect(self.hostport)
+        # NAME -> [metadata, meta packet, data packet header, last sent]
+        self._meta = {}
+        self.max_meta = max_meta
 
     def send(self, NAME, VAL, TYPE='', UNITS='', SLOPE='both',
              TMAX=60, DMAX=0, GROUP="", SPOOF=""):
-        if SLOPE not in slope_str2int:
-            raise ValueError("Slope must be one of: " + str(list(self.slope.keys())))
-        if TYPE not in self.type:
-            raise ValueError("Type must be one of: " + str(self.type))
-        if len(NAME) == 0:
-            raise ValueError("Name must be non-empty")
+        meta = (TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF)
+        cached = self._meta.get(NAME)
+        if cached is None or cached[0] != meta:
+            if SLOPE not in slope_str2int:
+                raise ValueError("Slope must be one of: " + str(list(slope_str2int.keys())))
+            if TYPE not in self.type:
+                raise ValueError("Type must be one of: " + str(self.type))
+            if len(NAME) == 0:
+                raise ValueError("Name must be non-empty")
+            cached = [meta, gmetric_meta(NAME, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF),
+                      gmetric_data_header(NAME, SPOOF), None]
+            if len(self._meta) >= self.max_meta:
+                self._meta.clear()
+            self._meta[NAME] = cached
 
-        ( meta_msg, data_msg )  = gmetric_write(NAME, VAL, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF)
-        # print msg
+        now = time.time()
+        if cached[3] is None or now - cached[3] >= int(TMAX):
+            self.socket.sendto(cached[1], self.hostport)
+            cached[3] = now
+        self.socket.sendto(cached[2] + _pack_string(str(VAL)), self.hostport)
 
-        self.socket.sendto(bytes(bytearray(meta_msg, "utf-8")), self.hostport)
-        self.socket.sendto(bytes(bytearray(data_msg, "utf-8")), self.hostport)
+    def close(self):
+        self.socket.close()
 
-def gmetric_write(NAME, VAL, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF):
+
+def _host(SPOOF):
+    if SPOOF == "":
+        return "test", 0
+    return SPOOF, 1
+
+
+def gmetric_meta(NAME, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF):
     """
-    Arguments are in all upper-case to match XML
+    Metadata packet about a metric
     """
-    packer = Packer()
-    HOSTNAME="test"
-    if SPOOF == "":
-        SPOOFENABLED=0
-    else :
-        SPOOFENABLED=1
-    # Meta data about a metric
-    packer.pack_int(128)
-    if SPOOFENABLED == 1:
-        packer.pack_string(SPOOF)
-    else:
-        packer.pack_string(HOSTNAME)
-    packer.pack_string(NAME)
-    packer.pack_int(SPOOFENABLED)
-    packer.pack_string(TYPE)
-    packer.pack_string(NAME)
-    packer.pack_string(UNITS)
-    packer.pack_int(slope_str2int[SLOPE]) # map slope string to int
-    packer.pack_uint(int(TMAX))
-    packer.pack_uint(int(DMAX))
+    HOSTNAME, SPOOFENABLED = _host(SPOOF)
+    parts = [
+        _pack_int(128),
+        _pack_string(HOSTNAME),
+        _pack_string(NAME),
+        _pack_int(SPOOFENABLED),
+        _pack_string(TYPE),
+        _pack_string(NAME),
+        _pack_string(UNITS),
+        _pack_int(slope_str2int[SLOPE]), # map slope string to int
+        _pack_uint(int(TMAX)),
+        _pack_uint(int(DMAX)),
+    ]
     # Magic number. Indicates number of entries to follow. Put in 1 for GROUP
     if GROUP == "":
-        packer.pack_int(0)
+        parts.append(_pack_int(0))
     else:
-        packer.pack_int(1)
-        packer.pack_string("GROUP")
-        packer.pack_string(GROUP)
+        parts.append(_pack_int(1))
+        parts.append(_pack_string("GROUP"))
+        parts.append(_pack_string(GROUP))
+    return b''.join(parts)
 
-    # Actual data sent in a separate packet
-    data = Packer()
-    data.pack_int(128+5)
-    if SPOOFENABLED == 1:
-        data.pack_string(SPOOF)
-    else:
-        data.pack_string(HOSTNAME)
-    data.pack_string(NAME)
-    data.pack_int(SPOOFENABLED)
-    data.pack_string("%s")
-    data.pack_string(str(VAL))
 
-    return ( packer.get_buffer() ,  data.get_buffer() )
+def gmetric_data_header(NAME, SPOOF):
+    """
+    Everything in a data packet before the value
+    """
+    HOSTNAME, SPOOFENABLED = _host(SPOOF)
+    return b''.join([
+        _pack_int(128+5),
+        _pack_string(HOSTNAME),
+        _pack_string(NAME),
+        _pack_int(SPOOFENABLED),
+        _pack_string("%s"),
+    ])
+
+
+def gmetric_write(NAME, VAL, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF):
+    """
+    Arguments are in all upper-case to match XML
+    """
+    # Actual data sent in a separate packet
+    data = gmetric_data_header(NAME, SPOOF) + _pack_string(str(VAL))
+    return ( gmetric_meta(NAME, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF), data )
 
 def gmetric_read(msg):
-    unpacker = Unpacker(msg)
+    unpacker = _Unpacker(msg)
     values = dict()
     unpacker.unpack_int()
     values['TYPE'] = unpacker.unpack_string()
@@ -0,0 +1,93 @@
+"""Run gmetric emissions on a bounded pool of worker threads.
+
+Spawning /usr/bin/gmetric once per metric, one after the other, can take
+longer than the flush interval. GmetricPool runs up to ``workers`` of
+them at a time and gives up on whatever has not finished by the
+deadline, reporting how many emissions were dropped.
+
+Processes are polled rather than waited on with a timeout, which
+Python 2.7's subprocess does not have.
+"""
+
+import collections
+import logging
+import subprocess
+import threading
+import time
+
+__all__ = ['GmetricPool']
+
+
+log = logging.getLogger(__name__)
+
+# How often a running gmetric is checked against the deadline, in seconds.
+_POLL_INTERVAL = 0.01
+
+
+def _run_until(command, end):
+    """Run command, killing it if it is still running at time end.
+    Returns True if it finished in time.
+    """
+    process = subprocess.Popen(command)
+    while process.poll() is None:
+        remaining = end - time.time()
+        if remaining <= 0:
+            process.kill()
+            process.wait()
+            return False
+        time.sleep(min(_POLL_INTERVAL, remaining))
+    return True
+
+
+class GmetricPool(object):
+    """
+    * workers: how many gmetric processes may run at once
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+
+    def run(self, commands, deadline):
+        """Run every command (an argv list) within deadline seconds.
+        Returns the number of commands that were not run to completion.
+        """
+        end = time.time() + deadline
+        if not commands:
+            return 0
+        pending = collections.deque(commands)
+        lock = threading.Lock()
+        dropped = [0]
+
+        def drop():
+            with lock:
+                dropped[0] += 1
+
+        def work():
+            while 1:
+                try:
+                    command = pending.popleft()
+                except IndexError:
+                    return
+                remaining = end - time.time()
+                if remaining <= 0:
+                    drop()
+                    continue
+                try:
+                    if not _run_until(command, end):
+                        drop()
+                except OSError as e:
+                    log.error("Could not run %s: %s", command[0], e)
+                    drop()
+                except Exception:
+                    # Never let a failure pass as a successful emission.
+                    log.exception("Error running %s", command[0])
+                    drop()
+
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.workers, len(commands)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return dropped[0]
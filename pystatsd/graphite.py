@@ -0,0 +1,230 @@
+"""Formatting and persistent TCP sending for Graphite.
+
+Metrics can be formatted for carbon's plaintext line protocol (port
+2003) or its pickle protocol (port 2004), which is much cheaper for
+carbon to parse at high volumes.
+
+Keeps one long-lived connection per carbon host, spreads flushes over
+them round-robin, and backs off exponentially when a host is down.
+Payloads are written in chunks through a memoryview, so large flushes are
+never copied; whatever could not be delivered is kept in a bounded queue
+and sent first on the next successful attempt, starting again from the
+first line that may not have made it.
+"""
+
+import collections
+import logging
+import socket
+import struct
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__all__ = ['GraphiteSender', 'PlaintextFormatter', 'PickleFormatter',
+           'parse_addrs']
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_addrs(hosts, default_port=2003):
+    """Parse 'host[:port][,host[:port]...]' into a list of (host, port)."""
+    addrs = []
+    for host in hosts.split(','):
+        host, sep, port = host.strip().partition(':')
+        addrs.append((host, int(port) if sep else default_port))
+    return addrs
+
+
+class PlaintextFormatter(object):
+    """Encode metrics as 'path value timestamp' lines into one buffer.
+
+    * prefix: prepended to every path, e.g. 'apikey.'
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.buffer = bytearray()
+
+    def add(self, path, value, ts):
+        self.buffer += ('%s%s %s %s\n' % (self.prefix, path, value, ts)).encode('utf-8')
+
+    def payloads(self):
+        return [self.buffer]
+
+
+class PickleFormatter(object):
+    """Pack metrics into length-prefixed pickled lists of
+    (path, (timestamp, value)) tuples, as carbon's pickle receiver expects.
+
+    * prefix: prepended to every path, e.g. 'apikey.'
+    * batch_size: metrics per pickled frame
+    """
+
+    def __init__(self, prefix='', batch_size=500):
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.frames = []
+        self._batch = []
+
+    def add(self, path, value, ts):
+        self._batch.append((self.prefix + path, (ts, value)))
+        if len(self._batch) >= self.batch_size:
+            self._pack()
+
+    def _pack(self):
+        # Protocol 2 is understood by every carbon version.
+        payload = pickle.dumps(self._batch, 2)
+        self.frames.append(struct.pack('!L', len(payload)) + payload)
+        self._batch = []
+
+    def payloads(self):
+        if self._batch:
+            self._pack()
+        return self.frames
+
+
+class _Connection(object):
+    """A connection to one carbon host, with its own reconnect backoff."""
+
+    def __init__(self, addr, timeout, backoff_min, backoff_max):
+        self.addr = addr
+        self.timeout = timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.backoff = 0
+        self.retry_at = 0
+        self.sock = None
+
+    def available(self, now):
+        return self.sock is not None or now >= self.retry_at
+
+    def sendall(self, payload):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.addr, self.timeout)
+        self.sock.sendall(payload)
+        self.backoff = 0
+
+    def fail(self, now):
+        self.close()
+        self.backoff = min(self.backoff * 2 or self.backoff_min,
+                           self.backoff_max)
+        self.retry_at = now + self.backoff
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class GraphiteSender(object):
+    """Send payloads to one or more carbon hosts over persistent TCP
+    connections.
+
+    * addrs: list of (host, port) to spread flushes over
+    * timeout: connect and send timeout in seconds
+    * max_queue_bytes: how much undelivered data to keep for retrying;
+      the oldest payloads are dropped first once this is exceeded
+    * backoff_min, backoff_max: reconnect backoff bounds in seconds
+    * chunk_size: bytes handed to each sendall call
+    * line_protocol: True for the plaintext protocol, where an interrupted
+      payload can be resumed from the last complete line. Otherwise
+      (pickle frames) it is resent from its start.
+    """
+
+    def __init__(self, addrs, timeout=5.0, max_queue_bytes=16 * 1024 * 1024,
+                 backoff_min=1.0, backoff_max=60.0, chunk_size=64 * 1024,
+                 line_protocol=True):
+        self.connections = [_Connection(addr, timeout, backoff_min, backoff_max)
+                            for addr in addrs]
+        self.max_queue_bytes = max_queue_bytes
+        self.chunk_size = chunk_size
+        self.line_protocol = line_protocol
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._next = 0
+        self.dropped_bytes = 0
+
+    def _enqueue(self, payload):
+        # Entries are [payload, offset of the first unsent byte].
+        self._queue.append([payload, 0])
+        self._queued_bytes += len(payload)
+        while self._queued_bytes > self.max_queue_bytes and self._queue:
+            dropped, offset = self._queue.popleft()
+            size = len(dropped) - offset
+            self._queued_bytes -= size
+            self.dropped_bytes += size
+            log.warning("Graphite retry queue full, dropped %d bytes", size)
+
+    def _pick(self, now):
+        """Return the next connection in round-robin order that is not
+        backing off, or None.
+        """
+        count = len(self.connections)
+        for i in range(count):
+            connection = self.connections[(self._next + i) % count]
+            if connection.available(now):
+                self._next = (self._next + i + 1) % count
+                return connection
+        return None
+
+    def send(self, payloads):
+        """Queue payloads (bytes or bytearrays, which must not be modified
+        afterwards; a single one or a list) and send everything queued,
+        oldest first. Returns True if the queue was emptied.
+        """
+        if not isinstance(payloads, (list, tuple)):
+            payloads = [payloads]
+        for payload in payloads:
+            if payload:
+                self._enqueue(payload)
+        queue = self._queue
+        chunk_size = self.chunk_size
+        while queue:
+            now = time.time()
+            connection = self._pick(now)
+            if connection is None:
+                log.debug("All Graphite hosts backing off, %d bytes queued",
+                          self._queued_bytes)
+                return False
+            entry = queue[0]
+            payload, offset = entry
+            view = memoryview(payload)
+            size = len(payload)
+            try:
+                while offset < size:
+                    connection.sendall(view[offset:offset + chunk_size])
+                    sent = min(chunk_size, size - offset)
+                    offset += sent
+                    entry[1] = offset
+                    self._queued_bytes -= sent
+            except (socket.error, socket.timeout) as e:
+                # Part of the failed chunk may have gone out. Carbon drops
+                # an unterminated line (or frame) when the connection goes
+                # away, so resume from the start of the line it was in.
+                if self.line_protocol:
+                    resume = payload.rfind(b'\n', 0, offset) + 1
+                else:
+                    resume = 0
+                self._queued_bytes += offset - resume
+                entry[1] = resume
+                connection.fail(now)
+                log.error("Error communicating with Graphite %s:%s: %s"
+                          % (connection.addr + (e,)))
+                continue
+            queue.popleft()
+        return True
+
+    @property
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
@@ -0,0 +1,85 @@
+"""Single-pass parser for the statsd line protocol.
+
+A line looks like ``name:value|type[|@rate]``; ``value`` may also be several
+colon-separated values (``name:1:2:3|ms``), which count as that many
+samples of the same metric. Parsing is done with
+``str.partition`` rather than a regular expression, and cleaned metric
+names are cached so that hot keys only go through the regex-based
+cleaning once.
+"""
+
+import re
+
+__all__ = ['Parser', 'clean_key', 'parse_sample_rate']
+
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_INVALID_CHARS_RE = re.compile(r'[^a-zA-Z_\-0-9\.]')
+_SAMPLE_RATE_RE = re.compile(r'^@([\d\.]+)')
+
+
+def clean_key(k):
+    """Turn a raw metric name into something safe to send to Graphite."""
+    return _INVALID_CHARS_RE.sub(
+        '',
+        _WHITESPACE_RE.sub(
+            '_',
+            k.replace('/', '-').replace(' ', '_')
+        )
+    )
+
+
+def parse_sample_rate(field):
+    """Parse a ``@rate`` field. Raises ValueError if it is malformed."""
+    match = _SAMPLE_RATE_RE.match(field)
+    if match is None:
+        raise ValueError("Invalid sample rate: <%s>" % field)
+    return float(match.group(1))
+
+
+def split_line(line):
+    """Split a line into ``(raw_key, value, mtype, rest)``.
+
+    Returns None if the line is malformed. This accepts exactly the lines
+    the old ``\\A([^:]+):([^|]+)\\|(.+)`` pattern did.
+    """
+    raw_key, sep, tail = line.partition(':')
+    if not sep or not raw_key:
+        return None
+    value, sep, rest = tail.partition('|')
+    if not sep or not value or not rest:
+        return None
+    rest = rest.split('|')
+    mtype = rest.pop(0)
+    return raw_key, value, mtype, rest
+
+
+class Parser(object):
+    """Parses statsd lines, caching cleaned keys.
+
+    * max_keys: size of the cleaned-key cache. The cache is simply dropped
+      when it fills up, so a burst of unique keys cannot grow it forever.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._keys = {}
+
+    def clean(self, raw_key):
+        keys = self._keys
+        try:
+            return keys[raw_key]
+        except KeyError:
+            pass
+        if len(keys) >= self.max_keys:
+            keys.clear()
+        key = keys[raw_key] = clean_key(raw_key)
+        return key
+
+    def parse(self, line):
+        """Parse one line into ``(key, value, mtype, rest)`` or None."""
+        parts = split_line(line)
+        if parts is None:
+            return None
+        raw_key, value, mtype, rest = parts
+        return self.clean(raw_key), value, mtype, rest
@@ -0,0 +1,198 @@
+"""On-demand profiling of a running Server.
+
+While a Profiler is running it times every call of the ingest stages and
+each phase of flush, and a background thread samples the stacks of
+every thread in the process. Nothing is wrapped, and nothing costs
+anything, while profiling is off.
+
+Stages:
+
+    recvfrom           receiving datagrams; with the plain blocking loop
+                       this includes time spent waiting for them
+    process            process(), everything below included
+    parse              Parser.parse
+    clean_key          Parser.clean, cache hits included
+    record_counter     Server.__record_counter, and the other types
+    flush              the whole flush
+    flush.<phase>      collect, swap, counters, gauges, timers, sets,
+                       format (finishing the payloads) and send
+    format             encoding each metric for Graphite, which counts
+                       towards the counters, gauges and timers phases
+
+Stacks are written in the collapsed format read by flamegraph.pl and
+speedscope, one ``thread;frame;frame count`` line per distinct stack.
+
+With workers, only this process is profiled: the flush and whatever the
+extra listeners receive.
+"""
+
+import os
+import sys
+import threading
+import time
+
+__all__ = ['Profiler']
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Ingest methods of Server that are timed, as (attribute, stage).
+RECORD_STAGES = (
+    ('_Server__record_counter', 'record_counter'),
+    ('_Server__record_gauge', 'record_gauge'),
+    ('_Server__record_timer', 'record_timer'),
+    ('_Server__record_set', 'record_set'),
+)
+
+
+class _TimedSocket(object):
+    """Stands in for a datagram socket, timing recvfrom."""
+    __slots__ = ('recvfrom',)
+
+    def __init__(self, recvfrom):
+        self.recvfrom = recvfrom
+
+
+class Profiler(object):
+    """Times the stages of server and samples stacks every interval
+    seconds between start() and stop().
+    """
+
+    def __init__(self, server, interval=0.005):
+        self.server = server
+        self.interval = interval
+        self.stages = {}
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._patched = []
+        self._sock = None
+        self._running = threading.Event()
+        self._thread = None
+
+    def _timed(self, name, func):
+        stage = self.stages.setdefault(name, [0, 0.0])
+        clock = _clock
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage[0] += 1
+                stage[1] += clock() - start
+        return timed
+
+    def _patch(self, obj, attr, wrapper):
+        setattr(obj, attr, wrapper)
+        self._patched.append((obj, attr))
+
+    def start(self):
+        server = self.server
+        self.started = time.time()
+
+        # Bound methods are shadowed by instance attributes, so every
+        # call through self.<method> goes through the wrappers.
+        self._patch(server, 'process', self._timed('process', server.process))
+        self._patch(server.parser, 'parse', self._timed('parse', server.parser.parse))
+        self._patch(server.parser, 'clean', self._timed('clean_key', server.parser.clean))
+        for attr, name in RECORD_STAGES:
+            self._patch(server, attr, self._timed(name, getattr(server, attr)))
+
+        drain = server._drain
+        timed_recvfrom = lambda sock: _TimedSocket(self._timed('recvfrom', sock.recvfrom))
+        self._patch(server, '_drain', lambda sock: drain(timed_recvfrom(sock)))
+        if getattr(server, '_sock', None) is not None:
+            self._sock = server._sock
+            server._sock = timed_recvfrom(self._sock)
+
+        flush = self._timed('flush', server.flush)
+
+        def timed_flush():
+            flush()
+            for phase, ms in server.flush_phases:
+                stage = self.stages.setdefault('flush.' + phase, [0, 0.0])
+                stage[0] += 1
+                stage[1] += ms / 1000.0
+        self._patch(server, 'flush', timed_flush)
+
+        formatter = server._formatter
+
+        def timed_formatter(*args):
+            out = formatter(*args)
+            out.add = self._timed('format', out.add)
+            return out
+        self._patch(server, '_formatter', timed_formatter)
+
+        self._running.set()
+        self._thread = threading.Thread(target=self._sample, name='pystatsd-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for obj, attr in reversed(self._patched):
+            delattr(obj, attr)
+        self._patched = []
+        if self._sock is not None:
+            self.server._sock, self._sock = self._sock, None
+        self.stopped = time.time()
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        stacks = self.stacks
+        while self._running.is_set():
+            names = dict([(t.ident, t.name) for t in threading.enumerate()])
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('%s (%s)' % (code.co_name, os.path.basename(code.co_filename)))
+                    frame = frame.f_back
+                frames.append(names.get(ident, 'thread-%s' % ident))
+                frames.reverse()
+                stack = ';'.join(frames)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def summary(self):
+        """Stage timings as (stage, calls, total ms, mean us per call),
+        most expensive first.
+        """
+        rows = []
+        for name, (calls, total) in self.stages.items():
+            if calls:
+                rows.append((name, calls, total * 1000, total * 1e6 / calls))
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def collapsed(self):
+        """The sampled stacks, one 'frame;frame;frame count' line each."""
+        return ['%s %d' % item for item in sorted(self.stacks.items())]
+
+    def dump(self, directory):
+        """Write the summary and the collapsed stacks to directory.
+        Returns (summary path, stacks path).
+        """
+        base = os.path.join(directory, 'pystatsd-%d-%d' % (os.getpid(), int(self.started)))
+        end = self.stopped or time.time()
+        with open(base + '.txt', 'w') as f:
+            f.write('%.1f seconds, %d stack samples\n' % (end - self.started, self.samples))
+            f.write('%-22s %12s %14s %12s\n' % ('stage', 'calls', 'total ms', 'us/call'))
+            for row in self.summary():
+                f.write('%-22s %12d %14.3f %12.3f\n' % row)
+        with open(base + '.collapsed', 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+        return base + '.txt', base + '.collapsed'
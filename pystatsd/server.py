@@ -1,11 +1,17 @@
-import re
+import bisect
+import errno
+import math
+import operator
+import multiprocessing
+import os
+import select
 import socket
+from stat import S_ISSOCK
 import threading
 import time
 import types
 import logging
-from subprocess import call
-from warnings import warn
+from array import array
 # from xdrlib import Packer, Unpacker
 
 try:
@@ -13,37 +19,247 @@ try:
 except ImportError:
     setproctitle = None
 
+# Timer statistics are vectorized when NumPy is installed.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Messily get the import for things we're distributing. This is in a
 # try block, since we seem to need different syntax based on some set
 # of Python versions and whether or not we're in a library.
 try:
     from . import gmetric
     from .daemon import Daemon
+    from .parser import Parser, parse_sample_rate
+    from .sketch import QuantileSketch
+    from .graphite import GraphiteSender, PickleFormatter, PlaintextFormatter, parse_addrs
+    from .gmetric_pool import GmetricPool
+    from .hll import HyperLogLog, UniqueSet
+    from .admin import AdminServer
+    from .profiler import Profiler
 except ValueError:
     import gmetric
     from daemon import Daemon
+    from parser import Parser, parse_sample_rate
+    from sketch import QuantileSketch
+    from graphite import GraphiteSender, PickleFormatter, PlaintextFormatter, parse_addrs
+    from gmetric_pool import GmetricPool
+    from hll import HyperLogLog, UniqueSet
+    from admin import AdminServer
+    from profiler import Profiler
 
 
 __all__ = ['Server']
 
+# Workers inherit their already-bound sockets, so they must be forked.
+if hasattr(multiprocessing, 'get_context'):
+    _mp = multiprocessing.get_context('fork')
+else:
+    _mp = multiprocessing
+
+
+# Transports that send to carbon, in its plaintext or pickle format.
+GRAPHITE_TRANSPORTS = ('graphite', 'graphite-pickle')
+
+# Below this many samples NumPy's per-call overhead outweighs what it saves.
+_NUMPY_MIN_SAMPLES = 256
+
+# Ingest counters kept per flush interval, and the internal metric each
+# is reported as. process() calls count as packets, whether they carry a
+# datagram or a chunk of a TCP stream.
+INGEST_METRICS = (
+    ('packets', 'statsd.packetsReceived'),
+    ('lines', 'statsd.linesReceived'),
+    ('bytes', 'statsd.bytesReceived'),
+    ('malformed', 'statsd.badLines.malformed'),
+    ('unknown_type', 'statsd.badLines.unknownType'),
+    ('bad_value', 'statsd.badLines.badValue'),
+)
+
+
+def _parse_pcts(value):
+    """Parse a comma separated list of percentiles, e.g. '50,90,99.9'."""
+    pcts = []
+    for pct in str(value).split(','):
+        pct = float(pct)
+        if not 0 < pct <= 100:
+            raise ValueError("percentile out of range: %s" % pct)
+        pcts.append(int(pct) if pct.is_integer() else pct)
+    return pcts
+
+
+def _pct_label(pct):
+    # 99.9 is reported as upper_99_9, since dots separate graphite nodes
+    return str(pct).replace('.', '_')
+
+
+def _parse_histogram(value):
+    """Parse histogram bins for a timer key prefix, e.g. 'api.=10,50,inf',
+    into (prefix, edges). An empty prefix matches every timer.
+    """
+    prefix, sep, edges = str(value).rpartition('=')
+    edges = [float(edge) for edge in edges.split(',')]
+    if edges != sorted(set(edges)):
+        raise ValueError("histogram bins must be increasing: %s" % value)
+    return prefix, edges
+
+
+def _bin_label(edge):
+    # bin_10, bin_0_5 and bin_inf, as etsy statsd names them
+    if math.isinf(edge):
+        return 'inf'
+    return _pct_label(int(edge) if edge.is_integer() else edge)
+
+
+def _timer_values(stat):
+    """The (name, value) pairs reported to Graphite for one timer."""
+    values = [
+        ('lower', stat['min']),
+        ('count', stat['count']),
+        ('mean', stat['mean']),
+        ('upper', stat['max']),
+        ('sum', stat['sum']),
+        ('sum_squares', stat['sum_squares']),
+        ('median', stat['median']),
+        ('std', stat['std']),
+    ]
+    for pct, max_threshold in stat['thresholds']:
+        values.append(('upper_' + _pct_label(pct), max_threshold))
+    for label, count in stat['bins']:
+        values.append(('histogram.bin_' + label, count))
+    return values
+
+
+def _timer_stats(v, pct_thresholds, bins=None):
+    """Compute everything flush reports for one timer, given its samples
+    as an array('d'), a list or a QuantileSketch. Samples are sorted once
+    and every percentile is read off the sorted samples. Large arrays are
+    sorted in place and summed by NumPy when it is installed.
+
+    bins is an optional (edges, labels) pair. Each bin counts the samples
+    above the previous edge and up to its own; samples above the last
+    edge are not counted. The counts are found by bisecting the sorted
+    samples once per edge; with a sketch, samples within its accuracy of
+    an edge may be counted in the neighbouring bin.
+    """
+    if isinstance(v, QuantileSketch):
+        count = v.count
+        lower, upper = v.min, v.max
+        total = v.sum
+        sum_squares = v.sum_squares
+        value_at_rank = v.value_at_rank
+        rank_above = lambda edge: _bisect_ranks(value_at_rank, count, edge)
+    elif numpy is not None and len(v) >= _NUMPY_MIN_SAMPLES:
+        if isinstance(v, array) and v.typecode == 'd':
+            samples = numpy.frombuffer(v, dtype=numpy.float64)
+        else:
+            samples = numpy.array(v, dtype=numpy.float64)
+        samples.sort()
+        count = len(samples)
+        lower, upper = float(samples[0]), float(samples[-1])
+        total = float(samples.sum())
+        sum_squares = float(numpy.dot(samples, samples))
+        value_at_rank = lambda rank: float(samples[rank])
+        rank_above = lambda edge: int(numpy.searchsorted(samples, edge, 'right'))
+    else:
+        v = sorted(v)
+        count = len(v)
+        lower, upper = v[0], v[-1]
+        total = sum(v)
+        sum_squares = sum(map(operator.mul, v, v))
+        value_at_rank = v.__getitem__
+        rank_above = lambda edge: bisect.bisect_right(v, edge)
+
+    mean = total / count
+    # Population standard deviation; clamp rounding noise below zero.
+    std = math.sqrt(max(sum_squares / count - mean * mean, 0.0))
+
+    mid = count // 2
+    if count % 2:
+        median = value_at_rank(mid)
+    else:
+        median = (value_at_rank(mid - 1) + value_at_rank(mid)) / 2
+
+    thresholds = []
+    for pct in pct_thresholds:
+        max_threshold = upper
+        if count > 1:
+            # At least rank 0: a low pct of few samples is the minimum.
+            thresh_index = max(int((pct / 100.0) * count), 1)
+            max_threshold = value_at_rank(thresh_index - 1)
+        thresholds.append((pct, max_threshold))
+
+    histogram = []
+    if bins is not None:
+        below = 0
+        for edge, label in zip(*bins):
+            rank = rank_above(edge)
+            histogram.append((label, rank - below))
+            below = rank
+
+    return {
+        'count': count,
+        'min': lower,
+        'max': upper,
+        'mean': mean,
+        'sum': total,
+        'sum_squares': sum_squares,
+        'median': median,
+        'std': std,
+        'thresholds': thresholds,
+        'bins': histogram,
+    }
+
+
+def _bisect_ranks(value_at_rank, count, edge):
+    """Number of samples up to edge, given their values by rank."""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if value_at_rank(mid) <= edge:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _Record(object):
+    """A metric's value and the (whole second) time it was last updated.
+    For timers the value is the list or sketch of samples.
+
+    Slotted, so a key costs one 48 byte object rather than a 72 byte
+    [value, ts] list, and the timestamp int is shared by everything
+    recorded in the same batch.
+    """
+    __slots__ = ('value', 'ts')
+
+    def __init__(self, value, ts):
+        self.value = value
+        self.ts = ts
+
+    def __getstate__(self):
+        return (self.value, self.ts)
+
+    def __setstate__(self, state):
+        self.value, self.ts = state
+
+    def __eq__(self, other):
+        return (isinstance(other, _Record) and
+                self.value == other.value and self.ts == other.ts)
+
+    def __ne__(self, other):
+        return not self == other
 
-def _clean_key(k):
-    return re.sub(
-        r'[^a-zA-Z_\-0-9\.]',
-        '',
-        re.sub(
-            r'\s+',
-            '_',
-            k.replace('/', '-').replace(' ', '_')
-        )
-    )
+    def __repr__(self):
+        return '%s(%r, %r)' % (type(self).__name__, self.value, self.ts)
 
-TIMER_MSG = '''%(prefix)s.%(key)s.lower %(min)s %(ts)s
-%(prefix)s.%(key)s.count %(count)s %(ts)s
-%(prefix)s.%(key)s.mean %(mean)s %(ts)s
-%(prefix)s.%(key)s.upper %(max)s %(ts)s
-%(prefix)s.%(key)s.upper_%(pct_threshold)s %(max_threshold)s %(ts)s
-'''
+
+class _GaugeDelta(_Record):
+    """A change to a gauge whose value a worker does not know; the
+    parent adds it to its own value when merging.
+    """
+    __slots__ = ()
 
 
 class Server(object):
@@ -52,13 +268,55 @@ class Server(object):
                  ganglia_host='localhost', ganglia_port=8649,
                  ganglia_spoof_host='statsd:statsd', ganglia_max_length=100,
                  gmetric_exec='/usr/bin/gmetric', gmetric_options = '-d',
-                 graphite_host='localhost', graphite_port=2003, global_prefix=None, 
+                 graphite_host='localhost', graphite_port=None, global_prefix=None, 
                  flush_interval=10000,
                  no_aggregate_counters=False, counters_prefix='stats',
-                 timers_prefix='stats.timers', expire=0):
+                 timers_prefix='stats.timers', expire=0,
+                 rcvbuf=None, sockets=1, recv_batch=1, workers=0,
+                 timer_backend='list', sketch_accuracy=0.01,
+                 graphite_timeout=5.0, graphite_queue_bytes=16 * 1024 * 1024,
+                 pickle_batch_size=500, gmetric_workers=8, gmetric_deadline=None,
+                 unix_socket=None, tcp_port=None, max_keys=0,
+                 max_keys_per_prefix=0, prefix_depth=1,
+                 overflow_key='statsd.overflow', admin_port=None,
+                 admin_host='127.0.0.1', profile_dir=None,
+                 sets_prefix='stats.sets', set_threshold=64, histograms=None):
         self.buf = 8192
+        # Optional extra listeners feeding process(): a UNIX datagram
+        # socket at this path and a TCP port taking newline-terminated
+        # lines.
+        self.unix_socket = unix_socket
+        self.tcp_port = tcp_port
+        self._streams = {}
+        self._listeners = []
+        # (path, inode) of the UNIX socket this server bound, the only
+        # file stop() removes.
+        self._unix_bound = None
+        # Receive settings. With recv_batch > 1 (or more than one socket)
+        # the serve loop waits for readability and then drains up to
+        # recv_batch datagrams per socket without blocking.
+        self.rcvbuf = rcvbuf
+        self.sockets = sockets
+        self.recv_batch = recv_batch
+        # With workers > 0, each worker process owns one SO_REUSEPORT
+        # socket and aggregates locally; this process only merges their
+        # partial state at flush time.
+        self.workers = workers
+        self._workers = []
         self.flush_interval = flush_interval
+        # A single percentile or a list of them, e.g. [50, 90, 99.9]
         self.pct_threshold = pct_threshold
+        if isinstance(pct_threshold, (list, tuple)):
+            self.pct_thresholds = list(pct_threshold)
+        else:
+            self.pct_thresholds = _parse_pcts(pct_threshold)
+        # 'list' keeps every timer sample, packed 8 bytes each in an
+        # array('d'); 'sketch' keeps a bounded QuantileSketch per timer
+        # with sketch_accuracy relative error.
+        if timer_backend not in ('list', 'sketch'):
+            raise ValueError("timer_backend must be 'list' or 'sketch'")
+        self.timer_backend = timer_backend
+        self.sketch_accuracy = sketch_accuracy
         self.transport = transport
         # Embedded Ganglia library options specific settings
         self.ganglia_host = ganglia_host
@@ -67,6 +325,15 @@ class Server(object):
         # Use gmetric
         self.gmetric_exec = gmetric_exec
         self.gmetric_options = gmetric_options
+        # gmetric runs on a pool of gmetric_workers processes at a time;
+        # whatever has not finished gmetric_deadline seconds into the
+        # flush (default: 80% of the flush interval) is dropped.
+        self.gmetric_pool = GmetricPool(gmetric_workers)
+        if gmetric_deadline is None:
+            gmetric_deadline = self.flush_interval / 1000.0 * 0.8
+        self.gmetric_deadline = gmetric_deadline
+        self.gmetric_dropped = 0
+        self._gmetric_commands = []
         # Common Ganglia
         self.ganglia_max_length = ganglia_max_length
         # Set DMAX to flush interval plus 20%. That should avoid metrics to prematurely expire if there is
@@ -76,74 +343,296 @@ class Server(object):
         self.ganglia_spoof_host = ganglia_spoof_host
 
         # Graphite specific settings
+        # graphite_host may list several relays: 'host[:port],host[:port]'
         self.graphite_host = graphite_host
+        if graphite_port is None:
+            graphite_port = 2004 if transport == 'graphite-pickle' else 2003
         self.graphite_port = graphite_port
+        self.pickle_batch_size = pickle_batch_size
+        self.graphite_timeout = graphite_timeout
+        self.graphite_queue_bytes = graphite_queue_bytes
+        self._graphite = None
+        self._gmetric = None
         self.no_aggregate_counters = no_aggregate_counters
         self.counters_prefix = counters_prefix
         self.timers_prefix = timers_prefix
+        self.sets_prefix = sets_prefix
+        # Sets count members exactly up to set_threshold, then estimate
+        # with a 4 KiB HyperLogLog.
+        self.set_threshold = set_threshold
+        # Histogram bins for timers, as (key prefix, edges) pairs; the
+        # first prefix a timer's key starts with picks its bins.
+        self.histograms = []
+        for prefix, edges in histograms or []:
+            edges = sorted([float(edge) for edge in edges])
+            self.histograms.append((prefix, (edges, [_bin_label(edge) for edge in edges])))
         self.debug = debug
         self.expire = expire
 
         # For services like Hosted Graphite, etc.
         self.global_prefix = global_prefix
 
+        # Aggregation buffers. Ingest writes to these while holding _lock;
+        # flush swaps in fresh dicts under the same lock and then works on
+        # the old ones without blocking ingest.
         self.counters = {}
         self.timers = {}
         self.gauges = {}
+        self.sets = {}
+        # Gauges are re-sent every flush until they expire, so the flush
+        # thread keeps the last known values here.
+        self._flushed_gauges = {}
+        self._lock = threading.Lock()
+        # Set in worker processes, which leave gauge deltas they cannot
+        # resolve to the parent.
+        self._worker = False
+
+        # Cardinality limits. Once a type holds max_keys keys, or the
+        # first prefix_depth components of a new key's name already
+        # have max_keys_per_prefix keys, the metric is recorded under
+        # overflow_key instead. 0 means no limit. Both limits are per
+        # flush interval, except for gauges: they persist, so every
+        # known gauge counts, against a per-prefix tally of its own that
+        # only goes down when gauges expire.
+        self._prefix_gauges = {}
+        self.max_keys = max_keys
+        self.max_keys_per_prefix = max_keys_per_prefix
+        self.prefix_depth = prefix_depth
+        self.overflow_key = overflow_key
+        self._limited = bool(max_keys or max_keys_per_prefix)
+        self._reset_limits()
+
+        # Self-instrumentation. Ingest counts are kept per flush interval
+        # and added to the totals at flush; the flush and send figures
+        # are those of the last flush.
+        self._reset_ingest()
+        self.totals = dict.fromkeys([name for name, metric in INGEST_METRICS], 0)
+        self.started = time.time()
+        self.last_flush = None
+        self.flush_duration = 0.0
+        self.send_latency = 0.0
+        self.bytes_sent = 0
+        # (phase, ms) for each phase of the last flush.
+        self.flush_phases = []
+        # Admin TCP port (see admin.py); off unless admin_port is set.
+        self.admin_port = admin_port
+        self.admin_host = admin_host
+        self._admin = None
+        # Profiling (see profiler.py) is started and stopped from the
+        # admin port, or by SIGUSR1 when profile_dir is set; dumps are
+        # written to profile_dir.
+        self.profile_dir = profile_dir
+        self._profiler = None
         self.flusher = 0
+        self.parser = Parser()
 
     def send_to_ganglia_using_gmetric(self,k,v,group, units):
         if len(k) >= self.ganglia_max_length:
             log.debug("Ganglia metric too long. Ignoring: %s" % k)
         else:
-            call([self.gmetric_exec, self.gmetric_options, "-u", units, "-g", group, "-t", "double", "-n",  k, "-v", str(v) ])
+            # Queued here, run by the pool at the end of the flush
+            self._gmetric_commands.append([self.gmetric_exec, self.gmetric_options, "-u", units, "-g", group, "-t", "double", "-n",  k, "-v", str(v) ])
 
 
-    def process(self, data):
+    def process(self, data, ts=None):
+        """Aggregate a datagram (or a chunk of lines from a stream).
+        ts is the receive time in whole seconds; callers handling a batch
+        of datagrams pass it in so the clock is read once per batch.
+        """
         # the data is a sequence of newline-delimited metrics
         # a metric is in the form "name:value|rest"  (rest may have more pipes)
-        data.rstrip('\n')
-
-        for metric in data.split('\n'):
-            match = re.match('\A([^:]+):([^|]+)\|(.+)', metric)
-
-            if match == None:
-                warn("Skipping malformed metric: <%s>" % (metric))
-                continue
-
-            key   = _clean_key( match.group(1) )
-            value = match.group(2)
-            rest  = match.group(3).split('|')
-            mtype = rest.pop(0)
-
-            if   (mtype == 'ms'): self.__record_timer(key, value, rest)
-            elif (mtype == 'g' ): self.__record_gauge(key, value, rest)
-            elif (mtype == 'c' ): self.__record_counter(key, value, rest)
-            else:
-                warn("Encountered unknown metric type in <%s>" % (metric))
-
-    def __record_timer(self, key, value, rest):
-        ts = int(time.time())
-        timer = self.timers.setdefault(key, [ [], ts ])
-        timer[0].append(float(value or 0))
-        timer[1] = ts
-
-    def __record_gauge(self, key, value, rest):
-        ts = int(time.time())
-        self.gauges[key] = [ float(value), ts ]
+        # value may be packed as "v1:v2:v3", one sample per value
+        size = len(data)
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        lines = data.rstrip('\n').split('\n')
+        parse = self.parser.parse
+        if ts is None:
+            ts = int(time.time())
+
+        with self._lock:
+            ingest = self._ingest
+            ingest['packets'] += 1
+            ingest['bytes'] += size
+            ingest['lines'] += len(lines)
+            for metric in lines:
+                parsed = parse(metric)
+
+                if parsed is None:
+                    ingest['malformed'] += 1
+                    log.debug("Skipping malformed metric: <%s>", metric)
+                    continue
+
+                key, value, mtype, rest = parsed
+
+                try:
+                    if   (mtype == 'ms'): self.__record_timer(key, value, rest, ts)
+                    elif (mtype == 'g' ): self.__record_gauge(key, value, rest, ts)
+                    elif (mtype == 'c' ): self.__record_counter(key, value, rest, ts)
+                    elif (mtype == 's' ): self.__record_set(key, value, rest, ts)
+                    else:
+                        ingest['unknown_type'] += 1
+                        log.debug("Encountered unknown metric type in <%s>", metric)
+                except ValueError as e:
+                    ingest['bad_value'] += 1
+                    log.debug("Skipping metric <%s>: %s", metric, e)
+
+    def _new_samples(self):
+        if self.timer_backend == 'sketch':
+            return QuantileSketch(self.sketch_accuracy)
+        return array('d')
+
+    def _reset_limits(self):
+        """Start a new limiting window and return the rejections of the
+        last one, as [rejected metrics, HyperLogLog of rejected keys].
+        """
+        rejected = getattr(self, '_rejected', None)
+        self._rejected = [0, HyperLogLog()]
+        self._prefix_keys = {}
+        self._new_gauges = 0
+        if self._worker:
+            # Workers never flush, so their gauges do not persist; the
+            # parent admits them again when merging.
+            self._prefix_gauges = {}
+        return rejected
+
+    def _reset_ingest(self):
+        """Start a new ingest window and return the counts of the last
+        one, keyed by the names in INGEST_METRICS.
+        """
+        ingest = getattr(self, '_ingest', None)
+        self._ingest = dict.fromkeys([name for name, metric in INGEST_METRICS], 0)
+        return ingest
+
+    def _prefix(self, key):
+        return '.'.join(key.split('.', self.prefix_depth)[:self.prefix_depth])
+
+    def _admit(self, key, size, prefix_keys=None):
+        """Decide whether a key that is not yet in its store (holding
+        size keys) may be added. Returns key, or overflow_key if a limit
+        was hit. prefix_keys holds the per-prefix counts to check and
+        update, by default those of the current window.
+        """
+        if key == self.overflow_key:
+            return key
+        if not self.max_keys or size < self.max_keys:
+            if not self.max_keys_per_prefix:
+                return key
+            if prefix_keys is None:
+                prefix_keys = self._prefix_keys
+            prefix = self._prefix(key)
+            count = prefix_keys.get(prefix, 0)
+            if count < self.max_keys_per_prefix:
+                prefix_keys[prefix] = count + 1
+                return key
+        self._rejected[0] += 1
+        self._rejected[1].add(key)
+        return self.overflow_key
+
+    def _admit_gauge(self, key):
+        if key in self._flushed_gauges:
+            return key
+        admitted = self._admit(key, len(self._flushed_gauges) + self._new_gauges,
+                               self._prefix_gauges)
+        if admitted is key:
+            self._new_gauges += 1
+        return admitted
+
+    def _forget_gauge(self, key):
+        """Give an expired gauge's place back to its prefix."""
+        if not self.max_keys_per_prefix or key == self.overflow_key:
+            return
+        prefix = self._prefix(key)
+        with self._lock:
+            count = self._prefix_gauges.get(prefix, 0)
+            if count > 1:
+                self._prefix_gauges[prefix] = count - 1
+            elif count:
+                del self._prefix_gauges[prefix]
+
+    def __record_timer(self, key, value, rest, ts):
+        timer = self.timers.get(key)
+        if timer is None and self._limited:
+            key = self._admit(key, len(self.timers))
+            timer = self.timers.get(key)
+        if timer is None:
+            timer = self.timers[key] = _Record(self._new_samples(), ts)
+        if ':' in value:
+            timer.value.extend([float(v or 0) for v in value.split(':')])
+        else:
+            timer.value.append(float(value or 0))
+        timer.ts = ts
+
+    def __record_gauge(self, key, value, rest, ts):
+        # A value with a sign (+5, -3) changes the gauge by that much
+        # instead of setting it, so a negative value has to be sent as
+        # 0:-3. Several values apply in order.
+        if value[0] in '+-' or ':' in value:
+            relative, amount = True, 0.0
+            for v in value.split(':'):
+                if v[:1] in ('+', '-'):
+                    amount += float(v)
+                else:
+                    relative, amount = False, float(v)
+        else:
+            relative, amount = False, float(value)
+
+        gauge = self.gauges.get(key)
+        if gauge is None and self._limited:
+            key = self._admit_gauge(key)
+            gauge = self.gauges.get(key)
+        if relative:
+            if gauge is not None:
+                gauge.value += amount
+                gauge.ts = ts
+                return
+            flushed = self._flushed_gauges.get(key)
+            if flushed is not None:
+                amount += flushed.value
+            elif self._worker:
+                self.gauges[key] = _GaugeDelta(amount, ts)
+                return
+        if gauge is None or type(gauge) is _GaugeDelta:
+            self.gauges[key] = _Record(amount, ts)
+        else:
+            gauge.value = amount
+            gauge.ts = ts
 
-    def __record_counter(self, key, value, rest):
-        ts = int(time.time())
+    def __record_counter(self, key, value, rest, ts):
         sample_rate = 1.0
         if len(rest) == 1:
-            sample_rate = float(re.match('^@([\d\.]+)', rest[0]).group(1))
+            sample_rate = parse_sample_rate(rest[0])
             if sample_rate == 0:
-                warn("Ignoring counter with sample rate of zero: <%s>" % (key))
-                return
+                raise ValueError("sample rate of zero")
 
-        counter = self.counters.setdefault(key, [ 0, ts ])
-        counter[0] += float(value or 1) * (1 / sample_rate)
-        counter[1] = ts
+        if ':' in value:
+            total = sum([float(v or 1) for v in value.split(':')])
+        else:
+            total = float(value or 1)
+
+        counter = self.counters.get(key)
+        if counter is None and self._limited:
+            key = self._admit(key, len(self.counters))
+            counter = self.counters.get(key)
+        if counter is None:
+            self.counters[key] = _Record(total * (1 / sample_rate), ts)
+        else:
+            counter.value += total * (1 / sample_rate)
+            counter.ts = ts
+
+    def __record_set(self, key, value, rest, ts):
+        members = self.sets.get(key)
+        if members is None and self._limited:
+            key = self._admit(key, len(self.sets))
+            members = self.sets.get(key)
+        if members is None:
+            members = self.sets[key] = _Record(UniqueSet(self.set_threshold), ts)
+        if ':' in value:
+            for member in value.split(':'):
+                members.value.add(member)
+        else:
+            members.value.add(value)
+        members.ts = ts
 
     def on_timer(self):
         """Executes flush(). Ignores any errors to make sure one exception
@@ -155,20 +644,175 @@ class Server(object):
             log.exception('Error while flushing: %s', e)
         self._set_timer()
 
+    def merge(self, counters, gauges, timers, rejected=None, ingest=None, sets=None):
+        """Merge partially aggregated state (as kept in self.counters,
+        self.gauges, self.timers and self.sets, plus what _reset_limits
+        and _reset_ingest return) into this server. Cardinality limits
+        apply to the merged keys too.
+        """
+        with self._lock:
+            self._merge(counters, gauges, timers, rejected, ingest, sets)
+
+    def _merge(self, counters, gauges, timers, rejected=None, ingest=None, sets=None):
+        limited = self._limited
+        for k, record in counters.items():
+            counter = self.counters.get(k)
+            if counter is None and limited:
+                k = self._admit(k, len(self.counters))
+                counter = self.counters.get(k)
+            if counter is None:
+                self.counters[k] = record
+            else:
+                counter.value += record.value
+                counter.ts = max(counter.ts, record.ts)
+
+        for k, record in gauges.items():
+            gauge = self.gauges.get(k)
+            if gauge is None and limited:
+                k = self._admit_gauge(k)
+                gauge = self.gauges.get(k)
+            if type(record) is _GaugeDelta:
+                if gauge is None:
+                    gauge = self._flushed_gauges.get(k)
+                if gauge is not None:
+                    record = _Record(gauge.value + record.value, max(gauge.ts, record.ts))
+                else:
+                    record = _Record(record.value, record.ts)
+                self.gauges[k] = record
+            elif gauge is None or record.ts >= gauge.ts:
+                self.gauges[k] = record
+
+        for k, record in timers.items():
+            timer = self.timers.get(k)
+            if timer is None and limited:
+                k = self._admit(k, len(self.timers))
+                timer = self.timers.get(k)
+            if timer is None:
+                timer = self.timers[k] = _Record(self._new_samples(), record.ts)
+            timer.value.extend(record.value)
+            timer.ts = max(timer.ts, record.ts)
+
+        for k, record in (sets or {}).items():
+            members = self.sets.get(k)
+            if members is None and limited:
+                k = self._admit(k, len(self.sets))
+                members = self.sets.get(k)
+            if members is None:
+                self.sets[k] = record
+            else:
+                members.value.update(record.value)
+                members.ts = max(members.ts, record.ts)
+
+        if rejected is not None:
+            self._rejected[0] += rejected[0]
+            self._rejected[1].update(rejected[1])
+
+        if ingest is not None:
+            for name, count in ingest.items():
+                self._ingest[name] += count
+
+    def _collect(self):
+        """Ask every worker for its state since the last collect and merge
+        it in. Workers that have died are dropped; the flush goes on
+        with the rest.
+        """
+        asked = []
+        for worker in self._workers:
+            try:
+                worker[1].send('collect')
+            except (EOFError, OSError, IOError) as e:
+                self._drop_worker(worker, e)
+                continue
+            asked.append(worker)
+        for worker in asked:
+            process, conn = worker
+            try:
+                # A wedged worker must not hold up the flush forever.
+                if not conn.poll(self.flush_interval / 1000):
+                    log.error("Worker %s did not answer collect in time", process.pid)
+                    continue
+                state = conn.recv()
+            except (EOFError, OSError, IOError) as e:
+                self._drop_worker(worker, e)
+                continue
+            self.merge(*state)
+
+    def _drop_worker(self, worker, error):
+        process, conn = worker
+        log.error("Worker %s has gone away (%r), dropping it", process.pid, error)
+        self._workers.remove(worker)
+        conn.close()
+        process.terminate()
+        process.join(1)
+        if not self._workers:
+            log.error("No workers left, nothing more is received on the main port")
+
+    def _swap(self):
+        """Swap in empty aggregation buffers and return the old ones,
+        with the rejections and ingest counts of the window they cover.
+        """
+        with self._lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            timers, self.timers = self.timers, {}
+            sets, self.sets = self.sets, {}
+            rejected = self._reset_limits()
+            ingest = self._reset_ingest()
+            # Under the lock, so a gauge delta never misses the value
+            # it applies to.
+            self._flushed_gauges.update(gauges)
+        return counters, self._flushed_gauges, timers, sets, rejected, ingest
+
     def flush(self):
-        ts = int(time.time())
+        # (phase, time) as each phase of the flush ends.
+        marks = [('', time.time())]
+        if self._workers:
+            self._collect()
+        marks.append(('collect', time.time()))
+
+        start = time.time()
+        counters, gauges, timers, sets, rejected, ingest = self._swap()
+        ts = int(start)
         stats = 0
 
-        if self.transport == 'graphite':
-            stat_string = ''
+        # Internal metrics about this statsd itself. Flush and send
+        # figures are those of the previous flush.
+        internal = []
+        for name, metric in INGEST_METRICS:
+            self.totals[name] += ingest[name]
+            internal.append((metric, ingest[name]))
+        internal.extend([
+            ('statsd.keys.counters', len(counters)),
+            ('statsd.keys.gauges', len(gauges)),
+            ('statsd.keys.timers', len(timers)),
+            ('statsd.keys.sets', len(sets)),
+            ('statsd.flushDuration', self.flush_duration),
+            ('statsd.sendLatency', self.send_latency),
+            ('statsd.bytesSent', self.bytes_sent),
+        ])
+        if self._limited:
+            rejected_keys = rejected[1].count()
+            internal.append(('statsd.cardinality.rejected', rejected[0]))
+            internal.append(('statsd.cardinality.rejectedKeys', rejected_keys))
+            if rejected[0]:
+                log.warning("Cardinality limit hit: %d updates to about %d keys recorded as %s"
+                            % (rejected[0], rejected_keys, self.overflow_key))
+
+        graphite = self.transport in GRAPHITE_TRANSPORTS
+        if graphite:
+            # Metrics are encoded as they are formatted, with the global
+            # prefix (for services like Hosted Graphite) applied then.
+            line_prefix = '%s.' % self.global_prefix if self.global_prefix else ''
+            out = self._formatter(line_prefix)
         elif self.transport == 'ganglia':
-            g = gmetric.Gmetric(self.ganglia_host, self.ganglia_port, self.ganglia_protocol)
+            g = self.ganglia_sender()
+        marks.append(('swap', time.time()))
 
-        for k, (v, t) in self.counters.items():
+        for k, record in counters.items():
+            v, t = record.value, record.ts
             if self.expire > 0 and t + self.expire < ts:
                 if self.debug:
                     print("Expiring counter %s (age: %s)" % (k, ts -t))
-                del(self.counters[k])
                 continue
             v = float(v)
             v = v if self.no_aggregate_counters else v / (self.flush_interval / 1000)
@@ -176,9 +820,8 @@ class Server(object):
             if self.debug:
                 print("Sending %s => count=%s" % (k, v))
 
-            if self.transport == 'graphite':
-                msg = '%s.%s %s %s\n' % (self.counters_prefix, k, v, ts)
-                stat_string += msg
+            if graphite:
+                out.add('%s.%s' % (self.counters_prefix, k), v, ts)
             elif self.transport == 'ganglia':
                 # We put counters in _counters group. Underscore is to make sure counters show up
                 # first in the GUI. Change below if you disagree
@@ -189,25 +832,25 @@ class Server(object):
             elif self.transport == 'ganglia-gmetric':
                 self.send_to_ganglia_using_gmetric(k,v, "_counters", "count")
 
-            # Clear the counter once the data is sent
-            del(self.counters[k])
             stats += 1
+        marks.append(('counters', time.time()))
 
-        for k, (v, t) in self.gauges.items():
+        for k, record in list(gauges.items()):
+            v, t = record.value, record.ts
             if self.expire > 0 and t + self.expire < ts:
                 if self.debug:
                     print("Expiring gauge %s (age: %s)" % (k, ts - t))
-                del(self.gauges[k])
+                del(gauges[k])
+                self._forget_gauge(k)
                 continue
             v = float(v)
 
             if self.debug:
                 print("Sending %s => value=%s" % (k, v))
 
-            if self.transport == 'graphite':
+            if graphite:
                 # note: counters and gauges implicitly end up in the same namespace
-                msg = '%s.%s %s %s\n' % (self.counters_prefix, k, v, ts)
-                stat_string += msg
+                out.add('%s.%s' % (self.counters_prefix, k), v, ts)
             elif self.transport == 'ganglia':
                 if len(k) >= self.ganglia_max_length:
                     log.debug("Ganglia metric too long. Ignoring: %s" % k)
@@ -217,48 +860,27 @@ class Server(object):
                 self.send_to_ganglia_using_gmetric(k,v, "_gauges", "gauge")
 
             stats += 1
+        marks.append(('gauges', time.time()))
 
-        for k, (v, t) in self.timers.items():
+        for k, record in timers.items():
+            v, t = record.value, record.ts
             if self.expire > 0 and t + self.expire < ts:
                 if self.debug:
                     print("Expiring timer %s (age: %s)" % (k, ts - t))
-                del(self.timers[k])
                 continue
             if len(v) > 0:
-                # Sort all the received values. We need it to extract percentiles
-                v.sort()
-                count = len(v)
-                min = v[0]
-                max = v[-1]
+                stat = _timer_stats(v, self.pct_thresholds, self._histogram_bins(k))
+                count, min, max, mean = stat['count'], stat['min'], stat['max'], stat['mean']
 
-                mean = min
-                max_threshold = max
-
-                if count > 1:
-                    thresh_index = int((self.pct_threshold / 100.0) * count)
-                    max_threshold = v[thresh_index - 1]
-                    total = sum(v)
-                    mean = total / count
+                if self.debug:
+                    print("Sending %s ====> lower=%s, mean=%s, upper=%s, %s, count=%s" \
+                        % (k, min, mean, max, ', '.join(['%spct=%s' % t for t in stat['thresholds']]), count))
 
-                del(self.timers[k])
+                if graphite:
 
-                if self.debug:
-                    print("Sending %s ====> lower=%s, mean=%s, upper=%s, %dpct=%s, count=%s" \
-                        % (k, min, mean, max, self.pct_threshold, max_threshold, count))
-
-                if self.transport == 'graphite':
-
-                    stat_string += TIMER_MSG % {
-                        'prefix': self.timers_prefix,
-                        'key': k,
-                        'mean': mean,
-                        'max': max,
-                        'min': min,
-                        'count': count,
-                        'max_threshold': max_threshold,
-                        'pct_threshold': self.pct_threshold,
-                        'ts': ts,
-                    }
+                    timer_prefix = '%s.%s.' % (self.timers_prefix, k)
+                    for name, value in _timer_values(stat):
+                        out.add(timer_prefix + name, value, ts)
 
                 elif self.transport == 'ganglia':
                     # We are gonna convert all times into seconds, then let rrdtool add proper SI unit. This avoids things like
@@ -272,7 +894,13 @@ class Server(object):
                         g.send(k + "_mean", mean / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
                         g.send(k + "_max", max / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
                         g.send(k + "_count", count, "double", "count", "both", 60, self.dmax, group, self.ganglia_spoof_host)
-                        g.send(k + "_" + str(self.pct_threshold) + "pct", max_threshold / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
+                        g.send(k + "_sum", stat['sum'] / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
+                        g.send(k + "_median", stat['median'] / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
+                        g.send(k + "_std", stat['std'] / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
+                        for pct, max_threshold in stat['thresholds']:
+                            g.send(k + "_" + _pct_label(pct) + "pct", max_threshold / 1000, "double", "seconds", "both", 60, self.dmax, group, self.ganglia_spoof_host)
+                        for label, bin_count in stat['bins']:
+                            g.send(k + "_bin_" + label, bin_count, "double", "count", "both", 60, self.dmax, group, self.ganglia_spoof_host)
                 elif self.transport == 'ganglia-gmetric':
                     # We are gonna convert all times into seconds, then let rrdtool add proper SI unit. This avoids things like
                     # 3521 k ms which is 3.521 seconds
@@ -281,70 +909,416 @@ class Server(object):
                     self.send_to_ganglia_using_gmetric(k + "_min",  min / 1000 , group, "seconds")
                     self.send_to_ganglia_using_gmetric(k + "_max",  max / 1000, group, "seconds")
                     self.send_to_ganglia_using_gmetric(k + "_count", count , group, "count")
-                    self.send_to_ganglia_using_gmetric(k + "_" + str(self.pct_threshold) + "pct",  max_threshold / 1000, group, "seconds")
+                    self.send_to_ganglia_using_gmetric(k + "_sum", stat['sum'] / 1000, group, "seconds")
+                    self.send_to_ganglia_using_gmetric(k + "_median", stat['median'] / 1000, group, "seconds")
+                    self.send_to_ganglia_using_gmetric(k + "_std", stat['std'] / 1000, group, "seconds")
+                    for pct, max_threshold in stat['thresholds']:
+                        self.send_to_ganglia_using_gmetric(k + "_" + _pct_label(pct) + "pct",  max_threshold / 1000, group, "seconds")
+                    for label, bin_count in stat['bins']:
+                        self.send_to_ganglia_using_gmetric(k + "_bin_" + label, bin_count, group, "count")
 
                 stats += 1
+        marks.append(('timers', time.time()))
 
-        if self.transport == 'graphite':
+        for k, record in sets.items():
+            t = record.ts
+            if self.expire > 0 and t + self.expire < ts:
+                if self.debug:
+                    print("Expiring set %s (age: %s)" % (k, ts - t))
+                continue
+            v = record.value.count()
 
-            stat_string += "statsd.numStats %s %d\n" % (stats, ts)
+            if self.debug:
+                print("Sending %s => unique=%s" % (k, v))
 
-            # Prepend stats with Hosted Graphite API key if necessary
-            if self.global_prefix:
-                stat_string = '\n'.join([
-                    '%s.%s' % (self.global_prefix, s) for s in stat_string.split('\n')[:-1]
-                ])
+            if graphite:
+                out.add('%s.%s.count' % (self.sets_prefix, k), v, ts)
+            elif self.transport == 'ganglia':
+                if len(k) >= self.ganglia_max_length:
+                    log.debug("Ganglia metric too long. Ignoring: %s" % k)
+                else:
+                    g.send(k, v, "double", "count", "both", 60, self.dmax, "_sets", self.ganglia_spoof_host)
+            elif self.transport == 'ganglia-gmetric':
+                self.send_to_ganglia_using_gmetric(k, v, "_sets", "count")
 
-            graphite = socket.socket()
-            try:
-                graphite.connect((self.graphite_host, self.graphite_port))
-                graphite.sendall(bytes(bytearray(stat_string, "utf-8")))
-                graphite.close()
-            except socket.error as e:
-                log.error("Error communicating with Graphite: %s" % e)
-                if self.debug:
-                    print("Error communicating with Graphite: %s" % e)
+            stats += 1
+        marks.append(('sets', time.time()))
+
+        if graphite:
+
+            out.add('statsd.numStats', stats, ts)
+            for name, value in internal:
+                out.add(name, value, ts)
+            payloads = out.payloads()
+            marks.append(('format', time.time()))
+            self._send_graphite(payloads)
+
+        elif self.transport == 'ganglia':
+            for name, value in internal:
+                g.send(name, value, "double", "count", "both", 60, self.dmax, "_statsd", self.ganglia_spoof_host)
+
+        elif self.transport == 'ganglia-gmetric':
+            for name, value in internal:
+                self.send_to_ganglia_using_gmetric(name, value, "_statsd", "count")
+            commands, self._gmetric_commands = self._gmetric_commands, []
+            marks.append(('format', time.time()))
+            self._run_gmetric(commands)
+
+        marks.append(('send', time.time()))
+        self.flush_phases = [(name, (t - marks[i][1]) * 1000)
+                             for i, (name, t) in enumerate(marks[1:])]
+        self.last_flush = ts
+        # From the very start, so waiting for the workers counts too.
+        self.flush_duration = (time.time() - marks[0][1]) * 1000
 
         if self.debug:
             print("\n================== Flush completed. Waiting until next flush. Sent out %d metrics =======" \
                 % (stats))
 
+    def _histogram_bins(self, key):
+        for prefix, bins in self.histograms:
+            if key.startswith(prefix):
+                return bins
+        return None
+
+    def _formatter(self, line_prefix):
+        if self.transport == 'graphite-pickle':
+            return PickleFormatter(line_prefix, self.pickle_batch_size)
+        return PlaintextFormatter(line_prefix)
+
+    def _send_graphite(self, payloads):
+        sender = self.graphite_sender()
+        # Only what left the queue by being written counts as sent, not
+        # what is still queued or was dropped from a full queue.
+        pending = sender.queued_bytes + sum([len(payload) for payload in payloads])
+        dropped = sender.dropped_bytes
+        start = time.time()
+        sent = sender.send(payloads)
+        self.send_latency = (time.time() - start) * 1000
+        self.bytes_sent = pending - sender.queued_bytes - (sender.dropped_bytes - dropped)
+        if not sent:
+            if self.debug:
+                print("Graphite unavailable, %d bytes queued for retry" % self._graphite.queued_bytes)
+
+    def _run_gmetric(self, commands):
+        start = time.time()
+        dropped = self.gmetric_pool.run(commands, self.gmetric_deadline)
+        self.send_latency = (time.time() - start) * 1000
+        if dropped:
+            self.gmetric_dropped += dropped
+            log.warning("gmetric deadline hit, dropped %d of %d emissions" % (dropped, len(commands)))
+
+    def graphite_sender(self):
+        if self._graphite is None:
+            self._graphite = GraphiteSender(
+                parse_addrs(self.graphite_host, self.graphite_port),
+                timeout=self.graphite_timeout,
+                max_queue_bytes=self.graphite_queue_bytes,
+                line_protocol=self.transport != 'graphite-pickle')
+        return self._graphite
+
+    def ganglia_sender(self):
+        # One Gmetric for the lifetime of the server, so its socket and
+        # cached metadata packets are reused across flushes.
+        if self._gmetric is None:
+            self._gmetric = gmetric.Gmetric(self.ganglia_host, self.ganglia_port, self.ganglia_protocol)
+        return self._gmetric
+
+    def start_profiling(self):
+        """Start profiling (see profiler.py) unless it already is.
+        Returns the running Profiler.
+        """
+        if self._profiler is None:
+            self._profiler = Profiler(self)
+            self._profiler.start()
+        return self._profiler
+
+    def stop_profiling(self):
+        """Stop profiling and return the Profiler, or None if it was not
+        running. Its summary and stacks are dumped to profile_dir if set.
+        """
+        profiler, self._profiler = self._profiler, None
+        if profiler is not None:
+            profiler.stop()
+            if self.profile_dir:
+                paths = profiler.dump(self.profile_dir)
+                log.warning("Profile written to %s and %s" % paths)
+        return profiler
+
+    def _toggle_profiling(self, signum=None, frame=None):
+        if self._profiler is None:
+            self.start_profiling()
+            log.warning("Profiling started")
+        else:
+            self.stop_profiling()
+
     def _set_timer(self):
         self._timer = threading.Timer(self.flush_interval / 1000, self.on_timer)
         self._timer.daemon = True
         self._timer.start()
 
+    def _bind(self, addr, reuseport=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuseport:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ValueError('SO_REUSEPORT is not supported on this platform')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        sock.bind(addr)
+        return sock
+
+    def _bind_unix(self, path):
+        # A socket file left behind by an earlier run would make bind
+        # fail, but anything else at path is not ours to delete.
+        if os.path.lexists(path):
+            if not S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError('%s exists and is not a socket' % path)
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        sock.bind(path)
+        self._unix_bound = (path, os.lstat(path).st_ino)
+        return sock
+
+    def _unlink_unix(self):
+        """Remove the UNIX socket this server bound, unless something
+        else has replaced it since.
+        """
+        if self._unix_bound is None:
+            return
+        path, inode = self._unix_bound
+        self._unix_bound = None
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return
+        if S_ISSOCK(st.st_mode) and st.st_ino == inode:
+            os.unlink(path)
+
+    def _listen_tcp(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(addr)
+        sock.listen(128)
+        return sock
+
+    def _bind_listeners(self, hostname):
+        """Bind the optional UNIX datagram and TCP listeners. Returns
+        (datagram sockets, TCP listening sockets).
+        """
+        dgram, listeners = [], []
+        if self.unix_socket:
+            dgram.append(self._bind_unix(self.unix_socket))
+        if self.tcp_port is not None:
+            listeners.append(self._listen_tcp((hostname, self.tcp_port)))
+        return dgram, listeners
+
+    def _accept(self, listener):
+        try:
+            conn, addr = listener.accept()
+        except socket.error as e:
+            log.error("Error accepting TCP connection: %s", e)
+            return
+        conn.setblocking(0)
+        self._streams[conn] = b''
+
+    def _read_stream(self, conn):
+        """Process the complete lines received on a TCP connection,
+        keeping a trailing partial line for the next read.
+        """
+        try:
+            data = conn.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        pending = self._streams[conn]
+        if not data:
+            del self._streams[conn]
+            conn.close()
+            lines = pending
+        else:
+            lines, sep, pending = (pending + data).rpartition(b'\n')
+            if len(pending) > self.buf:
+                log.error("Dropping line longer than %d bytes from TCP client", self.buf)
+                pending = b''
+            self._streams[conn] = pending
+        if lines:
+            try:
+                self.process(lines)
+            except Exception as error:
+                log.error("Bad data from TCP client: %s", error)
+
+    def _select_loop(self, dgram, listeners):
+        """Serve datagram sockets, TCP listeners and their connections
+        from one non-blocking select() loop.
+        """
+        for sock in dgram + listeners:
+            sock.setblocking(0)
+        while 1:
+            readable, _, _ = select.select(
+                dgram + listeners + list(self._streams), [], [])
+            for sock in readable:
+                if sock in self._streams:
+                    self._read_stream(sock)
+                elif sock in listeners:
+                    self._accept(sock)
+                else:
+                    self._drain(sock)
+
+    def _drain(self, sock):
+        """Receive and process up to recv_batch datagrams from a
+        non-blocking socket, stopping early once it would block.
+        """
+        recvfrom = sock.recvfrom
+        buf = self.buf
+        # One clock read for the whole batch.
+        ts = int(time.time())
+        for i in range(self.recv_batch):
+            try:
+                data, addr = recvfrom(buf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            try:
+                self.process(data, ts)
+            except Exception as error:
+                log.error("Bad data from %s: %s",addr,error)
+
+    def _work(self, sock, conn, parent_conn, parent):
+        """Worker process main loop: aggregate datagrams from sock and hand
+        the state over whenever the parent asks for it. Returns once the
+        parent has gone away.
+        """
+        import signal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        # Only the parent may hold the other ends of the pipes, or EOF
+        # never arrives when it dies.
+        parent_conn.close()
+        for process, other in self._workers:
+            other.close()
+        self.counters, self.gauges, self.timers, self.sets = {}, {}, {}, {}
+        self._workers = []
+        self._worker = True
+        sock.setblocking(0)
+        while 1:
+            readable, _, _ = select.select([sock, conn], [], [], 1)
+            if os.getppid() != parent:
+                return
+            if sock in readable:
+                self._drain(sock)
+            if conn in readable:
+                try:
+                    conn.recv()
+                except EOFError:
+                    return
+                conn.send((self.counters, self.gauges, self.timers,
+                           self._reset_limits(), self._reset_ingest(), self.sets))
+                self.counters, self.gauges, self.timers, self.sets = {}, {}, {}, {}
+
+    def _start_workers(self, addr):
+        for i in range(self.workers):
+            # Bound one at a time and closed once forked, so each worker
+            # holds its own socket and no other.
+            sock = self._bind(addr, reuseport=True)
+            conn, child_conn = _mp.Pipe()
+            process = _mp.Process(target=self._work,
+                                  args=(sock, child_conn, conn, os.getpid()))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            sock.close()
+            self._workers.append((process, conn))
+
     def serve(self, hostname='', port=8125):
         assert type(port) is int, 'port is not an integer: %s' % (port)
         addr = (hostname, port)
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock.bind(addr)
 
         import signal
 
         def signal_handler(signal, frame):
                 self.stop()
         signal.signal(signal.SIGINT, signal_handler)
+        if self.profile_dir and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._toggle_profiling)
+
+        if self.admin_port is not None:
+            self._admin = AdminServer(self, (self.admin_host, self.admin_port))
+            self._admin.start()
+
+        if self.workers > 0:
+            # daemon stop sends SIGTERM; stop() takes the workers down
+            # with this process rather than leaving them bound to the
+            # port.
+            signal.signal(signal.SIGTERM, signal_handler)
+            self._socks = []
+            self._start_workers(addr)
+            # The extra listeners are bound after forking and served by
+            # this process; what they receive is flushed with the rest.
+            dgram, self._listeners = self._bind_listeners(hostname)
+            self._socks = dgram + self._listeners
+            self._set_timer()
+            if self._socks:
+                self._select_loop(dgram, self._listeners)
+            for process, conn in self._workers:
+                process.join()
+            return
+
+        reuseport = self.sockets > 1
+        self._socks = [self._bind(addr, reuseport) for i in range(self.sockets)]
+        self._sock = self._socks[0]
+        dgram, self._listeners = self._bind_listeners(hostname)
+        dgram = self._socks + dgram
+        self._socks = dgram + self._listeners
 
         self._set_timer()
-        while 1:
-            data, addr = self._sock.recvfrom(self.buf)
-            try:
-                self.process(data)
-            except Exception as error:
-                log.error("Bad data from %s: %s",addr,error) 
+        if len(self._socks) == 1 and self.recv_batch <= 1:
+            while 1:
+                data, addr = self._sock.recvfrom(self.buf)
+                try:
+                    self.process(data)
+                except Exception as error:
+                    log.error("Bad data from %s: %s",addr,error) 
+        else:
+            self._select_loop(dgram, self._listeners)
 
 
     def stop(self):
         self._timer.cancel()
-        self._sock.close()
+        self.stop_profiling()
+        for sock in self._socks:
+            sock.close()
+        for conn in list(self._streams):
+            conn.close()
+        self._streams = {}
+        self._unlink_unix()
+        for process, conn in self._workers:
+            process.terminate()
+        if self._admin is not None:
+            self._admin.stop()
+        if self._graphite is not None:
+            self._graphite.close()
+        if self._gmetric is not None:
+            self._gmetric.close()
 
 
 class ServerDaemon(Daemon):
     def run(self, options):
         if setproctitle:
             setproctitle('pystatsd')
-        server = Server(pct_threshold=options.pct,
+        server_class = Server
+        if options.use_asyncio:
+            # Python 3 only, so it is not imported unless asked for.
+            try:
+                from .aioserver import AsyncServer as server_class
+            except ValueError:
+                from aioserver import AsyncServer as server_class
+        server = server_class(pct_threshold=options.pct,
                         debug=options.debug,
                         transport=options.transport,
                         graphite_host=options.graphite_host,
@@ -359,7 +1333,29 @@ class ServerDaemon(Daemon):
                         no_aggregate_counters=options.no_aggregate_counters,
                         counters_prefix=options.counters_prefix,
                         timers_prefix=options.timers_prefix,
-                        expire=options.expire)
+                        expire=options.expire,
+                        rcvbuf=options.rcvbuf,
+                        sockets=options.sockets,
+                        recv_batch=options.recv_batch,
+                        workers=options.workers,
+                        timer_backend=options.timer_backend,
+                        sketch_accuracy=options.sketch_accuracy,
+                        graphite_timeout=options.graphite_timeout,
+                        graphite_queue_bytes=options.graphite_queue_bytes,
+                        pickle_batch_size=options.pickle_batch_size,
+                        gmetric_workers=options.gmetric_workers,
+                        gmetric_deadline=options.gmetric_deadline,
+                        unix_socket=options.unix_socket,
+                        tcp_port=options.tcp_port,
+                        max_keys=options.max_keys,
+                        max_keys_per_prefix=options.max_keys_per_prefix,
+                        prefix_depth=options.prefix_depth,
+                        admin_port=options.admin_port,
+                        admin_host=options.admin_host,
+                        profile_dir=options.profile_dir,
+                        sets_prefix=options.sets_prefix,
+                        set_threshold=options.set_threshold,
+                        histograms=options.histograms)
 
         server.serve(options.name, options.port)
 
@@ -371,9 +1367,12 @@ def run_server():
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', help='debug mode', default=False)
     parser.add_argument('-n', '--name', dest='name', help='hostname to run on ', default='')
     parser.add_argument('-p', '--port', dest='port', help='port to run on (default: 8125)', type=int, default=8125)
-    parser.add_argument('-r', '--transport', dest='transport', help='transport to use graphite, ganglia (uses embedded library) or ganglia-gmetric (uses gmetric)', type=str, default="graphite")
-    parser.add_argument('--graphite-port', dest='graphite_port', help='port to connect to graphite on (default: 2003)', type=int, default=2003)
-    parser.add_argument('--graphite-host', dest='graphite_host', help='host to connect to graphite on (default: localhost)', type=str, default='localhost')
+    parser.add_argument('-r', '--transport', dest='transport', help='transport to use graphite, graphite-pickle (carbon pickle protocol), ganglia (uses embedded library) or ganglia-gmetric (uses gmetric)', type=str, default="graphite")
+    parser.add_argument('--graphite-port', dest='graphite_port', help='port to connect to graphite on (default: 2003, or 2004 for graphite-pickle)', type=int, default=None)
+    parser.add_argument('--pickle-batch-size', dest='pickle_batch_size', help='metrics per pickled batch with graphite-pickle (default: 500)', type=int, default=500)
+    parser.add_argument('--graphite-host', dest='graphite_host', help='host to connect to graphite on, or a comma separated list of host[:port] relays to spread flushes over (default: localhost)', type=str, default='localhost')
+    parser.add_argument('--graphite-timeout', dest='graphite_timeout', help='connect/send timeout for graphite in seconds (default: 5)', type=float, default=5.0)
+    parser.add_argument('--graphite-queue-bytes', dest='graphite_queue_bytes', help='max bytes of unsent flushes kept for retrying when graphite is down (default: 16777216)', type=int, default=16 * 1024 * 1024)
     # Uses embedded Ganglia Library
     parser.add_argument('--ganglia-port', dest='ganglia_port', help='Unicast port to connect to ganglia on', type=int, default=8649)
     parser.add_argument('--ganglia-host', dest='ganglia_host', help='Unicast host to connect to ganglia on', type=str, default='localhost')
@@ -381,6 +1380,8 @@ def run_server():
     # Use gmetric
     parser.add_argument('--ganglia-gmetric-exec', dest='gmetric_exec', help='Use gmetric executable. Defaults to /usr/bin/gmetric', type=str, default="/usr/bin/gmetric")
     parser.add_argument('--ganglia-gmetric-options', dest='gmetric_options', help='Options to pass to gmetric. Defaults to -d 60', type=str, default="-d 60")
+    parser.add_argument('--ganglia-gmetric-workers', dest='gmetric_workers', help='Number of gmetric processes to run at once. Defaults to 8', type=int, default=8)
+    parser.add_argument('--ganglia-gmetric-deadline', dest='gmetric_deadline', help='Seconds into a flush after which pending gmetric runs are dropped. Defaults to 80%% of the flush interval', type=float, default=None)
     # Common for ganglia
     parser.add_argument('--ganglia-max-length', dest='ganglia_max_length', help='Maximum length of metric names for ganglia. Defaults to 100 characters', type=str, default=100)
     # 
@@ -389,7 +1390,25 @@ def run_server():
     parser.add_argument('--global-prefix', dest='global_prefix', help='prefix to append to all stats sent to graphite. Useful for hosted services (ex: Hosted Graphite) or stats namespacing (default: None)', type=str, default=None)
     parser.add_argument('--counters-prefix', dest='counters_prefix', help='prefix to append before sending counter data to graphite (default: stats)', type=str, default='stats')
     parser.add_argument('--timers-prefix', dest='timers_prefix', help='prefix to append before sending timing data to graphite (default: stats.timers)', type=str, default='stats.timers')
-    parser.add_argument('-t', '--pct', dest='pct', help='stats pct threshold (default: 90)', type=int, default=90)
+    parser.add_argument('--sets-prefix', dest='sets_prefix', help='prefix to append before sending set counts to graphite (default: stats.sets)', type=str, default='stats.sets')
+    parser.add_argument('--set-threshold', dest='set_threshold', help='distinct members per set counted exactly before switching to a HyperLogLog estimate (default: 64)', type=int, default=64)
+    parser.add_argument('--histogram', dest='histograms', help='count timer samples into bins for keys starting with PREFIX, emitted as histogram.bin_<edge>, e.g. api.=10,50,100,inf; repeatable, first match wins (default: None)', metavar='PREFIX=EDGES', type=_parse_histogram, action='append', default=None)
+    parser.add_argument('-t', '--pct', dest='pct', help='stats pct threshold, or a comma separated list of them, e.g. 50,90,99.9 (default: 90)', type=_parse_pcts, default=[90])
+    parser.add_argument('--unix-socket', dest='unix_socket', help='also receive datagrams on a UNIX socket at this path (default: None)', type=str, default=None)
+    parser.add_argument('--tcp-port', dest='tcp_port', help='also accept newline-terminated lines over TCP on this port (default: None)', type=int, default=None)
+    parser.add_argument('--max-keys', dest='max_keys', help='max distinct keys per metric type per flush; more are aggregated under statsd.overflow. 0 for no limit (default: 0)', type=int, default=0)
+    parser.add_argument('--max-keys-per-prefix', dest='max_keys_per_prefix', help='max distinct keys per name prefix per flush, see --prefix-depth. 0 for no limit (default: 0)', type=int, default=0)
+    parser.add_argument('--prefix-depth', dest='prefix_depth', help='number of dot-separated name components that make up a prefix for --max-keys-per-prefix (default: 1)', type=int, default=1)
+    parser.add_argument('--admin-port', dest='admin_port', help='serve the admin commands (stats, counters, gauges, timers) on this TCP port (default: None)', type=int, default=None)
+    parser.add_argument('--admin-host', dest='admin_host', help='address to bind the admin port to (default: 127.0.0.1)', type=str, default='127.0.0.1')
+    parser.add_argument('--profile-dir', dest='profile_dir', help='let SIGUSR1 start and stop profiling, and write the stage timings and collapsed stacks to this directory (default: None)', type=str, default=None)
+    parser.add_argument('--rcvbuf', dest='rcvbuf', help='SO_RCVBUF size in bytes for the listening socket(s) (default: kernel default)', type=int, default=None)
+    parser.add_argument('--sockets', dest='sockets', help='number of SO_REUSEPORT sockets to listen on (default: 1)', type=int, default=1)
+    parser.add_argument('--recv-batch', dest='recv_batch', help='max datagrams drained per socket each time it becomes readable; 1 keeps the plain blocking loop (default: 1)', type=int, default=1)
+    parser.add_argument('--workers', dest='workers', help='number of worker processes sharing the port via SO_REUSEPORT; 0 aggregates in a single process (default: 0)', type=int, default=0)
+    parser.add_argument('--timer-backend', dest='timer_backend', help='how to store timer samples: list keeps every sample (8 bytes each), sketch keeps a bounded-memory quantile sketch (default: list)', choices=['list', 'sketch'], default='list')
+    parser.add_argument('--sketch-accuracy', dest='sketch_accuracy', help='relative error of percentiles with --timer-backend sketch (default: 0.01)', type=float, default=0.01)
+    parser.add_argument('--asyncio', dest='use_asyncio', help='run on an asyncio event loop, so slow backends never block receiving; incompatible with --workers', action='store_true', default=False)
     parser.add_argument('-D', '--daemon', dest='daemonize', action='store_true', help='daemonize', default=False)
     parser.add_argument('--pidfile', dest='pidfile', action='store', help='pid file', default='/var/run/pystatsd.pid')
     parser.add_argument('--restart', dest='restart', action='store_true', help='restart a running daemon', default=False)
@@ -0,0 +1,167 @@
+"""Bounded-memory quantile sketch for timer samples.
+
+This is a DDSketch-style sketch: every sample falls into a logarithmic
+bucket ``ceil(log(x) / log(gamma))`` with ``gamma = (1 + a) / (1 - a)``,
+and only a count per bucket is kept.
+
+Error bounds: any quantile returned is within a relative error of ``a``
+(``relative_accuracy``, 1% by default) of the true sample at that rank.
+count, sum, sum of squares, min and max are exact. Memory is bounded by ``max_buckets``
+per sign; with the defaults 2048 buckets cover values from 1e-9 up to
+beyond 1e8 before any collapsing happens. If the limit is hit, the
+lowest buckets are merged together, so only the lowest quantiles lose
+accuracy.
+"""
+
+import math
+from bisect import bisect_right
+
+__all__ = ['QuantileSketch']
+
+
+_ceil = math.ceil
+_log = math.log
+
+# Values closer to zero than this are counted as zero.
+_MIN_VALUE = 1e-9
+
+
+class QuantileSketch(object):
+    """Approximate distribution of a stream of floats.
+
+    Supports ``append``/``extend``/``len`` so it can stand in for the
+    plain list of samples a timer normally keeps.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self._positive = {}
+        self._negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = None
+        self.max = None
+        # (cumulative counts, values) of the buckets in sorted order,
+        # built by value_at_rank and dropped whenever a sample is added.
+        self._ranks = None
+
+    def __len__(self):
+        return self.count
+
+    def _value(self, index):
+        # Midpoint of the bucket (gamma^(i-1), gamma^i] in relative terms.
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _collapse(self, store):
+        keys = sorted(store)
+        extra = len(keys) - self.max_buckets
+        if extra <= 0:
+            return
+        total = 0
+        for key in keys[:extra + 1]:
+            total += store.pop(key)
+        store[keys[extra]] = total
+
+    def append(self, value):
+        self._ranks = None
+        if value > _MIN_VALUE:
+            store = self._positive
+            index = int(_ceil(_log(value) / self._log_gamma))
+        elif value < -_MIN_VALUE:
+            store = self._negative
+            index = int(_ceil(_log(-value) / self._log_gamma))
+        else:
+            store = None
+            self.zero_count += 1
+
+        if store is not None:
+            count = store.get(index)
+            if count is not None:
+                store[index] = count + 1
+            else:
+                store[index] = 1
+                if len(store) > self.max_buckets:
+                    self._collapse(store)
+
+        self.count += 1
+        self.sum += value
+        self.sum_squares += value * value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def extend(self, values):
+        """Add many samples, or merge another sketch with the same
+        accuracy.
+        """
+        if not isinstance(values, QuantileSketch):
+            for value in values:
+                self.append(value)
+            return
+        if values.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        if not values.count:
+            return
+        self._ranks = None
+        for mine, theirs in ((self._positive, values._positive),
+                             (self._negative, values._negative)):
+            for index, count in theirs.items():
+                mine[index] = mine.get(index, 0) + count
+            self._collapse(mine)
+        self.zero_count += values.zero_count
+        self.count += values.count
+        self.sum += values.sum
+        self.sum_squares += values.sum_squares
+        if self.min is None or values.min < self.min:
+            self.min = values.min
+        if self.max is None or values.max > self.max:
+            self.max = values.max
+
+    def value_at_rank(self, rank):
+        """Approximate value of the sample at 0-based rank ``rank`` in
+        sorted order. Negative ranks count from the end, as with lists.
+        """
+        if not self.count:
+            raise IndexError("sketch is empty")
+        if rank < 0:
+            rank += self.count
+        if not 0 <= rank < self.count:
+            raise IndexError("rank out of range")
+
+        if self._ranks is None:
+            self._ranks = self._build_ranks()
+        ends, values = self._ranks
+        i = bisect_right(ends, rank)
+        if i == len(ends):
+            return self.max
+        return values[i]
+
+    def _build_ranks(self):
+        ends = []
+        values = []
+        seen = 0
+        for index in sorted(self._negative, reverse=True):
+            seen += self._negative[index]
+            ends.append(seen)
+            values.append(max(-self._value(index), self.min))
+        if self.zero_count:
+            seen += self.zero_count
+            ends.append(seen)
+            values.append(0.0)
+        for index in sorted(self._positive):
+            seen += self._positive[index]
+            ends.append(seen)
+            values.append(min(self._value(index), self.max))
+        return ends, values
+
+    def quantile(self, q):
+        """Approximate q-quantile, 0 <= q <= 1."""
+        return self.value_at_rank(int(q * (self.count - 1)))
@@ -3,31 +3,74 @@
 # Steve Ivy <steveivy@gmail.com>
 # http://monkinetic.com
 
+import collections
 import logging
 import socket
 import random
+import threading
 import time
 
 
-# Sends statistics to the stats daemon over UDP
+def parse_address(host, port=8125):
+    """
+    Split a statsd address into (scheme, host, port). host may be a plain
+    hostname (UDP), udp://host[:port], tcp://host[:port] or
+    unix:///path/to/socket, for which host is the path and port is None.
+    """
+    scheme, sep, rest = host.partition("://")
+    if not sep:
+        return "udp", host, int(port)
+    if scheme not in ("udp", "tcp", "unix"):
+        raise ValueError("Unsupported statsd address scheme: %s" % scheme)
+    if scheme == "unix":
+        return scheme, rest, None
+    rest, sep, rest_port = rest.partition(":")
+    return scheme, rest, int(rest_port) if sep else int(port)
+
+
+def _gauge_lines(stat, value, delta, rate=""):
+    if delta:
+        return "%s:%+f|g%s" % (stat, value, rate)
+    if value < 0:
+        # A leading minus sign would make it a delta, so reset the gauge
+        # to 0 first, in the same datagram.
+        return "%s:0|g%s\n%s:%f|g%s" % (stat, rate, stat, value, rate)
+    return "%s:%f|g%s" % (stat, value, rate)
+
+
+# Sends statistics to the stats daemon over UDP, TCP or a UNIX socket
 class Client(object):
 
     def __init__(self, host='localhost', port=8125, prefix=None):
         """
         Create a new Statsd client.
-        * host: the host where statsd is listening, defaults to localhost
+        * host: the host where statsd is listening, defaults to localhost.
+          tcp://host[:port] sends newline-terminated lines over a TCP
+          connection and unix:///path sends datagrams to a UNIX socket.
         * port: the port where statsd is listening, defaults to 8125
 
         >>> from pystatsd import statsd
         >>> stats_client = statsd.Statsd(host, port)
+        >>> local_client = statsd.Client('unix:///var/run/pystatsd.sock')
         """
-        self.host = host
-        self.port = int(port)
-        self.addr = (socket.gethostbyname(self.host), self.port)
+        self.scheme, self.host, self.port = parse_address(host, port)
+        if self.scheme == "unix":
+            self.addr = self.host
+            self.udp_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        else:
+            self.addr = (socket.gethostbyname(self.host), self.port)
+            if self.scheme == "udp":
+                self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            else:
+                self.udp_sock = None
         self.prefix = prefix
         self.log = logging.getLogger("pystatsd.client")
         self.log.addHandler(logging.StreamHandler())
-        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # TCP only: connected lazily, and not retried for a second after
+        # a failure so a dead server costs little.
+        self.tcp_sock = None
+        self._tcp_lock = threading.Lock()
+        self._tcp_retry_at = 0
 
     def timing_since(self, stat, start, sample_rate=1):
         """
@@ -40,18 +83,42 @@ class Client(object):
 
     def timing(self, stat, time, sample_rate=1):
         """
-        Log timing information for a single stat
+        Log timing information for a single stat, or several samples of
+        it at once in a single line
         >>> statsd_client.timing('some.time',500)
+        >>> statsd_client.timing('some.time',[500, 20, 35])
         """
-        stats = {stat: "%f|ms" % time}
+        if isinstance(time, (list, tuple)):
+            stats = {stat: "%s|ms" % ":".join(["%f" % t for t in time])}
+        else:
+            stats = {stat: "%f|ms" % time}
         self.send(stats, sample_rate)
 
-    def gauge(self, stat, value, sample_rate=1):
+    def gauge(self, stat, value, sample_rate=1, delta=False):
         """
-        Log gauge information for a single stat
+        Log gauge information for a single stat, or change it by value
+        with delta=True
         >>> statsd_client.gauge('some.gauge',42)
+        >>> statsd_client.gauge('some.gauge',-3,delta=True)
+        """
+        rate = ""
+        if sample_rate < 1:
+            if random.random() > sample_rate:
+                return
+            rate = "|@%s" % sample_rate
+        if self.prefix:
+            stat = ".".join((self.prefix, stat))
+        try:
+            self._send_line(_gauge_lines(stat, value, delta, rate))
+        except:
+            self.log.exception("unexpected error")
+
+    def set(self, stat, value, sample_rate=1):
         """
-        stats = {stat: "%f|g" % value}
+        Add a member to a set; the server counts distinct members
+        >>> statsd_client.set('some.users', user_id)
+        """
+        stats = {stat: "%s|s" % value}
         self.send(stats, sample_rate)
 
     def increment(self, stats, sample_rate=1):
@@ -103,11 +170,344 @@ class Client(object):
             sampled_data = data
 
         try:
-            [self.udp_sock.sendto(bytes(bytearray("%s:%s" % (stat, value),
-                                                  "utf-8")), self.addr)
-             for stat, value in sampled_data.items()]
+            for stat, value in sampled_data.items():
+                self._send_line("%s:%s" % (stat, value))
         except:
             self.log.exception("unexpected error")
 
+    def _send_line(self, line):
+        self._send_data(line.encode("utf-8"))
+
+    def _send_data(self, data):
+        if self.udp_sock is not None:
+            self.udp_sock.sendto(data, self.addr)
+            return
+        with self._tcp_lock:
+            if self.tcp_sock is None:
+                if time.time() < self._tcp_retry_at:
+                    return
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(1.0)
+                try:
+                    sock.connect(self.addr)
+                except socket.error:
+                    sock.close()
+                    self._tcp_retry_at = time.time() + 1
+                    raise
+                self.tcp_sock = sock
+            try:
+                self.tcp_sock.sendall(data + b"\n")
+            except socket.error:
+                self.tcp_sock.close()
+                self.tcp_sock = None
+                raise
+
+    def close(self):
+        """
+        Close the TCP connection, if any
+        """
+        with self._tcp_lock:
+            if self.tcp_sock is not None:
+                self.tcp_sock.close()
+                self.tcp_sock = None
+
+    def pipeline(self, max_size=1432):
+        """
+        Batch stats into as few datagrams as possible
+        >>> with statsd_client.pipeline() as pipe:
+        ...     pipe.increment('some.int')
+        ...     pipe.timing('some.time', 500)
+        """
+        return Pipeline(self, max_size)
+
     def __repr__(self):
         return "<pystatsd.statsd.Client addr=%s prefix=%s>" % (self.addr, self.prefix)
+
+
+class Pipeline(Client):
+
+    def __init__(self, client, max_size=1432):
+        """
+        Collects stats from the usual Client methods and sends them as
+        newline-delimited datagrams of at most max_size bytes. Use
+        max_size=1432 to stay inside an ethernet MTU, or up to 8192 (the
+        server's receive buffer) on loopback.
+
+        Data is sent when the next stat would not fit, on send() with no
+        arguments, and when leaving a with block.
+        """
+        self.scheme = client.scheme
+        self.host = client.host
+        self.port = client.port
+        self.addr = client.addr
+        self.prefix = client.prefix
+        self.log = client.log
+        self.udp_sock = client.udp_sock
+        # Data goes out through the client's connection; the pipeline
+        # never opens one of its own.
+        self.tcp_sock = None
+        self._tcp_lock = threading.Lock()
+        self._client = client
+        self.max_size = max_size
+        self._buffer = bytearray()
+
+    def _send_line(self, line):
+        data = line.encode("utf-8")
+        if self._buffer and len(self._buffer) + 1 + len(data) > self.max_size:
+            self.flush()
+        if self._buffer:
+            self._buffer += b"\n"
+        self._buffer += data
+
+    def flush(self):
+        """
+        Send whatever is buffered
+        """
+        if not self._buffer:
+            return
+        data, self._buffer = bytes(self._buffer), bytearray()
+        try:
+            self._client._send_data(data)
+        except:
+            self.log.exception("unexpected error")
+
+    def send(self, data=None, sample_rate=1):
+        """
+        Buffer the metrics, or with no arguments send the buffer
+        """
+        if data is None:
+            self.flush()
+        else:
+            Client.send(self, data, sample_rate)
+
+    def close(self):
+        """
+        Send whatever is buffered; the client's connection stays open
+        """
+        self.flush()
+        Client.close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __repr__(self):
+        return "<pystatsd.statsd.Pipeline addr=%s prefix=%s>" % (self.addr, self.prefix)
+
+
+class BufferedClient(Client):
+
+    def __init__(self, host='localhost', port=8125, prefix=None,
+                 flush_interval=100, capacity=10000, max_size=1432):
+        """
+        A Client that never sends from the calling thread. Stats are
+        appended to an in-process buffer and a background thread packs
+        them into datagrams of at most max_size bytes every
+        flush_interval milliseconds, or sooner once the buffer is half
+        full. When the buffer already holds capacity stats, new ones are
+        dropped and counted in self.dropped, as are stats logged after
+        close().
+
+        Call close() on shutdown to send what is left.
+        >>> stats_client = statsd.BufferedClient(host, port)
+        >>> stats_client.increment('some.int')
+        >>> stats_client.close()
+        """
+        Client.__init__(self, host, port, prefix)
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.max_size = max_size
+        self.dropped = 0
+        self._buffer = collections.deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _send_line(self, line):
+        buffered = len(self._buffer)
+        if buffered >= self.capacity or self._closed:
+            # Nothing would ever send it after close().
+            self.dropped += 1
+            return
+        self._buffer.append(line)
+        if buffered + 1 == self.capacity // 2:
+            self._wakeup.set()
+
+    def _drain(self):
+        pipe = Pipeline(self, self.max_size)
+        popleft = self._buffer.popleft
+        while 1:
+            try:
+                line = popleft()
+            except IndexError:
+                break
+            pipe._send_line(line)
+        pipe.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval / 1000.0)
+            self._wakeup.clear()
+            try:
+                self._drain()
+            except:
+                self.log.exception("unexpected error")
+
+    def close(self):
+        """
+        Stop the background thread and send everything still buffered
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._drain()
+        Client.close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<pystatsd.statsd.BufferedClient addr=%s prefix=%s>" % (self.addr, self.prefix)
+
+
+class AggregatingClient(BufferedClient):
+
+    def __init__(self, host='localhost', port=8125, prefix=None,
+                 flush_interval=1000, capacity=10000, max_size=1432):
+        """
+        A BufferedClient that aggregates locally for each flush_interval
+        window: counter deltas are summed (already scaled by their sample
+        rate), gauges keep their last value and timer samples are
+        collected and sent packed as key:v1:v2:...|ms, so a hot counter
+        costs one line per window instead of one datagram per call. The
+        server ends up with the same totals.
+
+        At most capacity timer samples are kept per window; further ones
+        are dropped and counted in self.dropped. Set members are
+        deduplicated and sent packed as key:m1:m2:...|s, with the same
+        limit on distinct members per window.
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._timer_samples = 0
+        self._gauges = {}
+        self._sets = {}
+        self._set_members = 0
+        BufferedClient.__init__(self, host, port, prefix, flush_interval,
+                                capacity, max_size)
+
+    def timing(self, stat, time, sample_rate=1):
+        if sample_rate < 1 and random.random() > sample_rate:
+            return
+        if not isinstance(time, (list, tuple)):
+            time = [time]
+        elif not time:
+            return
+        with self._lock:
+            if self._closed:
+                self.dropped += len(time)
+                return
+            room = self.capacity - self._timer_samples
+            if len(time) > room:
+                self.dropped += len(time) - max(room, 0)
+                time = time[:max(room, 0)]
+                if not time:
+                    return
+            self._timer_samples += len(time)
+            self._timers.setdefault(stat, []).extend(time)
+
+    def gauge(self, stat, value, sample_rate=1, delta=False):
+        if sample_rate < 1 and random.random() > sample_rate:
+            return
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                return
+            # [value, delta]; deltas add up, until a value is set.
+            gauge = self._gauges.get(stat)
+            if delta and gauge is not None:
+                gauge[0] += value
+            else:
+                self._gauges[stat] = [value, delta]
+
+    def set(self, stat, value, sample_rate=1):
+        if sample_rate < 1 and random.random() > sample_rate:
+            return
+        value = str(value)
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                return
+            members = self._sets.get(stat)
+            if members is None or value not in members:
+                if self._set_members >= self.capacity:
+                    self.dropped += 1
+                    return
+                self._set_members += 1
+                self._sets.setdefault(stat, set()).add(value)
+
+    def update_stats(self, stats, delta, sample_rate=1):
+        if not isinstance(stats, list):
+            stats = [stats]
+        if sample_rate < 1:
+            if random.random() > sample_rate:
+                return
+            delta = delta / float(sample_rate)
+        with self._lock:
+            if self._closed:
+                self.dropped += len(stats)
+                return
+            counters = self._counters
+            for stat in stats:
+                counters[stat] = counters.get(stat, 0) + delta
+
+    def _drain(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            timers, self._timers = self._timers, {}
+            gauges, self._gauges = self._gauges, {}
+            sets, self._sets = self._sets, {}
+            self._timer_samples = 0
+            self._set_members = 0
+
+        if self.prefix:
+            name = lambda stat: ".".join((self.prefix, stat))
+        else:
+            name = lambda stat: stat
+
+        pipe = Pipeline(self, self.max_size)
+        for stat, value in counters.items():
+            pipe._send_line("%s:%s|c" % (name(stat), value))
+        for stat, values in timers.items():
+            self._send_packed(pipe, name(stat), [":%f" % value for value in values], "|ms")
+        for stat, members in sets.items():
+            self._send_packed(pipe, name(stat), [":" + member for member in members], "|s")
+        for stat, (value, delta) in gauges.items():
+            pipe._send_line(_gauge_lines(name(stat), value, delta))
+        pipe.flush()
+
+        # Anything passed straight to send()
+        BufferedClient._drain(self)
+
+    def _send_packed(self, pipe, stat, values, suffix):
+        # Pack as many values per line as fit in a datagram
+        line = stat
+        for value in values:
+            if line != stat and len(line) + len(value) + len(suffix) > self.max_size:
+                pipe._send_line(line + suffix)
+                line = stat
+            line += value
+        pipe._send_line(line + suffix)
+
+    def __repr__(self):
+        return "<pystatsd.statsd.AggregatingClient addr=%s prefix=%s>" % (self.addr, self.prefix)
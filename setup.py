@@ -23,5 +23,5 @@ setup(
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
-    scripts=['bin/pystatsd-server']
+    scripts=['bin/pystatsd-server', 'bin/pystatsd-bench']
 )
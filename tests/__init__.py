@@ -1,2 +1,16 @@
+import sys
+
+from .admin import *
+from .bench import *
 from .client import *
+from .gmetric import *
+from .graphite import *
+from .hll import *
+from .parser import *
+from .profiler import *
 from .server import *
+from .sketch import *
+
+# asyncio and async def, so not on Python 2.
+if sys.version_info >= (3, 5):
+    from .aioserver import *
@@ -0,0 +1,74 @@
+import socket
+import unittest
+import mock
+
+from pystatsd.admin import AdminServer, admin_command
+from pystatsd.server import Server
+
+
+class AdminTestCase(unittest.TestCase):
+    """
+    Tests the admin commands
+    """
+    def test_stats(self):
+        server = Server()
+        server.process('a:1|c\nbad\nb:x|c\nc:1|zz')
+        reply = admin_command(server, 'stats')
+
+        self.assertTrue(reply.endswith('END\n\n'))
+        stats = dict(line.split(': ', 1) for line in reply.splitlines()[:-2])
+        self.assertEqual(stats['ingest.packets'], '1')
+        self.assertEqual(stats['ingest.lines'], '4')
+        self.assertEqual(stats['ingest.malformed'], '1')
+        self.assertEqual(stats['ingest.bad_value'], '1')
+        self.assertEqual(stats['ingest.unknown_type'], '1')
+        self.assertEqual(stats['keys.counters'], '1')
+
+    def test_metrics(self):
+        server = Server()
+        server.process('a:1|c\nb:2|c\nt:1:2|ms\ng:3|g\nu:x:y|s')
+
+        self.assertEqual(admin_command(server, 'counters'), 'a: 1.0\nb: 2.0\nEND\n\n')
+        self.assertEqual(admin_command(server, 'timers'), 't: 2\nEND\n\n')
+        self.assertEqual(admin_command(server, 'gauges'), 'g: 3.0\nEND\n\n')
+        self.assertEqual(admin_command(server, 'sets'), 'u: 2\nEND\n\n')
+        self.assertEqual(admin_command(server, 'nope'), 'ERROR\n')
+
+    def test_admin_server(self):
+        server = Server()
+        server.process('a:1|c')
+        admin = AdminServer(server, ('127.0.0.1', 0))
+        admin.start()
+        try:
+            client = socket.create_connection(admin.server_address, 5)
+            client.sendall(b'counters\nquit\n')
+            reply = b''
+            while 1:
+                data = client.recv(4096)
+                if not data:
+                    break
+                reply += data
+            client.close()
+            self.assertEqual(reply, b'a: 1.0\nEND\n\n')
+        finally:
+            admin.stop()
+
+    def test_profile(self):
+        server = Server()
+        self.assertEqual(admin_command(server, 'profile'), 'profiling: off\nEND\n\n')
+        reply = admin_command(server, 'profile start')
+        self.assertTrue(reply.startswith('profiling: on\n'))
+        server.process('a:1|c')
+        reply = admin_command(server, 'profile stop')
+        self.assertTrue(reply.startswith('profiling: off\n'))
+        self.assertTrue('stage.process: calls=1 ' in reply)
+        self.assertEqual(admin_command(server, 'profile stacks'), 'profiling: off\nEND\n\n')
+        self.assertEqual(admin_command(server, 'profile nope'), 'ERROR\n')
+
+    def test_stats_flush_phases(self):
+        server = Server()
+        with mock.patch('pystatsd.graphite.socket.create_connection'):
+            server.flush()
+        stats = admin_command(server, 'stats')
+        for phase in ('collect', 'swap', 'counters', 'gauges', 'timers', 'sets', 'format', 'send'):
+            self.assertTrue('flush.phase.%s_ms: ' % phase in stats, phase)
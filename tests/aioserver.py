@@ -0,0 +1,134 @@
+import asyncio
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from pystatsd.aioserver import AsyncServer
+
+
+class AsyncServerTestCase(unittest.TestCase):
+    """
+    Tests the asyncio server
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.received = bytearray()
+        self.servers = []
+        self.carbons = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for carbon in self.carbons:
+            carbon.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def start_carbon(self):
+        received = self.received
+
+        class Carbon(asyncio.Protocol):
+            def data_received(self, data):
+                received.extend(data)
+
+        carbon = self.loop.run_until_complete(
+            self.loop.create_server(Carbon, '127.0.0.1', 0))
+        self.carbons.append(carbon)
+        return carbon.sockets[0].getsockname()[1]
+
+    def start_server(self, **kwargs):
+        server = AsyncServer(**kwargs)
+        self.loop.run_until_complete(server.start('127.0.0.1', 0, self.loop))
+        self.servers.append(server)
+        return server
+
+    def wait_for(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition() and time.time() < end:
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_receive_and_flush(self):
+        port = self.start_carbon()
+        server = self.start_server(graphite_host='127.0.0.1', graphite_port=port)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto(b'c:2|c\ng:3|g', server.address)
+        client.close()
+        self.wait_for(lambda: 'c' in server.counters)
+        self.assertEqual(server.counters['c'].value, 2)
+
+        server.flush()
+        self.wait_for(lambda: b'statsd.numStats' in self.received)
+        self.assertTrue(b'stats.c 0.2 ' in self.received)
+        self.assertTrue(b'stats.g 3.0 ' in self.received)
+
+    def test_unreachable_graphite_does_not_block(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = self.start_server(graphite_host='127.0.0.1', graphite_port=port)
+        server.process('c:1|c')
+
+        start = time.time()
+        server.flush()
+        self.assertTrue(time.time() - start < 0.5)
+
+        server.process('c:1|c')
+        self.wait_for(lambda: server._graphite.connections[0].backoff)
+        self.assertTrue(server._graphite.queued_bytes > 0)
+        self.assertEqual(server.counters['c'].value, 1)
+
+    def test_flush_is_scheduled(self):
+        port = self.start_carbon()
+        self.start_server(graphite_host='127.0.0.1', graphite_port=port,
+                          flush_interval=50)
+        self.wait_for(lambda: b'statsd.numStats' in self.received)
+        self.assertTrue(b'statsd.numStats 0 ' in self.received)
+
+    def test_unix_and_tcp_listeners(self):
+        path = os.path.join(tempfile.mkdtemp(), 'statsd.sock')
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        tcp_port = sock.getsockname()[1]
+        sock.close()
+        server = self.start_server(unix_socket=path, tcp_port=tcp_port)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto(b'u:1|c', path)
+        client.close()
+        client = socket.create_connection(('127.0.0.1', tcp_port))
+        client.sendall(b't:1|c\nt:')
+        self.wait_for(lambda: 'u' in server.counters and 't' in server.counters)
+        client.sendall(b'2|c')
+        client.close()
+        self.wait_for(lambda: server.counters['t'].value == 3)
+
+        self.assertEqual(server.counters['u'].value, 1)
+        self.assertEqual(server.counters['t'].value, 3)
+        server.stop()
+        self.assertFalse(os.path.exists(path))
+
+    def test_admin_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        admin_port = sock.getsockname()[1]
+        sock.close()
+        server = self.start_server(admin_port=admin_port)
+        server.process('a:1|c')
+
+        reply = bytearray()
+
+        async def ask():
+            reader, writer = await asyncio.open_connection('127.0.0.1', admin_port)
+            writer.write(b'counters\nquit\n')
+            reply.extend(await reader.read())
+            writer.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(ask(), 5))
+        self.assertEqual(bytes(reply), b'a: 1.0\nEND\n\n')
+
+    def test_workers_not_supported(self):
+        self.assertRaises(ValueError, AsyncServer, workers=2)
@@ -0,0 +1,48 @@
+import argparse
+import unittest
+
+from pystatsd.bench import bench, make_packets, parse_mix, report
+
+
+class BenchTestCase(unittest.TestCase):
+    """
+    Tests the end-to-end benchmark
+    """
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix('c=60,ms=30,g=10'),
+                         [('c', 60.0), ('ms', 30.0), ('g', 10.0)])
+        self.assertEqual(parse_mix('ms'), [('ms', 1.0)])
+        self.assertRaises(ValueError, parse_mix, 'x=1')
+
+    def test_make_packets(self):
+        packets = make_packets(keys=100, mix=parse_mix('c=1,ms=1'),
+                               sample_rate=0.5, packet_size=200,
+                               values_per_line=3, lines=1000)
+        self.assertEqual(sum([count for data, count in packets]), 1000)
+        keys = set()
+        for data, count in packets:
+            self.assertTrue(len(data) <= 200)
+            lines = data.decode('utf-8').split('\n')
+            self.assertEqual(len(lines), count)
+            for line in lines:
+                key, rest = line.split(':', 1)
+                keys.add(key)
+                self.assertEqual(len(rest.split('|')[0].split(':')), 3)
+                if line.split('|')[1] == 'c':
+                    self.assertTrue(line.endswith('|c|@0.5'))
+        self.assertEqual(len(keys), 100)
+        self.assertEqual(make_packets(keys=100, lines=1000), make_packets(keys=100, lines=1000))
+
+    def test_bench(self):
+        options = argparse.Namespace(
+            keys=100, mix='c=60,ms=30,g=10', sample_rate=1.0, packet_size=512,
+            values_per_line=1, seed=0, duration=0.5, senders=1, rate=2000,
+            flush_interval=200, workers=0, sockets=1, recv_batch=1,
+            rcvbuf=None, timer_backend='list', pct=[90])
+        results = bench(options)
+        self.assertTrue(results['lines_sent'] > 0)
+        self.assertEqual(results['lines_received'], results['lines_sent'])
+        self.assertEqual(results['drop_rate'], 0.0)
+        self.assertTrue(results['flushes'] > 0)
+        self.assertTrue(results['carbon_lines'] > 0)
+        self.assertTrue('lines/sec' in report(results))
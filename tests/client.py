@@ -4,7 +4,7 @@ import mock
 import socket
 import sys
 
-from pystatsd.statsd import Client
+from pystatsd.statsd import AggregatingClient, BufferedClient, Client, parse_address
 
 
 if sys.version_info[0] < 3:
@@ -94,6 +94,75 @@ class ClientBasicsTestCase(unittest.TestCase):
         self.mock_socket.return_value.sendto.assert_called_with(
             bytes(stat_str, 'utf-8'), self.addr)
 
+    def test_basic_client_set(self):
+        stat = 'pystatsd.unittests.test_basic_client_set.users'
+        stat_str = stat + ':42|s'
+
+        self.client.set(stat, 42)
+
+        self.mock_socket.return_value.sendto.assert_called_with(
+            bytes(stat_str, 'utf-8'), self.addr)
+
+    def test_basic_client_gauge_delta(self):
+        sendto = self.mock_socket.return_value.sendto
+        self.client.gauge('g', 5, delta=True)
+        sendto.assert_called_with(b'g:+5.000000|g', self.addr)
+        self.client.gauge('g', -3, delta=True)
+        sendto.assert_called_with(b'g:-3.000000|g', self.addr)
+        # A negative value is set, not subtracted.
+        self.client.gauge('g', -3)
+        sendto.assert_called_with(b'g:0|g\ng:-3.000000|g', self.addr)
+        with mock.patch('pystatsd.statsd.random.random', return_value=0.1):
+            self.client.gauge('g', -3, sample_rate=0.5)
+        sendto.assert_called_with(b'g:0|g|@0.5\ng:-3.000000|g|@0.5', self.addr)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('localhost', 8125), ('udp', 'localhost', 8125))
+        self.assertEqual(parse_address('tcp://localhost:8126'), ('tcp', 'localhost', 8126))
+        self.assertEqual(parse_address('udp://localhost', 9000), ('udp', 'localhost', 9000))
+        self.assertEqual(parse_address('unix:///tmp/s.sock'), ('unix', '/tmp/s.sock', None))
+        self.assertRaises(ValueError, parse_address, 'http://localhost')
+
+    def test_unix_client(self):
+        client = Client('unix:///tmp/statsd.sock')
+        self.mock_socket.assert_called_with(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.increment('a')
+        self.mock_socket.return_value.sendto.assert_called_with(
+            b'a:1|c', '/tmp/statsd.sock')
+
+    def test_tcp_client(self):
+        client = Client('tcp://localhost:8126')
+        client.increment('a')
+        with client.pipeline() as pipe:
+            pipe.increment('b')
+            pipe.increment('c')
+
+        sock = self.mock_socket.return_value
+        self.mock_socket.assert_called_with(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect.call_count, 1)
+        self.assertEqual([call[0][0] for call in sock.sendall.call_args_list],
+                         [b'a:1|c\n', b'b:1|c\nc:1|c\n'])
+        self.assertFalse(sock.sendto.called)
+
+    def test_tcp_client_reconnects(self):
+        client = Client('tcp://localhost:8126')
+        sock = self.mock_socket.return_value
+        sock.sendall.side_effect = [socket.error('reset'), None]
+        client.increment('a')
+        self.assertEqual(client.tcp_sock, None)
+        client.increment('b')
+        self.assertEqual(sock.connect.call_count, 2)
+        sock.sendall.assert_called_with(b'b:1|c\n')
+
+    def test_basic_client_timing_multi(self):
+        stat = 'pystatsd.unittests.test_basic_client_timing.time'
+        stat_str = stat + ':5.000000:6.000000|ms'
+
+        self.client.timing(stat, [5, 6])
+
+        self.mock_socket.return_value.sendto.assert_called_with(
+            bytes(stat_str, 'utf-8'), self.addr)
+
     def test_basic_client_timing_since(self):
         ts = (1971, 6, 29, 4, 13, 0, 0, 0, -1)
         now = time.mktime(ts)
@@ -114,6 +183,177 @@ class ClientBasicsTestCase(unittest.TestCase):
 
         mock_time_patcher.stop()
 
+    def test_pipeline(self):
+        sendto = self.mock_socket.return_value.sendto
+
+        with self.client.pipeline() as pipe:
+            pipe.increment('a')
+            pipe.update_stats(['b'], 5)
+            pipe.timing('c', 5)
+            self.assertEqual(sendto.call_count, 0)
+
+        sendto.assert_called_once_with(
+            bytes('a:1|c\nb:5|c\nc:5.000000|ms', 'utf-8'), self.addr)
+
+    def test_pipeline_max_size(self):
+        sendto = self.mock_socket.return_value.sendto
+        pipe = self.client.pipeline(max_size=16)
+
+        pipe.increment('aaa')
+        pipe.increment('bbb')
+        pipe.increment('ccc')
+        sendto.assert_called_once_with(
+            bytes('aaa:1|c\nbbb:1|c', 'utf-8'), self.addr)
+
+        pipe.send()
+        self.assertEqual(sendto.call_count, 2)
+        sendto.assert_called_with(bytes('ccc:1|c', 'utf-8'), self.addr)
+
+    def test_pipeline_close(self):
+        sendto = self.mock_socket.return_value.sendto
+        pipe = self.client.pipeline()
+
+        pipe.increment('a')
+        pipe.close()
+        sendto.assert_called_once_with(b'a:1|c', self.addr)
+        pipe.close()
+        self.assertEqual(sendto.call_count, 1)
+
+    def test_buffered_client(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = BufferedClient(flush_interval=60000)
+
+        client.increment('a')
+        client.gauge('b', 1)
+        self.assertEqual(sendto.call_count, 0)
+        client.close()
+
+        sendto.assert_called_once_with(
+            bytes('a:1|c\nb:1.000000|g', 'utf-8'), self.addr)
+
+    def test_buffered_client_capacity(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = BufferedClient(flush_interval=60000, capacity=4)
+        # Keep the background thread from draining while we fill up.
+        client._closed = True
+        client._wakeup.set()
+        client._thread.join()
+        client._closed = False
+
+        for i in range(6):
+            client.increment('a')
+        self.assertEqual(client.dropped, 2)
+
+        client._drain()
+        sendto.assert_called_once_with(
+            bytes('\n'.join(['a:1|c'] * 4), 'utf-8'), self.addr)
+
+    def test_buffered_client_counts_stats_after_close(self):
+        sendto = self.mock_socket.return_value.sendto
+        for client_class in (BufferedClient, AggregatingClient):
+            client = client_class(flush_interval=60000)
+            client.increment('a')
+            client.close()
+            client.increment('b')
+            client.timing('t', [1, 2])
+            client.gauge('g', 1)
+            self.assertEqual(client.dropped, 3 if client_class is BufferedClient else 4)
+            sendto.assert_called_with(b'a:1|c', self.addr)
+
+    def test_buffered_client_wakes_up_when_half_full(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = BufferedClient(flush_interval=60000, capacity=4)
+        try:
+            client.increment('a')
+            client.increment('b')
+            for i in range(100):
+                if sendto.call_count:
+                    break
+                time.sleep(0.01)
+            sendto.assert_called_once_with(
+                bytes('a:1|c\nb:1|c', 'utf-8'), self.addr)
+        finally:
+            client.close()
+
+    def test_aggregating_client(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = AggregatingClient(flush_interval=60000, prefix='p')
+
+        for i in range(100):
+            client.increment('a')
+        client.decrement('a')
+        client.update_stats(['b', 'c'], 2)
+        client.timing('t', 1)
+        client.timing('t', 2)
+        client.gauge('g', 1)
+        client.gauge('g', 3)
+        self.assertEqual(sendto.call_count, 0)
+        client.close()
+
+        self.assertEqual(sendto.call_count, 1)
+        lines = sendto.call_args[0][0].decode('utf-8').split('\n')
+        self.assertEqual(sorted(lines), [
+            'p.a:99|c', 'p.b:2|c', 'p.c:2|c', 'p.g:3.000000|g',
+            'p.t:1.000000:2.000000|ms'])
+
+    def test_aggregating_client_timer_lines_fit(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = AggregatingClient(flush_interval=60000, max_size=39)
+        client.timing('t', [1, 2, 3, 4, 5])
+        client.close()
+
+        lines = []
+        for call in sendto.call_args_list:
+            self.assertTrue(len(call[0][0]) <= 39)
+            lines.extend(call[0][0].decode('utf-8').split('\n'))
+        self.assertEqual(lines, ['t:1.000000:2.000000:3.000000|ms',
+                                 't:4.000000:5.000000|ms'])
+
+    def test_aggregating_client_sets(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = AggregatingClient(flush_interval=60000, capacity=3, max_size=7)
+        for member in ('a', 'b', 'a', 'c', 'd'):
+            client.set('u', member)
+        client.set('v', 'a')
+        client.close()
+
+        members = []
+        for call in sendto.call_args_list:
+            for line in call[0][0].decode('utf-8').split('\n'):
+                self.assertTrue(len(line) <= 7)
+                key, sep, rest = line.partition(':')
+                self.assertEqual(key, 'u')
+                members.extend(rest[:-2].split(':'))
+        self.assertEqual(sorted(members), ['a', 'b', 'c'])
+        self.assertEqual(client.dropped, 2)
+
+    def test_aggregating_client_gauge_deltas(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = AggregatingClient(flush_interval=60000)
+        client.gauge('d', 2, delta=True)
+        client.gauge('d', -5, delta=True)
+        client.gauge('s', 1)
+        client.gauge('s', 2, delta=True)
+        client.gauge('n', -2)
+        client.close()
+
+        lines = sendto.call_args[0][0].decode('utf-8').split('\n')
+        self.assertEqual(sorted(lines), ['d:-3.000000|g', 'n:-2.000000|g', 'n:0|g', 's:3.000000|g'])
+        self.assertEqual(lines.index('n:0|g') + 1, lines.index('n:-2.000000|g'))
+
+    def test_aggregating_client_sample_rate(self):
+        sendto = self.mock_socket.return_value.sendto
+        client = AggregatingClient(flush_interval=60000)
+
+        with mock.patch('pystatsd.statsd.random.random', return_value=0.1):
+            client.increment('a', sample_rate=0.5)
+            client.increment('a', sample_rate=0.5)
+        with mock.patch('pystatsd.statsd.random.random', return_value=0.9):
+            client.increment('a', sample_rate=0.5)
+        client.close()
+
+        sendto.assert_called_once_with(bytes('a:4.0|c', 'utf-8'), self.addr)
+
     def tearDown(self):
         for patcher in self.patchers:
             patcher.stop()
@@ -0,0 +1,150 @@
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+import warnings
+
+import mock
+
+from pystatsd import gmetric
+from pystatsd.gmetric_pool import GmetricPool
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    try:
+        import xdrlib
+    except ImportError:
+        xdrlib = None
+
+
+class GmetricTestCase(unittest.TestCase):
+    """
+    Tests the embedded Ganglia library
+    """
+    def setUp(self):
+        self.patchers = []
+
+        socket_patcher = mock.patch('pystatsd.gmetric.socket.socket')
+        self.mock_socket = socket_patcher.start()
+        self.patchers.append(socket_patcher)
+
+    @unittest.skipIf(xdrlib is None, 'xdrlib is not available')
+    def test_matches_xdrlib(self):
+        meta, data = gmetric.gmetric_write('name', 1.5, 'double', 'count',
+                                           'both', 60, 12, 'grp', 'h:h')
+
+        packer = xdrlib.Packer()
+        packer.pack_int(128)
+        for s in (b'h:h', b'name'):
+            packer.pack_string(s)
+        packer.pack_int(1)
+        for s in (b'double', b'name', b'count'):
+            packer.pack_string(s)
+        packer.pack_int(3)
+        packer.pack_uint(60)
+        packer.pack_uint(12)
+        packer.pack_int(1)
+        packer.pack_string(b'GROUP')
+        packer.pack_string(b'grp')
+        self.assertEqual(meta, packer.get_buffer())
+
+        packer = xdrlib.Packer()
+        packer.pack_int(133)
+        packer.pack_string(b'h:h')
+        packer.pack_string(b'name')
+        packer.pack_int(1)
+        packer.pack_string(b'%s')
+        packer.pack_string(b'1.5')
+        self.assertEqual(data, packer.get_buffer())
+
+    def test_metadata_is_cached(self):
+        sendto = self.mock_socket.return_value.sendto
+        g = gmetric.Gmetric('localhost', 8649, 'udp')
+        meta, data = gmetric.gmetric_write('name', 1, 'double', 'count',
+                                           'both', 60, 0, '', '')
+
+        g.send('name', 1, 'double', 'count', 'both', 60, 0)
+        g.send('name', 1, 'double', 'count', 'both', 60, 0)
+        self.assertEqual([c[0][0] for c in sendto.call_args_list],
+                         [meta, data, data])
+
+        # Changed metadata is sent straight away.
+        g.send('name', 1, 'double', 'seconds', 'both', 60, 0)
+        self.assertEqual(sendto.call_count, 5)
+
+    def test_metadata_cache_is_bounded(self):
+        g = gmetric.Gmetric('localhost', 8649, 'udp', max_meta=3)
+        for i in range(10):
+            g.send('name%d' % i, 1, 'double', 'count', 'both', 60, 0)
+            self.assertTrue(len(g._meta) <= 3)
+        self.assertTrue('name9' in g._meta)
+
+    def test_read(self):
+        msg = b''.join([gmetric._pack_int(0), gmetric._pack_string('double'),
+                        gmetric._pack_string('name'), gmetric._pack_string('1'),
+                        gmetric._pack_string('s'), gmetric._pack_int(3),
+                        gmetric._pack_uint(60), gmetric._pack_uint(0)])
+        self.assertEqual(gmetric.gmetric_read(msg), {
+            'TYPE': b'double', 'NAME': b'name', 'VAL': b'1', 'UNITS': b's',
+            'SLOPE': 'both', 'TMAX': 60, 'DMAX': 0})
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+
+class GmetricPoolTestCase(unittest.TestCase):
+    """
+    Tests running gmetric on a worker pool with a deadline
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmpdir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def script(self, body):
+        path = os.path.join(self.tmpdir, 'gmetric')
+        with open(path, 'w') as fp:
+            fp.write('#!/bin/sh\n' + body + '\n')
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def test_run(self):
+        exe = self.script('echo "$1" >> %s' % self.out)
+        dropped = GmetricPool(workers=3).run(
+            [[exe, str(i)] for i in range(10)], deadline=10)
+
+        self.assertEqual(dropped, 0)
+        with open(self.out) as fp:
+            self.assertEqual(sorted(int(l) for l in fp), list(range(10)))
+
+    def test_deadline(self):
+        exe = self.script('sleep 5')
+        start = time.time()
+        dropped = GmetricPool(workers=2).run([[exe]] * 6, deadline=0.3)
+
+        self.assertEqual(dropped, 6)
+        self.assertTrue(time.time() - start < 3)
+
+    def test_deadline_starts_on_entry(self):
+        exe = self.script('sleep 5')
+        start = time.time()
+        dropped = GmetricPool(workers=1).run([[exe]], deadline=0.3)
+
+        self.assertEqual(dropped, 1)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_errors_count_as_dropped(self):
+        exe = self.script('true')
+        with mock.patch('pystatsd.gmetric_pool._run_until', side_effect=RuntimeError):
+            dropped = GmetricPool().run([[exe]] * 3, deadline=1)
+        self.assertEqual(dropped, 3)
+
+    def test_missing_executable(self):
+        dropped = GmetricPool().run(
+            [[os.path.join(self.tmpdir, 'nope')]], deadline=1)
+        self.assertEqual(dropped, 1)
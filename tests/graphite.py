@@ -0,0 +1,116 @@
+import pickle
+import socket
+import struct
+import unittest
+
+from pystatsd.graphite import (GraphiteSender, PickleFormatter,
+                               PlaintextFormatter, parse_addrs)
+
+
+class GraphiteSenderTestCase(unittest.TestCase):
+    """
+    Tests the persistent Graphite sender
+    """
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.listener.settimeout(5)
+        self.addr = self.listener.getsockname()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def unused_addr(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        addr = sock.getsockname()
+        sock.close()
+        return addr
+
+    def test_parse_addrs(self):
+        self.assertEqual(parse_addrs('a,b:2013', 2003),
+                         [('a', 2003), ('b', 2013)])
+
+    def test_plaintext_formatter(self):
+        out = PlaintextFormatter('key.')
+        out.add('a.b', 1.5, 10)
+        out.add('c', 2, 10)
+        self.assertEqual(out.payloads(), [b'key.a.b 1.5 10\nkey.c 2 10\n'])
+
+    def test_pickle_formatter(self):
+        out = PickleFormatter('key.', batch_size=2)
+        for i in range(3):
+            out.add('m%d' % i, i, 10)
+
+        batches = []
+        for frame in out.payloads():
+            size, = struct.unpack('!L', frame[:4])
+            self.assertEqual(size, len(frame) - 4)
+            batches.append(pickle.loads(frame[4:]))
+        self.assertEqual(batches, [
+            [('key.m0', (10, 0)), ('key.m1', (10, 1))],
+            [('key.m2', (10, 2))],
+        ])
+
+    def test_connection_is_reused(self):
+        sender = GraphiteSender([self.addr])
+        try:
+            self.assertTrue(sender.send(b'a 1 1\n'))
+            self.assertTrue(sender.send(b'b 2 2\n'))
+            conn, _ = self.listener.accept()
+            conn.settimeout(5)
+            data = b''
+            while len(data) < 12:
+                data += conn.recv(1024)
+            conn.close()
+        finally:
+            sender.close()
+
+        self.assertEqual(data, b'a 1 1\nb 2 2\n')
+
+    def test_queue_and_backoff(self):
+        sender = GraphiteSender([self.unused_addr()], max_queue_bytes=10,
+                                backoff_min=60)
+        self.assertFalse(sender.send(b'a 1 1\n'))
+        connection = sender.connections[0]
+        self.assertEqual(connection.backoff, 60)
+        self.assertEqual(sender.queued_bytes, 6)
+
+        # Still backing off: nothing is attempted, and the oldest payload
+        # is dropped to stay under max_queue_bytes.
+        self.assertFalse(sender.send(b'b 2 2\n'))
+        self.assertEqual(sender.queued_bytes, 6)
+        self.assertEqual(sender.dropped_bytes, 6)
+
+        connection.addr = self.addr
+        connection.retry_at = 0
+        self.assertTrue(sender.send(None))
+        self.assertEqual(sender.queued_bytes, 0)
+        self.assertEqual(connection.backoff, 0)
+        sender.close()
+
+    def test_resume_from_line_start(self):
+        sender = GraphiteSender([self.addr], chunk_size=4)
+        connection = sender.connections[0]
+        sent = []
+
+        def sendall(chunk):
+            if len(sent) == 2:
+                raise socket.error('boom')
+            sent.append(bytes(chunk))
+
+        connection.sendall = sendall
+        self.assertFalse(sender.send(b'ab 1\ncd 2\n'))
+        # 'ab 1' and '\ncd ' went out, the failure was in the line 'cd 2'.
+        self.assertEqual(sent, [b'ab 1', b'\ncd '])
+        self.assertEqual(sender._queue[0][1], 5)
+        self.assertEqual(sender.queued_bytes, 5)
+
+    def test_failover(self):
+        sender = GraphiteSender([self.unused_addr(), self.addr])
+        try:
+            self.assertTrue(sender.send(b'a 1 1\n'))
+        finally:
+            sender.close()
+        self.assertTrue(sender.connections[0].backoff > 0)
@@ -0,0 +1,73 @@
+import pickle
+import unittest
+
+from pystatsd.hll import HyperLogLog, UniqueSet
+
+
+class HyperLogLogTestCase(unittest.TestCase):
+    """
+    Tests the distinct-count estimator
+    """
+    def test_small_counts_are_close_to_exact(self):
+        hll = HyperLogLog()
+        for i in range(100):
+            hll.add('key%d' % i)
+            hll.add('key%d' % i)
+        self.assertTrue(abs(hll.count() - 100) <= 2)
+
+    def test_large_count_within_error(self):
+        hll = HyperLogLog()
+        for i in range(100000):
+            hll.add('request.%d.time' % i)
+        # Standard error is about 1.6%; allow four of them.
+        self.assertTrue(abs(hll.count() - 100000) < 100000 * 0.065)
+
+    def test_update(self):
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in range(1000):
+            a.add('a%d' % i)
+            b.add('b%d' % i)
+        b.add('a1')
+        a.update(b)
+        self.assertTrue(abs(a.count() - 2000) < 2000 * 0.065)
+        self.assertRaises(ValueError, a.update, HyperLogLog(precision=10))
+
+
+class UniqueSetTestCase(unittest.TestCase):
+    """
+    Tests the exact-then-sketched set
+    """
+    def test_exact_below_threshold(self):
+        members = UniqueSet(threshold=10)
+        for i in range(10):
+            members.add('user%d' % i)
+            members.add('user%d' % i)
+        self.assertEqual(members.count(), 10)
+        self.assertEqual(members.sketch, None)
+
+    def test_switches_to_sketch(self):
+        members = UniqueSet(threshold=10)
+        for i in range(5000):
+            members.add('user%d' % i)
+        self.assertEqual(members.members, None)
+        self.assertTrue(abs(members.count() - 5000) < 5000 * 0.065)
+
+    def test_update(self):
+        small, other, large = UniqueSet(threshold=10), UniqueSet(threshold=10), UniqueSet(threshold=10)
+        for i in range(5):
+            small.add('a%d' % i)
+            other.add('a%d' % (i + 3))
+        for i in range(1000):
+            large.add('b%d' % i)
+        small.update(other)
+        self.assertEqual(small.count(), 8)
+        small.update(large)
+        self.assertTrue(small.sketch is not None)
+        self.assertTrue(abs(small.count() - 1008) < 1008 * 0.065)
+
+    def test_pickle(self):
+        members = UniqueSet(threshold=10)
+        members.add('a')
+        copy = pickle.loads(pickle.dumps(members))
+        self.assertEqual(copy.count(), 1)
+        self.assertEqual(copy.threshold, 10)
@@ -0,0 +1,33 @@
+import unittest
+
+from pystatsd.parser import Parser, clean_key, parse_sample_rate, split_line
+
+
+class ParserTestCase(unittest.TestCase):
+    """
+    Tests the statsd line parser
+    """
+    def test_split_line(self):
+        self.assertEqual(split_line('a.b:1|c'), ('a.b', '1', 'c', []))
+        self.assertEqual(split_line('a.b:1|c|@0.5'),
+                         ('a.b', '1', 'c', ['@0.5']))
+        self.assertEqual(split_line('a:b:1|ms'), ('a', 'b:1', 'ms', []))
+
+    def test_split_line_malformed(self):
+        for line in ('', 'a.b', 'a.b:1', 'a.b:1|', ':1|c', 'a.b:|c'):
+            self.assertEqual(split_line(line), None)
+
+    def test_clean_key(self):
+        self.assertEqual(clean_key('a b/c\td*e'), 'a_b-c_de')
+
+    def test_parse_caches_clean_keys(self):
+        parser = Parser(max_keys=2)
+        self.assertEqual(parser.parse('a b:1|c')[0], 'a_b')
+        self.assertEqual(parser._keys, {'a b': 'a_b'})
+        parser.parse('c:1|c')
+        parser.parse('d:1|c')
+        self.assertEqual(parser._keys, {'d': 'd'})
+
+    def test_parse_sample_rate(self):
+        self.assertEqual(parse_sample_rate('@0.25'), 0.25)
+        self.assertRaises(ValueError, parse_sample_rate, '0.25')
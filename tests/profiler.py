@@ -0,0 +1,90 @@
+import os
+import socket
+import tempfile
+import time
+import unittest
+import mock
+
+from pystatsd.profiler import Profiler
+from pystatsd.server import Server
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """
+    Tests profiling a running server
+    """
+    def setUp(self):
+        patcher = mock.patch('pystatsd.graphite.socket.create_connection')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stages(self):
+        server = Server()
+        profiler = Profiler(server, interval=0.001)
+        profiler.start()
+        server.process('a:1|c\nb:2|g\nt:1:2|ms\nbad')
+        server.process('a:1|c')
+        server.flush()
+        time.sleep(0.01)
+        profiler.stop()
+
+        stages = dict([(row[0], row[1]) for row in profiler.summary()])
+        self.assertEqual(stages['process'], 2)
+        self.assertEqual(stages['parse'], 5)
+        self.assertEqual(stages['clean_key'], 4)
+        self.assertEqual(stages['record_counter'], 2)
+        self.assertEqual(stages['record_gauge'], 1)
+        self.assertEqual(stages['record_timer'], 1)
+        self.assertEqual(stages['flush'], 1)
+        for phase in ('collect', 'swap', 'counters', 'gauges', 'timers', 'sets', 'format', 'send'):
+            self.assertEqual(stages['flush.' + phase], 1)
+        self.assertTrue(stages['format'] > 1)
+        self.assertEqual(server.counters, {})
+
+        self.assertTrue(profiler.samples > 0)
+        self.assertTrue(profiler.collapsed())
+        self.assertTrue(profiler.collapsed()[0].startswith('MainThread;'))
+
+        # Stopping puts the server's own methods back.
+        self.assertFalse('process' in vars(server))
+        self.assertFalse('parse' in vars(server.parser))
+        server.process('a:1|c')
+        self.assertEqual(dict([(row[0], row[1]) for row in profiler.summary()])['process'], 2)
+
+    def test_recvfrom(self):
+        server = Server(recv_batch=4)
+        sock = server._bind(('127.0.0.1', 0))
+        sock.setblocking(0)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            client.sendto(b'a:1|c', sock.getsockname())
+            client.sendto(b'a:1|c', sock.getsockname())
+            time.sleep(0.05)
+            profiler = Profiler(server)
+            profiler.start()
+            server._drain(sock)
+            profiler.stop()
+        finally:
+            client.close()
+            sock.close()
+
+        stages = dict([(row[0], row[1]) for row in profiler.summary()])
+        # Two datagrams, then the call that would block.
+        self.assertEqual(stages['recvfrom'], 3)
+        self.assertEqual(server.counters['a'].value, 2)
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        server = Server(profile_dir=directory)
+        self.assertTrue(server.start_profiling() is server.start_profiling())
+        server.process('a:1|c')
+        profiler = server.stop_profiling()
+        self.assertEqual(server.stop_profiling(), None)
+
+        files = sorted(os.listdir(directory))
+        self.assertEqual([os.path.splitext(name)[1] for name in files], ['.collapsed', '.txt'])
+        with open(os.path.join(directory, files[1])) as f:
+            summary = f.read()
+        self.assertTrue('\nprocess ' in summary)
+        with open(os.path.join(directory, files[0])) as f:
+            self.assertEqual(f.read().splitlines(), profiler.collapsed())
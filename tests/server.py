@@ -1,8 +1,18 @@
+import os
+import pickle
+import random
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import mock
 
 # from pystatsd.statsd import Client
-from pystatsd.server import Server
+from array import array
+
+from pystatsd import server as server_module
+from pystatsd.server import Server, _parse_histogram, _parse_pcts, _timer_stats
 
 
 class ServerBasicsTestCase(unittest.TestCase):
@@ -23,3 +33,572 @@ class ServerBasicsTestCase(unittest.TestCase):
             self.assertIsNotNone(server)
         else:
             assert server is not None
+
+    def test_server_process(self):
+        server = Server()
+        server.process(b'a b:1|c\na b:2|c|@0.5\nt:5|ms\nt:7|ms\ng:3|g\n')
+
+        self.assertEqual(server.counters['a_b'].value, 5)
+        self.assertEqual(list(server.timers['t'].value), [5.0, 7.0])
+        self.assertEqual(server.gauges['g'].value, 3.0)
+
+    def test_server_process_multi_value(self):
+        server = Server()
+        server.process('t:1:2:3|ms\nc:1:2|c|@0.5\ng:1:2|g')
+
+        self.assertEqual(list(server.timers['t'].value), [1.0, 2.0, 3.0])
+        self.assertEqual(server.counters['c'].value, 6)
+        self.assertEqual(server.gauges['g'].value, 2.0)
+
+    def test_server_sets(self):
+        server = Server(set_threshold=10)
+        server.process('u:a|s\nu:b:a|s\nv:x|s')
+        for i in range(1000):
+            server.process('big:%d|s' % i)
+
+        self.assertEqual(server.sets['u'].value.count(), 2)
+        self.assertEqual(server.sets['v'].value.count(), 1)
+        self.assertEqual(server._ingest['unknown_type'], 0)
+
+        server.flush()
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        lines = dict(line.split(' ')[:2] for line in payload.decode('utf-8').splitlines())
+        self.assertEqual(lines['stats.sets.u.count'], '2')
+        self.assertEqual(lines['stats.sets.v.count'], '1')
+        self.assertTrue(abs(int(lines['stats.sets.big.count']) - 1000) < 65)
+        self.assertEqual(lines['statsd.keys.sets'], '3')
+        self.assertEqual(server.sets, {})
+
+    def test_server_sets_gmetric(self):
+        server = Server(transport='ganglia-gmetric')
+        server.process('u:a|s\nu:b|s')
+        with mock.patch.object(server, '_run_gmetric') as run:
+            server.flush()
+        commands = run.call_args[0][0]
+        self.assertTrue(['/usr/bin/gmetric', '-d', '-u', 'count', '-g', '_sets',
+                         '-t', 'double', '-n', 'u', '-v', '2'] in commands)
+
+    def test_server_flush_keeps_gauges(self):
+        server = Server()
+        server.process('g:3|g')
+        server.flush()
+        server.flush()
+
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        self.assertTrue(b'stats.g 3.0 ' in payload)
+
+    def test_server_flush_timer_sketch(self):
+        server = Server(timer_backend='sketch')
+        server.process('\n'.join('t:%d|ms' % i for i in range(1, 101)))
+        server.flush()
+
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        lines = dict(line.split()[:2]
+                     for line in payload.decode('utf-8').splitlines())
+        self.assertEqual(lines['stats.timers.t.count'], '100')
+        self.assertEqual(lines['stats.timers.t.lower'], '1.0')
+        self.assertEqual(lines['stats.timers.t.upper'], '100.0')
+        self.assertEqual(lines['stats.timers.t.mean'], '50.5')
+        self.assertTrue(abs(float(lines['stats.timers.t.upper_90']) - 90) < 1)
+
+    def test_server_flush_timer_percentiles(self):
+        server = Server(pct_threshold=[50, 90, 99.9])
+        server.process('\n'.join('t:%d|ms' % i for i in range(1, 11)))
+        server.flush()
+
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        lines = dict(line.split()[:2]
+                     for line in payload.decode('utf-8').splitlines())
+        self.assertEqual(lines['stats.timers.t.upper_50'], '5.0')
+        self.assertEqual(lines['stats.timers.t.upper_90'], '9.0')
+        self.assertEqual(lines['stats.timers.t.upper_99_9'], '9.0')
+        self.assertEqual(lines['stats.timers.t.sum'], '55.0')
+        self.assertEqual(lines['stats.timers.t.sum_squares'], '385.0')
+        self.assertEqual(lines['stats.timers.t.median'], '5.5')
+        self.assertAlmostEqual(float(lines['stats.timers.t.std']), 2.8722813)
+
+    def test_server_flush_global_prefix(self):
+        server = Server(global_prefix='key')
+        server.process('c:1|c\nt:1|ms')
+        server.flush()
+
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        lines = payload.decode('utf-8').splitlines()
+        self.assertTrue(payload.endswith(b'\n'))
+        self.assertTrue(all(line.startswith('key.') for line in lines))
+        self.assertTrue(any(line.startswith('key.stats.timers.t.count ')
+                            for line in lines))
+
+    def test_server_flush_pickle(self):
+        server = Server(transport='graphite-pickle', no_aggregate_counters=True)
+        self.assertEqual(server.graphite_port, 2004)
+        server.process('c:2|c\nt:1|ms')
+        server.flush()
+
+        metrics = {}
+        for call in self.mock_socket.return_value.sendall.call_args_list:
+            frame = bytes(call[0][0])
+            for path, (ts, value) in pickle.loads(frame[4:]):
+                metrics[path] = value
+        self.assertEqual(metrics['stats.c'], 2.0)
+        self.assertEqual(metrics['stats.timers.t.count'], 1)
+        self.assertEqual(metrics['statsd.numStats'], 2)
+
+    def test_server_flush_ganglia(self):
+        server = Server(transport='ganglia')
+        server.process('c:1|c')
+        server.flush()
+        g = server._gmetric
+        server.process('c:1|c')
+        server.flush()
+
+        self.assertTrue(server._gmetric is g)
+        # metadata once, then one data packet per flush
+        name = b'\x00\x00\x00\x01c\x00\x00\x00'
+        packets = [call[0][0] for call in self.mock_socket.return_value.sendto.call_args_list]
+        self.assertEqual(len([p for p in packets if name in p]), 3)
+
+    def test_server_gauge_deltas(self):
+        server = Server()
+        server.process('g:10|g\ng:+5|g\ng:-3|g\nn:-2|g\nm:0:-4:+1|g')
+        self.assertEqual(server.gauges['g'].value, 12)
+        self.assertEqual(server.gauges['n'].value, -2)
+        self.assertEqual(server.gauges['m'].value, -3)
+
+        # Deltas apply to the value kept from earlier flushes.
+        server.flush()
+        server.process('g:+1:+1|g')
+        self.assertEqual(server.gauges['g'].value, 14)
+        server.process('g:4|g')
+        self.assertEqual(server.gauges['g'].value, 4)
+
+    def test_merge_gauge_deltas(self):
+        server = Server()
+        server.process('g:10|g')
+        server.flush()
+
+        shard = Server()
+        shard._worker = True
+        shard.process('g:+2|g\ng:+3|g\nh:-1|g')
+        self.assertEqual(type(shard.gauges['g']).__name__, '_GaugeDelta')
+        shard = pickle.loads(pickle.dumps(shard.gauges))
+        server.merge({}, shard, {})
+        self.assertEqual(server.gauges['g'].value, 15)
+        self.assertEqual(server.gauges['h'].value, -1)
+
+        shard = Server()
+        shard._worker = True
+        shard.process('g:+2|g\ng:1|g\ng:+1|g')
+        server.merge({}, shard.gauges, {})
+        self.assertEqual(server.gauges['g'].value, 2)
+
+    def test_server_histogram(self):
+        for backend in ('list', 'sketch'):
+            server = Server(timer_backend=backend,
+                            histograms=[('api.', [10, 50, 100]), ('', [0.5, float('inf')])])
+            server.process('\n'.join('api.t:%d|ms' % i for i in range(1, 201)))
+            server.process('db.t:0.25:1|ms')
+            server.flush()
+
+            payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+            lines = dict(line.split()[:2]
+                         for line in payload.decode('utf-8').splitlines())
+            # The sketch only knows samples to within 1%, so those at
+            # an edge may be counted in the next bin.
+            slack = 1 if backend == 'sketch' else 0
+            for label, count in (('10', 10), ('50', 40), ('100', 50)):
+                value = int(lines['stats.timers.api.t.histogram.bin_' + label])
+                self.assertTrue(abs(value - count) <= slack, (backend, label, value))
+            self.assertEqual(lines['stats.timers.db.t.histogram.bin_0_5'], '1', backend)
+            self.assertEqual(lines['stats.timers.db.t.histogram.bin_inf'], '1', backend)
+            self.assertFalse('stats.timers.api.t.histogram.bin_inf' in lines)
+
+    def test_timer_stats_bins(self):
+        samples = [random.uniform(0, 100) for i in range(1000)]
+        bins = ([25.0, 50.0, 75.0], ['25', '50', '75'])
+        expected = [sum(1 for s in samples if 0 <= s <= 25),
+                    sum(1 for s in samples if 25 < s <= 50),
+                    sum(1 for s in samples if 50 < s <= 75)]
+        for values in (samples, array('d', samples)):
+            stat = _timer_stats(values, [90], bins)
+            self.assertEqual([count for label, count in stat['bins']], expected)
+
+    def test_parse_histogram(self):
+        self.assertEqual(_parse_histogram('api.=10,50,inf'), ('api.', [10.0, 50.0, float('inf')]))
+        self.assertEqual(_parse_histogram('1,2'), ('', [1.0, 2.0]))
+        self.assertRaises(ValueError, _parse_histogram, 'a=5,1')
+
+    def test_timer_stats_low_percentiles(self):
+        for values in (array('d', [1, 2, 3]), [3, 1, 2], array('d', range(1, 4)) * 100):
+            stat = _timer_stats(values, [10, 25, 50])
+            self.assertEqual([t for pct, t in stat['thresholds']][:2], [1.0, 1.0])
+        sketch = server_module.QuantileSketch()
+        sketch.extend([1, 2, 3])
+        stat = _timer_stats(sketch, [10])
+        self.assertTrue(abs(stat['thresholds'][0][1] - 1) < 0.02)
+
+    def test_parse_pcts(self):
+        self.assertEqual(_parse_pcts('90'), [90])
+        self.assertEqual(_parse_pcts('50,99.9'), [50, 99.9])
+        self.assertRaises(ValueError, _parse_pcts, '0')
+
+    def test_timer_samples_are_packed(self):
+        server = Server()
+        server.process('t:1:2|ms')
+        self.assertEqual(server.timers['t'].value, array('d', [1.0, 2.0]))
+
+    def test_timer_stats_vectorized(self):
+        rnd = random.Random(0)
+        samples = [rnd.uniform(0, 100) for i in range(1000)]
+        stats = {}
+        for vectorized in (False, True):
+            with mock.patch.object(server_module, 'numpy',
+                                   server_module.numpy if vectorized else None):
+                stats[vectorized] = _timer_stats(array('d', samples), [50, 90])
+
+        plain, vector = stats[False], stats[True]
+        self.assertEqual(plain['count'], vector['count'])
+        for name in ('min', 'max', 'median', 'thresholds'):
+            self.assertEqual(plain[name], vector[name])
+        for name in ('sum', 'sum_squares', 'mean', 'std'):
+            self.assertAlmostEqual(plain[name], vector[name], places=6)
+        self.assertEqual(plain['thresholds'][1][1], sorted(samples)[899])
+
+    def test_server_internal_metrics(self):
+        server = Server()
+        server.process(b'a:1|c\nbad\nb:x|c')
+        server.flush()
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+
+        for line in (b'statsd.packetsReceived 1 ', b'statsd.linesReceived 3 ',
+                     b'statsd.bytesReceived 15 ', b'statsd.badLines.malformed 1 ',
+                     b'statsd.badLines.badValue 1 ', b'statsd.keys.counters 1 '):
+            self.assertTrue(line in payload, line)
+        self.assertEqual(server.totals['lines'], 3)
+        self.assertTrue(server.bytes_sent >= len(payload))
+
+        # The next flush reports how the last one went.
+        sent = server.bytes_sent
+        server.flush()
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        self.assertTrue(b'statsd.packetsReceived 0 ' in payload)
+        self.assertTrue(('statsd.bytesSent %d ' % sent).encode() in payload)
+
+    def test_server_bytes_sent_while_graphite_down(self):
+        server = Server()
+        sendall = self.mock_socket.return_value.sendall
+        sendall.side_effect = socket.error
+        server.process('a:1|c')
+        server.flush()
+        queued = server._graphite.queued_bytes
+        self.assertTrue(queued > 0)
+        self.assertEqual(server.bytes_sent, 0)
+
+        sendall.side_effect = None
+        server._graphite.connections[0].retry_at = 0
+        server.flush()
+        payload = bytes(sendall.call_args[0][0])
+        self.assertEqual(server._graphite.queued_bytes, 0)
+        self.assertEqual(server.bytes_sent, queued + len(payload))
+
+    def test_server_flush_duration_includes_collect(self):
+        server = Server()
+        server._workers = [None]
+        with mock.patch.object(server, '_collect', side_effect=lambda: time.sleep(0.05)):
+            server.flush()
+        server._workers = []
+        self.assertTrue(server.flush_duration >= 50)
+
+    def test_max_keys(self):
+        server = Server(max_keys=2)
+        server.process('a:1|c\nb:1|c\nc:1|c\nd:2|c\na:1|c\nt1:1|ms\nt2:1|ms\nt3:3|ms')
+
+        self.assertEqual(sorted(server.counters), ['a', 'b', 'statsd.overflow'])
+        self.assertEqual(server.counters['a'].value, 2)
+        self.assertEqual(server.counters['statsd.overflow'].value, 3)
+        self.assertEqual(list(server.timers['statsd.overflow'].value), [3.0])
+
+        server.flush()
+        payload = bytes(self.mock_socket.return_value.sendall.call_args[0][0])
+        self.assertTrue(b'statsd.cardinality.rejected 3 ' in payload)
+        self.assertTrue(b'statsd.cardinality.rejectedKeys 3 ' in payload)
+
+        # Limits start over every flush.
+        server.process('c:1|c')
+        self.assertEqual(list(server.counters), ['c'])
+
+    def test_max_keys_per_prefix(self):
+        server = Server(max_keys_per_prefix=2)
+        lines = ['api.req%d.x:1|c' % i for i in range(3)]
+        lines += ['api.req0.y:1|c', 'app.a:1|c']
+        server.process('\n'.join(lines))
+
+        # api.req0.x and api.req1.x use up the budget of the api prefix.
+        self.assertEqual(sorted(server.counters),
+                         ['api.req0.x', 'api.req1.x', 'app.a', 'statsd.overflow'])
+        server.process('\n'.join(lines))
+        self.assertEqual(server.counters['statsd.overflow'].value, 4)
+
+    def test_max_keys_gauges_persist(self):
+        server = Server(max_keys=1)
+        server.process('g1:1|g')
+        server.flush()
+        server.process('g2:1|g\ng1:2|g')
+
+        self.assertEqual(sorted(server.gauges), ['g1', 'statsd.overflow'])
+
+    def test_max_keys_per_prefix_gauges_persist(self):
+        server = Server(max_keys_per_prefix=10, expire=1)
+        with mock.patch('pystatsd.server.time.time', return_value=1000.0):
+            for flush in range(5):
+                server.process('\n'.join('app.g%d.%d:1|g' % (flush, i) for i in range(20)))
+                server.flush()
+        gauges = [k for k in server._flushed_gauges if k.startswith('app.')]
+        self.assertEqual(len(gauges), 10)
+
+        # Once gauges expire, their prefix gets its places back.
+        with mock.patch('pystatsd.server.time.time', return_value=1010.0):
+            server.flush()
+            server.process('app.new:1|g')
+        self.assertTrue('app.new' in server.gauges)
+
+    def test_merge_rejections(self):
+        shard = Server(max_keys=1)
+        shard.process('a:1|c\nb:1|c')
+        merged = Server(max_keys=1)
+        merged.process('c:1|c')
+        merged.merge(shard.counters, shard.gauges, shard.timers,
+                     shard._reset_limits())
+
+        self.assertEqual(merged.counters['statsd.overflow'].value, 2)
+        self.assertEqual(merged._rejected[0], 2)
+        self.assertEqual(merged._rejected[1].count(), 2)
+
+    def test_server_flush_under_load(self):
+        server = Server(no_aggregate_counters=True)
+        sendall = self.mock_socket.return_value.sendall
+        samples = 20000
+        done = threading.Event()
+
+        def ingest():
+            for i in range(samples):
+                server.process('c:1|c\nt:1|ms')
+            done.set()
+
+        thread = threading.Thread(target=ingest)
+        thread.start()
+        while not done.is_set():
+            server.flush()
+        thread.join()
+        server.flush()
+
+        counted = timed = 0
+        for call in sendall.call_args_list:
+            for line in bytes(call[0][0]).decode('utf-8').splitlines():
+                name, value, ts = line.split()
+                if name == 'stats.c':
+                    counted += float(value)
+                elif name == 'stats.timers.t.count':
+                    timed += int(value)
+        self.assertEqual(counted, samples)
+        self.assertEqual(timed, samples)
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+
+class ServerReceiveTestCase(unittest.TestCase):
+    """
+    Tests the batched receive path against a real loopback socket
+    """
+    def test_drain(self):
+        server = Server(recv_batch=2)
+        sock = server._bind(('127.0.0.1', 0))
+        sock.setblocking(0)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for i in range(3):
+                client.sendto(b'a:1|c', sock.getsockname())
+
+            # Only recv_batch datagrams are taken per call, and draining an
+            # empty socket returns instead of blocking.
+            server._drain(sock)
+            self.assertEqual(server.counters['a'].value, 2)
+            server._drain(sock)
+            server._drain(sock)
+            self.assertEqual(server.counters['a'].value, 3)
+        finally:
+            client.close()
+            sock.close()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'statsd.sock')
+        server = Server(unix_socket=path)
+        dgram, listeners = server._bind_listeners('127.0.0.1')
+        self.assertEqual(listeners, [])
+        sock = dgram[0]
+        sock.setblocking(0)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            client.sendto(b'a:1|c', path)
+            server._drain(sock)
+            self.assertEqual(server.counters['a'].value, 1)
+        finally:
+            client.close()
+            sock.close()
+            os.unlink(path)
+
+    def test_unix_socket_path_is_not_a_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'statsd.conf')
+        with open(path, 'w') as f:
+            f.write('keep me')
+        server = Server(unix_socket=path)
+        self.assertRaises(ValueError, server._bind_unix, path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep me')
+
+    def test_unix_socket_stale_and_stop(self):
+        path = os.path.join(tempfile.mkdtemp(), 'statsd.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(path)
+        stale.close()
+
+        server = Server(unix_socket=path)
+        server._socks = [server._bind_unix(path)]
+        server._timer = mock.Mock()
+        # Only the socket this server bound is removed, not a file that
+        # has replaced it.
+        os.unlink(path)
+        with open(path, 'w') as f:
+            f.write('keep me')
+        server.stop()
+        self.assertTrue(os.path.exists(path))
+
+        server = Server(unix_socket=path)
+        os.unlink(path)
+        server._socks = [server._bind_unix(path)]
+        server._timer = mock.Mock()
+        server.stop()
+        self.assertFalse(os.path.exists(path))
+
+    def test_tcp_stream(self):
+        server = Server()
+        conn, client = socket.socketpair()
+        try:
+            conn.setblocking(0)
+            server._streams[conn] = b''
+            client.sendall(b'a:1|c\na:2')
+            server._read_stream(conn)
+            self.assertEqual(server.counters['a'].value, 1)
+
+            # The partial line is completed by the next read, and the
+            # last line is processed when the client goes away.
+            client.sendall(b'|c\nt:5|ms')
+            client.close()
+            server._read_stream(conn)
+            server._read_stream(conn)
+            self.assertEqual(server.counters['a'].value, 3)
+            self.assertEqual(list(server.timers['t'].value), [5.0])
+            self.assertEqual(server._streams, {})
+        finally:
+            conn.close()
+
+    def test_bind_rcvbuf(self):
+        server = Server(rcvbuf=65536)
+        sock = server._bind(('127.0.0.1', 0))
+        try:
+            self.assertTrue(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536)
+        finally:
+            sock.close()
+
+
+class ServerWorkersTestCase(unittest.TestCase):
+    """
+    Tests that sharded aggregation matches a single process
+    """
+    def test_merge(self):
+        lines = ['c:1|c', 'c:2|c|@0.5', 't:3|ms', 't:1|ms', 'g:1|g', 's:a|s', 's:b|s', 's:a|s']
+        single = Server()
+        single.process('\n'.join(lines))
+
+        merged = Server()
+        for line in lines:
+            shard = Server()
+            shard.process(line)
+            merged.merge(shard.counters, shard.gauges, shard.timers, sets=shard.sets)
+
+        self.assertEqual(merged.sets['s'].value.count(), 2)
+        self.assertEqual(merged.counters, single.counters)
+        self.assertEqual(merged.gauges, single.gauges)
+        self.assertEqual(sorted(merged.timers['t'].value),
+                         sorted(single.timers['t'].value))
+
+    def test_workers(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        addr = probe.getsockname()
+        probe.close()
+
+        server = Server(workers=2, recv_batch=16)
+        server._start_workers(addr)
+        try:
+            # Different source ports hash to different worker sockets.
+            for i in range(8):
+                client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                client.sendto(b'c:1|c\nt:%d|ms\ns:%d|s' % (i, i % 3), addr)
+                client.close()
+            # Give the workers a moment to drain their sockets.
+            time.sleep(0.2)
+            server._collect()
+        finally:
+            for process, conn in server._workers:
+                process.terminate()
+
+        self.assertEqual(server.counters['c'].value, 8)
+        self.assertEqual(sorted(server.timers['t'].value),
+                         [float(i) for i in range(8)])
+        self.assertEqual(server.sets['s'].value.count(), 3)
+
+    def _worker_server(self, workers):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        addr = probe.getsockname()
+        probe.close()
+
+        server = Server(workers=workers, flush_interval=1000)
+        server._start_workers(addr)
+        return server
+
+    def test_flush_survives_dead_worker(self):
+        server = self._worker_server(2)
+        dead, alive = server._workers
+        try:
+            dead[0].terminate()
+            dead[0].join()
+            server.process('c:1|c')
+            with mock.patch.object(server, '_send_graphite') as send:
+                server.flush()
+                server.flush()
+        finally:
+            for process, conn in server._workers:
+                process.terminate()
+
+        self.assertEqual(server._workers, [alive])
+        self.assertEqual(send.call_count, 2)
+        payload = b''.join(send.call_args_list[0][0][0])
+        self.assertTrue(b'stats.c 1.0 ' in payload)
+
+    def test_workers_exit_with_parent_pipe(self):
+        server = self._worker_server(2)
+        try:
+            # Closing this end of the pipes is what the parent dying does.
+            for process, conn in server._workers:
+                conn.close()
+            for process, conn in server._workers:
+                process.join(5)
+                self.assertFalse(process.is_alive())
+        finally:
+            for process, conn in server._workers:
+                process.terminate()
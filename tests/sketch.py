@@ -0,0 +1,70 @@
+import random
+import unittest
+
+from pystatsd.sketch import QuantileSketch
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """
+    Tests the timer quantile sketch
+    """
+    def test_quantiles_within_relative_accuracy(self):
+        rnd = random.Random(42)
+        values = [rnd.lognormvariate(3, 1.5) for i in range(10000)]
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        sketch.extend(values)
+        values.sort()
+
+        self.assertEqual(len(sketch), len(values))
+        self.assertEqual(sketch.min, values[0])
+        self.assertEqual(sketch.max, values[-1])
+        self.assertAlmostEqual(sketch.sum, sum(values), places=6)
+        for rank in (0, 10, 5000, 9000, 9899, 9989, -1):
+            expected = values[rank]
+            self.assertTrue(
+                abs(sketch.value_at_rank(rank) - expected) <= 0.01 * expected)
+
+    def test_zero_and_negative(self):
+        sketch = QuantileSketch()
+        sketch.extend([-10, 0, 0, 10])
+
+        self.assertAlmostEqual(sketch.value_at_rank(0), -10, delta=0.1)
+        self.assertEqual(sketch.value_at_rank(1), 0)
+        self.assertEqual(sketch.value_at_rank(2), 0)
+        self.assertAlmostEqual(sketch.value_at_rank(3), 10, delta=0.1)
+
+    def test_merge(self):
+        a = QuantileSketch()
+        b = QuantileSketch()
+        a.extend(range(1, 501))
+        b.extend(range(501, 1001))
+        a.extend(b)
+
+        self.assertEqual(a.count, 1000)
+        self.assertEqual(a.min, 1)
+        self.assertEqual(a.max, 1000)
+        self.assertTrue(abs(a.quantile(0.5) - 500) <= 0.01 * 500)
+        self.assertRaises(ValueError, a.extend, QuantileSketch(0.05))
+
+    def test_bounded_buckets(self):
+        sketch = QuantileSketch(max_buckets=10)
+        sketch.extend(2 ** i for i in range(100))
+
+        self.assertTrue(len(sketch._positive) <= 10)
+        self.assertEqual(sketch.count, 100)
+        self.assertTrue(
+            abs(sketch.value_at_rank(-1) - 2 ** 99) <= 0.01 * 2 ** 99)
+
+    def test_ranks_follow_new_samples(self):
+        sketch = QuantileSketch()
+        sketch.extend([1, 2, 3])
+        self.assertAlmostEqual(sketch.value_at_rank(-1), 3, delta=0.03)
+
+        sketch.append(100)
+        self.assertAlmostEqual(sketch.value_at_rank(-1), 100, delta=1)
+        other = QuantileSketch()
+        other.extend([-5, 0])
+        sketch.extend(other)
+        self.assertAlmostEqual(sketch.value_at_rank(0), -5, delta=0.05)
+        self.assertEqual(sketch.value_at_rank(1), 0)
+        self.assertAlmostEqual(sketch.value_at_rank(2), 1, delta=0.01)